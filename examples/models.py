@@ -47,19 +47,29 @@ class LdapUser(ldapdb.models.Model):
     first_name = CharField(db_column='givenName')
     last_name = CharField(db_column='sn')
     full_name = CharField(db_column='cn')
-    email = CharField(db_column='mail')
-    phone = CharField(db_column='telephoneNumber', blank=True)
-    mobile_phone = CharField(db_column='mobile', blank=True)
+    email = CharField(db_column='mail', equality_rule='caseIgnoreIA5Match',
+                      ordering_rule=None)
+    phone = CharField(db_column='telephoneNumber', blank=True,
+                      equality_rule='telephoneNumberMatch', ordering_rule=None)
+    mobile_phone = CharField(db_column='mobile', blank=True,
+                             equality_rule='telephoneNumberMatch',
+                             ordering_rule=None)
     photo = ImageField(db_column='jpegPhoto')
 
     # posixAccount
     uid = IntegerField(db_column='uidNumber', unique=True)
     group = IntegerField(db_column='gidNumber')
-    gecos = CharField(db_column='gecos')
-    home_directory = CharField(db_column='homeDirectory')
-    login_shell = CharField(db_column='loginShell', default='/bin/bash')
+    gecos = CharField(db_column='gecos', equality_rule='caseIgnoreIA5Match',
+                      ordering_rule=None)
+    home_directory = CharField(db_column='homeDirectory',
+                               equality_rule='caseExactIA5Match',
+                               ordering_rule=None)
+    login_shell = CharField(db_column='loginShell', default='/bin/bash',
+                            equality_rule='caseExactIA5Match',
+                            ordering_rule=None)
     username = CharField(db_column='uid', primary_key=True)
-    password = CharField(db_column='userPassword')
+    password = CharField(db_column='userPassword',
+                         equality_rule='octetStringMatch', ordering_rule=None)
 
     date_of_birth = DateField(db_column='birthday', blank=True)
     latitude = FloatField(db_column='latitude', blank=True)
@@ -78,11 +88,13 @@ class LdapGroup(ldapdb.models.Model):
     # LDAP meta-data
     base_dn = "ou=groups,dc=nodomain"
     object_classes = ['posixGroup']
+    unique_rdns = True
 
     # posixGroup attributes
     gid = IntegerField(db_column='gidNumber', unique=True)
     name = CharField(db_column='cn', max_length=200, primary_key=True)
-    usernames = ListField(db_column='memberUid')
+    usernames = ListField(db_column='memberUid',
+                          equality_rule='caseExactIA5Match')
 
     def __str__(self):
         return self.name
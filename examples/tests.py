@@ -32,12 +32,27 @@
 
 import datetime
 import ldap
+import os
+import pickle
+import unittest
+from ldap.controls import SimplePagedResultsControl
 
 from django.conf import settings
-from django.db.models import Q, Count
+from django.db import connections
+from django.db.models import Q, Count, signals
 from django.test import TestCase
 
+from ldapdb.backends.ldap.base import (ASSERTION_OID, PERMISSIVE_MODIFY_OID,
+                                       SERVER_SIDE_SORT_OID, TREE_DELETE_OID)
+from ldapdb.backends.ldap.cache import clear_query_caches
 from ldapdb.backends.ldap.compiler import query_as_ldap
+from ldapdb.backends.ldap.mirror import close_mirrors
+from ldapdb.backends.ldap.poller import (Poller, asyncio, close_pollers,
+                                         get_poller)
+from ldapdb.backends.ldap.pool import close_pools
+from ldapdb.middleware import IdentityMapMiddleware
+from ldapdb.models.identity import identity_map
+from ldapdb.models.query import StopAsyncIteration
 from examples.models import LdapUser, LdapGroup
 
 from mockldap import MockLdap
@@ -133,6 +148,576 @@ class ConnectionTestCase(TestCase):
         self.assertEqual(self.ldapobj.bound_as, admin[0])
 
 
+class PoolTestCase(TestCase):
+    directory = dict([admin, groups, foogroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        settings.DATABASES['ldap']['POOL'] = {'MAX_SIZE': 2}
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+        del settings.DATABASES['ldap']['POOL']
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+
+    def tearDown(self):
+        close_pools()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_connection_reused(self):
+        LdapGroup.objects.get(name='foogroup')
+        LdapGroup.objects.get(name='bargroup')
+        # every search used the connection bound for the first one
+        methods = self.ldapobj.methods_called()
+        self.assertEquals(methods[:2], ['initialize', 'simple_bind_s'])
+        self.assertEquals(set(methods[2:]), set(['search_s']))
+
+    def test_close_pools(self):
+        LdapGroup.objects.get(name='foogroup')
+        close_pools()
+        methods = self.ldapobj.methods_called()
+        self.assertEquals(methods[:2], ['initialize', 'simple_bind_s'])
+        self.assertEquals(set(methods[2:-1]), set(['search_s']))
+        self.assertEquals(methods[-1], 'unbind_s')
+
+
+class QueryCacheTestCase(TestCase):
+    directory = dict([admin, groups, foogroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        settings.DATABASES['ldap']['QUERY_CACHE'] = {'TIMEOUT': 60}
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+        del settings.DATABASES['ldap']['QUERY_CACHE']
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+
+    def tearDown(self):
+        clear_query_caches()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_cached(self):
+        LdapGroup.objects.get(name='foogroup')
+        g = LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(g.gid, 1000)
+        self.assertEquals(self.ldapobj.methods_called(),
+                          ['initialize', 'simple_bind_s', 'search_s'])
+
+        # other searches are not affected
+        self.assertEquals(LdapGroup.objects.count(), 2)
+
+    def test_cached_sorted(self):
+        connection = connections['ldap']
+        connection.features._supported_controls = set([SERVER_SIDE_SORT_OID])
+        try:
+            for i in range(2):
+                # the mock server ignores the sort control
+                qs = LdapGroup.objects.order_by('name')
+                self.assertEquals(sorted(g.name for g in qs),
+                                  ['bargroup', 'foogroup'])
+        finally:
+            connection.features._supported_controls = None
+        self.assertEquals(self.ldapobj.methods_called(),
+                          ['initialize', 'simple_bind_s', 'search_s'])
+
+    def test_paged_not_cached(self):
+        for i in range(2):
+            self.assertEquals(len(LdapGroup.objects.page_size(1)), 2)
+        self.assertEquals(self.ldapobj.methods_called(),
+                          ['initialize', 'simple_bind_s', 'search_s',
+                           'search_s'])
+
+    def test_invalidated_on_write(self):
+        LdapGroup.objects.count()
+        g = LdapGroup.objects.get(name='foogroup')
+        g.gid = 1010
+        g.save()
+
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1010)
+        g = LdapGroup(name='newgroup', gid=1011)
+        g.save()
+        self.assertEquals(LdapGroup.objects.count(), 3)
+
+        g.delete()
+        self.assertEquals(LdapGroup.objects.count(), 2)
+        self.assertRaises(LdapGroup.DoesNotExist, LdapGroup.objects.get,
+                          name='newgroup')
+
+
+class ReplicaTestCase(TestCase):
+    directory = dict([admin, groups, foogroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        settings.DATABASES['ldap']['REPLICAS'] = ['ldap://replica']
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+        del settings.DATABASES['ldap']['REPLICAS']
+
+    def setUp(self):
+        self.mockldap.start()
+        self.provider = self.mockldap[settings.DATABASES['ldap']['NAME']]
+        self.replica = self.mockldap['ldap://replica']
+        connections['ldap'].last_write = None
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.provider
+        del self.replica
+
+    def test_read_from_replica(self):
+        LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(self.provider.methods_called(), [])
+        self.assertEquals(self.replica.methods_called(),
+                          ['initialize', 'simple_bind_s', 'search_s'])
+
+    def test_read_after_write(self):
+        g = LdapGroup(name='newgroup', gid=1010)
+        g.save()
+        LdapGroup.objects.get(name='newgroup')
+        self.assertEquals(self.provider.methods_called(),
+                          ['initialize', 'simple_bind_s', 'add_s',
+                           'search_s'])
+        self.assertEquals(self.replica.methods_called(), [])
+
+
+class MirrorTestCase(TestCase):
+    directory = dict([
+        admin, groups,
+        (foogroup[0], dict(foogroup[1], modifyTimestamp=['20150101000000Z'])),
+        (bargroup[0], dict(bargroup[1], modifyTimestamp=['20150101000000Z']))])
+
+    @classmethod
+    def setUpClass(cls):
+        settings.DATABASES['ldap']['LOCAL_MIRROR'] = {
+            'INTERVAL': None,
+            'SYNCREPL': False,
+        }
+        settings.DATABASES['ldap']['READ_AFTER_WRITE_WINDOW'] = 0
+        LdapGroup.local_mirror = True
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+        del LdapGroup.local_mirror
+        del settings.DATABASES['ldap']['LOCAL_MIRROR']
+        del settings.DATABASES['ldap']['READ_AFTER_WRITE_WINDOW']
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+        connections['ldap'].last_write = None
+
+    def tearDown(self):
+        close_mirrors()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def seed_poll(self, timestamp, results):
+        # the mock does not support ordering filters
+        mirror = connections['ldap'].get_mirror(LdapGroup)
+        self.ldapobj.search_s.seed(
+            'ou=groups,dc=nodomain', ldap.SCOPE_SUBTREE,
+            '(&(&(objectClass=posixGroup))(modifyTimestamp>=%s))' % timestamp,
+            mirror.attrlist + ['modifyTimestamp'])(results)
+
+    def test_read_from_mirror(self):
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1000)
+        self.assertEquals(LdapGroup.objects.filter(gid__gte=1001).count(), 1)
+        qs = LdapGroup.objects.filter(name__startswith='ba')
+        self.assertEquals(list(qs.values_list('name', flat=True)),
+                          ['bargroup'])
+        self.assertEquals(LdapGroup.objects.estimated_count(), 2)
+
+        # the entries were only searched once
+        self.assertEquals(self.ldapobj.methods_called(),
+                          ['initialize', 'simple_bind_s', 'search_s'])
+
+    def test_poll_after_write(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        g.gid = 1010
+        g.save()
+
+        self.seed_poll('20150101000000Z', [
+            (foogroup[0], dict(foogroup[1], gidNumber=['1010'],
+                               modifyTimestamp=['20150102000000Z']))])
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1010)
+
+        LdapGroup.objects.get(name='bargroup').delete()
+        self.seed_poll('20150102000000Z', [])
+        self.assertEquals(LdapGroup.objects.count(), 1)
+
+    def test_poll_error(self):
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1000)
+        mirror = connections['ldap'].get_mirror(LdapGroup)
+        mirror.wake()
+
+        # the server is searched instead
+        self.seed_poll('20150101000000Z', ldap.SERVER_DOWN())
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1000)
+        method, args, kwargs = self.ldapobj.methods_called(
+            with_args=True)[-1]
+        self.assertEquals((method, args[0]), ('search_s', foogroup[0]))
+
+    def test_wake_interval(self):
+        mirror = connections['ldap'].get_mirror(LdapGroup)
+        mirror.interval = 30
+        mirror.sync()
+        self.assertEquals(len(mirror.search('(cn=foogroup)')), 1)
+
+        # the copy is not used until the background update ran
+        mirror.wake()
+        self.assertEquals(mirror.search('(cn=foogroup)'), None)
+        self.seed_poll('20150101000000Z', [])
+        mirror.sync()
+        self.assertEquals(len(mirror.search('(cn=foogroup)')), 1)
+
+
+class IdentityMapTestCase(TestCase):
+    directory = dict([admin, groups, foogroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_get(self):
+        with identity_map():
+            g = LdapGroup.objects.get(name='foogroup')
+            self.assertTrue(LdapGroup.objects.get(name='foogroup') is g)
+            self.assertTrue(LdapGroup.objects.get(pk='foogroup') is g)
+            self.assertTrue(LdapGroup.objects.get(dn=g.dn) is g)
+            self.assertEquals(self.ldapobj.methods_called(),
+                              ['initialize', 'simple_bind_s', 'search_s'])
+
+            # other lookups search the directory
+            self.assertEquals(
+                LdapGroup.objects.filter(gid=1000).get(name='foogroup').gid,
+                1000)
+            self.assertEquals(len(self.ldapobj.methods_called()), 4)
+
+        self.assertFalse(LdapGroup.objects.get(name='foogroup') is g)
+
+    def test_get_lazy(self):
+        with identity_map():
+            g = LdapGroup.objects.lazy().get(name='foogroup')
+            self.assertTrue(LdapGroup.objects.get(name='foogroup') is g)
+            self.assertTrue(LdapGroup.objects.lazy().get(dn=g.dn) is g)
+            self.assertEquals(self.ldapobj.methods_called(),
+                              ['initialize', 'simple_bind_s', 'search_s'])
+
+    def test_save_delete(self):
+        with identity_map():
+            g = LdapGroup(name='newgroup', gid=1010)
+            g.save()
+            self.assertTrue(LdapGroup.objects.get(name='newgroup') is g)
+
+            g.name = 'newgroup2'
+            g.save()
+            self.assertTrue(LdapGroup.objects.get(name='newgroup2') is g)
+            self.assertRaises(LdapGroup.DoesNotExist, LdapGroup.objects.get,
+                              name='newgroup')
+
+            g.delete()
+            self.assertRaises(LdapGroup.DoesNotExist, LdapGroup.objects.get,
+                              name='newgroup2')
+
+    def test_update_queryset(self):
+        with identity_map():
+            g = LdapGroup.objects.get(name='foogroup')
+            LdapGroup.objects.filter(name='foogroup').update(gid=1010)
+            g2 = LdapGroup.objects.get(name='foogroup')
+            self.assertFalse(g2 is g)
+            self.assertEquals(g2.gid, 1010)
+
+    def test_middleware(self):
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(None)
+        g = LdapGroup.objects.get(name='foogroup')
+        self.assertTrue(LdapGroup.objects.get(name='foogroup') is g)
+        self.assertEquals(middleware.process_response(None, 'response'),
+                          'response')
+        self.assertFalse(LdapGroup.objects.get(name='foogroup') is g)
+
+
+class AsyncLDAPObject(object):
+    """
+    Provides the asynchronous methods of python-ldap >= 2.4, which the mock
+    LDAP object lacks, on top of its synchronous ones.
+    """
+
+    def __init__(self, ldapobj):
+        self.ldapobj = ldapobj
+        self.responses = {}
+        self.last_msgid = 0
+        self.fds = os.pipe()
+        # the deleted DNs, with the OIDs of the controls sent along
+        self.deleted = []
+        # the cookies of the requested pages
+        self.cookies = []
+
+    def _call(self, method, args, rtype, page_control=None):
+        rctrls = []
+        try:
+            result = getattr(self.ldapobj, method)(*args)
+        except ldap.LDAPError as e:
+            responses = [(e, None, None)]
+        else:
+            responses = []
+            if rtype == ldap.RES_SEARCH_RESULT:
+                if page_control is not None:
+                    self.cookies.append(page_control.cookie)
+                    start = int(page_control.cookie or 0)
+                    end = start + page_control.size
+                    cookie = end < len(result) and str(end) or ''
+                    rctrls.append(SimplePagedResultsControl(
+                        False, size=page_control.size, cookie=cookie))
+                    result = sorted(result)[start:end]
+                responses = [(ldap.RES_SEARCH_ENTRY, [entry], [])
+                             for entry in result]
+            responses.append((rtype, [], rctrls))
+        self.last_msgid += 1
+        self.responses[self.last_msgid] = responses
+        return self.last_msgid
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   *args, **kwargs):
+        page_control = None
+        for control in serverctrls or []:
+            if isinstance(control, SimplePagedResultsControl):
+                page_control = control
+        return self._call('search_s', (base, scope, filterstr, attrlist),
+                          ldap.RES_SEARCH_RESULT, page_control)
+
+    def add_ext(self, dn, modlist, *args, **kwargs):
+        return self._call('add_s', (dn, modlist), ldap.RES_ADD)
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        self.deleted.append((dn, [c.controlType for c in serverctrls or ()]))
+        return self._call('delete_s', (dn,), ldap.RES_DELETE)
+
+    def modify_ext(self, dn, modlist, *args, **kwargs):
+        return self._call('modify_s', (dn, modlist), ldap.RES_MODIFY)
+
+    def rename(self, dn, newrdn, *args, **kwargs):
+        return self._call('rename_s', (dn, newrdn), ldap.RES_MODRDN)
+
+    def result3(self, msgid, all=1, timeout=None):
+        rtype, rdata, rctrls = self.responses[msgid].pop(0)
+        if not self.responses[msgid]:
+            del self.responses[msgid]
+        if isinstance(rtype, ldap.LDAPError):
+            raise rtype
+        return rtype, rdata, msgid, rctrls
+
+    def fileno(self):
+        return self.fds[0]
+
+    def unbind_s(self):
+        for fd in self.fds:
+            os.close(fd)
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class AsyncTestCase(TestCase):
+    directory = dict([admin, groups, foogroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+        # register a poller whose connections support asynchronous
+        # operations before the backend creates one
+        self.connections = []
+        get_poller(('ldap', settings.DATABASES['ldap']['NAME']),
+                   lambda: Poller(self.connect))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        close_pollers()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def connect(self):
+        connection = AsyncLDAPObject(self.ldapobj)
+        self.connections.append(connection)
+        return connection
+
+    def cookies(self):
+        return sum([c.cookies for c in self.connections], [])
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_aget(self):
+        g = self.wait(LdapGroup.objects.aget(name='foogroup'))
+        self.assertEquals(g.dn, 'cn=foogroup,ou=groups,dc=nodomain')
+        self.assertEquals(g.gid, 1000)
+        self.assertEquals(g.usernames, ['foouser', 'baruser'])
+
+        self.assertRaises(LdapGroup.DoesNotExist, self.wait,
+                          LdapGroup.objects.aget(name='nogroup'))
+
+    def test_afetch(self):
+        groups = self.wait(LdapGroup.objects.all().afetch())
+        self.assertEquals(sorted(g.name for g in groups),
+                          ['bargroup', 'foogroup'])
+        groups = self.wait(LdapGroup.objects.exclude(gid=1000).afetch())
+        self.assertEquals([g.name for g in groups], ['bargroup'])
+        self.assertEquals(self.wait(LdapGroup.objects.none().afetch()), [])
+
+    def test_aiter(self):
+        it = LdapGroup.objects.page_size(1).__aiter__()
+
+        # only the first page has been requested when its object is yielded
+        g = self.wait(it.__anext__())
+        self.assertEquals(g.name, 'bargroup')
+        self.assertEquals(self.cookies(), [''])
+
+        g = self.wait(it.__anext__())
+        self.assertEquals(g.name, 'foogroup')
+        self.assertEquals(self.cookies(), ['', '1'])
+        self.assertRaises(StopAsyncIteration, self.wait, it.__anext__())
+
+        # without a page size, the objects are fetched with a single search
+        it = LdapGroup.objects.exclude(gid=1000).__aiter__()
+        self.assertEquals(self.wait(it.__anext__()).name, 'bargroup')
+        self.assertRaises(StopAsyncIteration, self.wait, it.__anext__())
+
+    def test_asave(self):
+        g = LdapGroup(name='newgroup', gid=1010)
+        self.wait(g.asave())
+        self.assertEquals(g.dn, 'cn=newgroup,ou=groups,dc=nodomain')
+
+        g.gid = 1020
+        self.wait(g.asave())
+        self.assertEquals(LdapGroup.objects.get(name='newgroup').gid, 1020)
+
+        # renamed entries are moved before being modified
+        g.name = 'wizgroup'
+        g.usernames = ['wizuser']
+        self.wait(g.asave())
+        self.assertEquals(g.dn, 'cn=wizgroup,ou=groups,dc=nodomain')
+        self.assertEquals(LdapGroup.objects.get(name='wizgroup').usernames,
+                          ['wizuser'])
+
+    def test_asave_strict(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        g.strict_save = True
+        other = LdapGroup.objects.get(name='foogroup')
+        other.gid = 1010
+        other.save()
+
+        g.usernames = ['foouser']
+        self.wait(g.asave())
+        g.gid = 1020
+        self.assertRaises(ldap.ASSERTION_FAILED, self.wait, g.asave())
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1010)
+
+        self.ldapobj.delete_s(g.dn)
+        g.gid = 1010
+        g.usernames = ['baruser']
+        self.assertRaises(LdapGroup.DoesNotExist, self.wait, g.asave())
+
+    def test_adelete(self):
+        g = LdapGroup.objects.get(name='bargroup')
+        self.wait(g.adelete())
+        self.assertEquals(LdapGroup.objects.count(), 1)
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.wait, g.adelete())
+
+
+class TreeDeleteTestCase(TestCase):
+    subgroup = ('cn=subgroup,cn=foogroup,ou=groups,dc=nodomain', {
+        'objectClass': ['posixGroup'], 'gidNumber': ['1010'],
+        'cn': ['subgroup']})
+    directory = dict([admin, groups, foogroup, subgroup, bargroup])
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.DATABASES['ldap']['NAME']]
+        # pipeline the deletions over a connection providing result3()
+        self.connection = connections['ldap']
+        self.connection.connection = AsyncLDAPObject(self.ldapobj)
+
+    def tearDown(self):
+        self.connection.connection.unbind_s()
+        self.connection.connection = None
+        self.connection.features._supported_controls = None
+        settings.DATABASES['ldap'].pop('TREE_DELETE', None)
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_delete(self):
+        self.connection.features._supported_controls = set()
+        ldapobj = self.connection.connection
+        LdapGroup.objects.all().delete()
+
+        # subordinates are deleted first
+        self.assertEquals(ldapobj.deleted[0], (self.subgroup[0], []))
+        self.assertEquals(sorted(ldapobj.deleted[1:]),
+                          [(bargroup[0], []), (foogroup[0], [])])
+        self.assertEquals(LdapGroup.objects.count(), 0)
+
+    def test_tree_delete(self):
+        settings.DATABASES['ldap']['TREE_DELETE'] = True
+        self.connection.features._supported_controls = set([TREE_DELETE_OID])
+        ldapobj = self.connection.connection
+        LdapGroup.objects.all().delete()
+
+        # the server deletes the subordinates of the deleted entries
+        self.assertEquals(sorted(ldapobj.deleted),
+                          [(bargroup[0], [TREE_DELETE_OID]),
+                           (foogroup[0], [TREE_DELETE_OID])])
+
+
 class GroupTestCase(TestCase):
     directory = dict([admin, groups, foogroup, bargroup, wizgroup, foouser])
 
@@ -163,6 +748,37 @@ class GroupTestCase(TestCase):
         self.assertEquals(self.ldapobj.methods_called(),
                           ['initialize', 'simple_bind_s', 'search_s'])
 
+    def test_count_no_attributes(self):
+        qs = LdapGroup.objects.exclude(gid=1000)
+        self.assertEquals(qs.count(), 2)
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('search_s', (
+                              LdapGroup.base_dn, ldap.SCOPE_SUBTREE,
+                              '(&(objectClass=posixGroup)'
+                              '(!(gidNumber=1000)))',
+                              ['1.1']), {}))
+
+    def test_exists(self):
+        self.assertTrue(LdapGroup.objects.exclude(gid=1000).exists())
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('search_s', (
+                              LdapGroup.base_dn, ldap.SCOPE_SUBTREE,
+                              '(&(objectClass=posixGroup)'
+                              '(!(gidNumber=1000)))',
+                              ['1.1']), {}))
+        self.assertFalse(LdapGroup.objects.filter(gid=1010).exists())
+        self.assertFalse(LdapGroup.objects.none().exists())
+
+        # with an offset
+        self.assertTrue(LdapGroup.objects.all()[2:].exists())
+        self.assertFalse(LdapGroup.objects.all()[3:].exists())
+
+    def test_estimated_count(self):
+        # the mock server provides no estimate, so entries are counted
+        qs = LdapGroup.objects.all()
+        self.assertEquals(qs.estimated_count(), 3)
+        self.assertEquals(qs[1:].estimated_count(), 2)
+
     def test_aggregate_count(self):
         qs = LdapGroup.objects.all()
         result = qs.aggregate(num_groups=Count('name'))
@@ -190,6 +806,16 @@ class GroupTestCase(TestCase):
         qs = LdapGroup.objects.all()
         self.assertEquals(len(qs), 3)
 
+    def test_iterator(self):
+        names = sorted(g.name for g in LdapGroup.objects.iterator())
+        self.assertEquals(names, ['bargroup', 'foogroup', 'wizgroup'])
+
+    def test_page_size(self):
+        qs = LdapGroup.objects.page_size(2).exclude(gid=1000)
+        self.assertEquals(qs.query.ldap_options, {'page_size': 2})
+        self.assertEquals(sorted(g.name for g in qs),
+                          ['bargroup', 'wizgroup'])
+
     def test_length_none(self):
         qs = LdapGroup.objects.none()
         self.assertEquals(len(qs), 0)
@@ -208,13 +834,13 @@ class GroupTestCase(TestCase):
         # AND filter
         qs = LdapGroup.objects.filter(gid=1000, name='foogroup')
         self.assertEquals(query_as_ldap(qs.query),
-                          '(&(objectClass=posixGroup)(&(gidNumber=1000)'
-                          '(cn=foogroup)))')
+                          '(&(objectClass=posixGroup)(gidNumber=1000)'
+                          '(cn=foogroup))')
 
         qs = LdapGroup.objects.filter(Q(gid=1000) & Q(name='foogroup'))
         self.assertEquals(query_as_ldap(qs.query),
-                          '(&(objectClass=posixGroup)(&(gidNumber=1000)'
-                          '(cn=foogroup)))')
+                          '(&(objectClass=posixGroup)(gidNumber=1000)'
+                          '(cn=foogroup))')
 
         # OR filter
         qs = LdapGroup.objects.filter(Q(gid=1000) | Q(name='foogroup'))
@@ -239,8 +865,77 @@ class GroupTestCase(TestCase):
 
         qs = LdapGroup.objects.filter(name='foogroup').exclude(gid=1000)
         self.assertEquals(query_as_ldap(qs.query),
-                          '(&(objectClass=posixGroup)(&(cn=foogroup)'
-                          '(!(gidNumber=1000))))')
+                          '(&(objectClass=posixGroup)(cn=foogroup)'
+                          '(!(gidNumber=1000)))')
+
+        # redundant terms
+        qs = LdapGroup.objects.filter(name='foogroup').filter(
+            Q(name='foogroup') | Q(name='foogroup'))
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(cn=foogroup))')
+
+        qs = LdapGroup.objects.filter(
+            Q(name__in=['foogroup', 'bargroup']) | Q(name='foogroup'))
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(|(cn=foogroup)'
+                          '(cn=bargroup)))')
+
+        # contradictions are not searched for
+        qs = LdapGroup.objects.filter(name='foogroup').exclude(
+            name='foogroup')
+        self.assertEquals(query_as_ldap(qs.query), None)
+        self.assertEquals(len(qs), 0)
+        self.assertEquals(self.ldapobj.methods_called(), [])
+
+    def test_ldap_filter_selectivity(self):
+        qs = LdapGroup.objects.filter(Q(gid=1000) & Q(name__startswith='foo'))
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(gidNumber=1000)'
+                          '(cn=foo*))')
+        self.assertEquals(query_as_ldap(qs.query, {'gidNumber': 0.5,
+                                                   'cn': 0.01}),
+                          '(&(cn=foo*)(gidNumber=1000)'
+                          '(objectClass=posixGroup))')
+
+    def test_ldap_query(self):
+        qs = LdapGroup.objects.filter(gid__gte=1001).order_by('-name')[1:3]
+        ldap_query = qs.ldap_query()
+        self.assertEquals(ldap_query.base_dn, 'ou=groups,dc=nodomain')
+        self.assertEquals(ldap_query.scope, ldap.SCOPE_SUBTREE)
+        self.assertEquals(ldap_query.filter,
+                          ('&', (('=', 'objectClass', 'posixGroup'),
+                                 ('>=', 'gidNumber', '1001'))))
+        self.assertEquals(sorted(ldap_query.attrlist),
+                          ['cn', 'gidNumber', 'memberUid'])
+        self.assertEquals(ldap_query.window, (1, 3))
+        self.assertEquals([(field.name, reverse)
+                           for field, reverse in ldap_query.ordering],
+                          [('name', True)])
+        self.assertEquals([(kind, value.name)
+                           for kind, value in ldap_query.columns],
+                          [('dn', 'dn'), ('field', 'gid'), ('field', 'name'),
+                           ('field', 'usernames')])
+        self.assertEquals(self.ldapobj.methods_called(), [])
+
+        self.assertEquals(LdapGroup.objects.none().ldap_query().filterstr,
+                          None)
+
+    def test_ldap_filter_template(self):
+        # queries of the same shape reuse the same template
+        qs = LdapGroup.objects.filter(gid=1000, name='foogroup')
+        query_as_ldap(qs.query)
+        qs = LdapGroup.objects.filter(gid=1001, name='100%s')
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(gidNumber=1001)'
+                          '(cn=100%s))')
+
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'bargroup'])
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(|(cn=foogroup)'
+                          '(cn=bargroup)))')
+        qs = LdapGroup.objects.filter(name__in=['foogroup'])
+        self.assertEquals(query_as_ldap(qs.query),
+                          '(&(objectClass=posixGroup)(cn=foogroup))')
 
     def test_filter(self):
         qs = LdapGroup.objects.filter(name='foogroup')
@@ -273,6 +968,22 @@ class GroupTestCase(TestCase):
         self.assertRaises(LdapGroup.DoesNotExist, LdapGroup.objects.get,
                           name='does_not_exist')
 
+    def test_get_by_pk(self):
+        LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('search_s', (
+                              'cn=foogroup,%s' % LdapGroup.base_dn,
+                              ldap.SCOPE_BASE,
+                              '(&(objectClass=posixGroup)(cn=foogroup))',
+                              ['gidNumber', 'cn', 'memberUid']), {}))
+
+        qs = LdapGroup.objects.filter(name__in=['foogroup', 'wizgroup'])
+        self.assertEquals(sorted(g.gid for g in qs), [1000, 1002])
+
+        # other conditions still apply
+        self.assertRaises(LdapGroup.DoesNotExist, LdapGroup.objects.get,
+                          name='foogroup', gid=1001)
+
     def test_insert(self):
         g = LdapGroup()
         g.name = 'newgroup'
@@ -290,6 +1001,47 @@ class GroupTestCase(TestCase):
         self.assertEquals(new.gid, 1010)
         self.assertEquals(new.usernames, ['someuser', 'foouser'])
 
+    def test_bulk_create(self):
+        objs = []
+        for i in range(3):
+            g = LdapGroup()
+            g.name = 'newgroup%d' % i
+            g.gid = 1010 + i
+            g.usernames = ['someuser']
+            objs.append(g)
+        LdapGroup.objects.bulk_create(objs)
+        self.assertEquals(self.ldapobj.methods_called(), [
+            'initialize',
+            'simple_bind_s',
+            'add_s',
+            'add_s',
+            'add_s'])
+        self.assertEquals(objs[0].dn, 'cn=newgroup0,%s' % LdapGroup.base_dn)
+
+        # the created objects save their changes without fetching the entry
+        calls = len(self.ldapobj.methods_called())
+        objs[1].gid = 1020
+        objs[1].save()
+        self.assertEquals(self.ldapobj.methods_called()[calls:],
+                          ['modify_s'])
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('modify_s', ('cn=newgroup1,%s' % LdapGroup.base_dn,
+                                        [(ldap.MOD_REPLACE, 'gidNumber',
+                                          ['1020'])]), {}))
+
+        # check groups were created
+        new = LdapGroup.objects.get(name='newgroup2')
+        self.assertEquals(new.gid, 1012)
+        self.assertEquals(new.usernames, ['someuser'])
+
+    def test_bulk_create_error(self):
+        g1 = LdapGroup(name='foogroup', gid=1010)
+        g2 = LdapGroup(name='newgroup', gid=1011)
+        self.assertRaises(ldap.ALREADY_EXISTS,
+                          LdapGroup.objects.bulk_create, [g1, g2])
+        self.assertEquals(g1.dn, '')
+        self.assertEquals(g2.dn, 'cn=newgroup,%s' % LdapGroup.base_dn)
+
     def test_order_by(self):
         # ascending name
         qs = LdapGroup.objects.order_by('name')
@@ -333,6 +1085,34 @@ class GroupTestCase(TestCase):
         self.assertEquals(qs[1].name, 'foogroup')
         self.assertEquals(qs[2].name, 'bargroup')
 
+    def test_order_by_without_sort_control(self):
+        # the mock server does not advertise any control
+        qs = LdapGroup.objects.order_by('-gid', 'name')
+        self.assertEquals([g.gid for g in qs], [1002, 1001, 1000])
+        self.assertFalse(
+            connections['ldap'].features.supports_server_side_sort)
+
+    def test_order_by_rejected_sort_control(self):
+        connection = connections['ldap']
+        search_iter = connection.search_iter
+
+        def rejecting_search_iter(*args, **kwargs):
+            # the server does not support the sort control after all
+            if kwargs.get('serverctrls'):
+                raise ldap.UNAVAILABLE_CRITICAL_EXTENSION(
+                    {'desc': 'Critical extension is unavailable'})
+            for entry in search_iter(*args, **kwargs):
+                yield entry
+
+        connection.features._supported_controls = set([SERVER_SIDE_SORT_OID])
+        connection.search_iter = rejecting_search_iter
+        try:
+            qs = LdapGroup.objects.order_by('-gid', 'name')
+            self.assertEquals([g.gid for g in qs], [1002, 1001, 1000])
+        finally:
+            del connection.search_iter
+            connection.features._supported_controls = None
+
     def test_bulk_delete(self):
         LdapGroup.objects.all().delete()
 
@@ -382,6 +1162,13 @@ class GroupTestCase(TestCase):
         self.assertEquals(len(objs), 1)
         self.assertEquals(objs[0].gid, 1001)
 
+    def test_slice_without_vlv(self):
+        # the mock server does not advertise any control
+        objs = list(LdapGroup.objects.order_by('-gid')[1:3])
+        self.assertEquals([g.gid for g in objs], [1001, 1000])
+        self.assertFalse(
+            connections['ldap'].features.supports_virtual_list_view)
+
     def test_update(self):
         g = LdapGroup.objects.get(name='foogroup')
         g.gid = 1002
@@ -394,6 +1181,133 @@ class GroupTestCase(TestCase):
         self.assertEquals(new.gid, 1002)
         self.assertEquals(new.usernames, ['foouser2', u'barusér2'])
 
+    def test_update_without_fetch(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        g.gid = 1010
+        g.save()
+
+        # the saved values are known, only the modification is sent
+        connections['ldap'].features.supported_controls
+        calls = len(self.ldapobj.methods_called())
+        g.usernames = ['foouser']
+        g.save()
+        self.assertEquals(self.ldapobj.methods_called()[calls:],
+                          ['modify_s'])
+
+        new = LdapGroup.objects.get(name='foogroup')
+        self.assertEquals(new.gid, 1010)
+        self.assertEquals(new.usernames, ['foouser'])
+
+    def test_update_list_delta(self):
+        # without the Permissive Modify control, the whole list is sent
+        g = LdapGroup.objects.get(name='foogroup')
+        g.usernames = ['foouser', 'baruser', 'zoouser']
+        g.save()
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('modify_s', ('cn=foogroup,%s' % LdapGroup.base_dn,
+                                        [(ldap.MOD_REPLACE, 'memberUid',
+                                          ['foouser', 'baruser',
+                                           'zoouser'])]), {}))
+
+        connection = connections['ldap']
+        connection.features._supported_controls = set([PERMISSIVE_MODIFY_OID])
+        try:
+            g.usernames = ['foouser', 'baruser', 'zoouser', 'wizuser']
+            modlist = g._build_modlist(g._saved_values, connection)
+            self.assertEquals(modlist, [(ldap.MOD_ADD, 'memberUid',
+                                         ['wizuser'])])
+            controls = g._delta_controls(modlist)
+            self.assertEquals([c.controlType for c in controls],
+                              [PERMISSIVE_MODIFY_OID])
+
+            g.usernames = ['zoouser', 'foouser']
+            modlist = g._build_modlist(g._saved_values, connection)
+            self.assertEquals(modlist, [(ldap.MOD_DELETE, 'memberUid',
+                                         ['baruser'])])
+            self.assertEquals(len(g._delta_controls(modlist)), 1)
+
+            # replacing most values sends the whole list
+            g.usernames = ['someuser']
+            modlist = g._build_modlist(g._saved_values, connection)
+            self.assertEquals(modlist, [(ldap.MOD_REPLACE, 'memberUid',
+                                         ['someuser'])])
+            self.assertEquals(g._delta_controls(modlist), [])
+        finally:
+            connection.features._supported_controls = None
+
+    def test_update_strict(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        g.strict_save = True
+        g.save()
+
+        other = LdapGroup.objects.get(name='foogroup')
+        other.gid = 1010
+        other.save()
+
+        # changes to other attributes do not conflict
+        g.usernames = ['foouser']
+        g.save()
+
+        g.gid = 1020
+        self.assertRaises(ldap.ASSERTION_FAILED, g.save)
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').gid, 1010)
+
+    def test_update_strict_assertion(self):
+        g = LdapGroup.objects.get(name='foogroup')
+        g.gid = 1010
+        g.usernames = ['foouser']
+        connection = connections['ldap']
+        connection.features._supported_controls = set([ASSERTION_OID])
+        try:
+            modlist = g._build_modlist(g._saved_values, connection)
+            controls = g._conflict_controls(modlist, connection)
+        finally:
+            connection.features._supported_controls = None
+        self.assertEquals(controls[0].controlType, ASSERTION_OID)
+        self.assertEquals(controls[0].filterstr,
+                          '(&(gidNumber=1000)'
+                          '(memberUid=foouser)(memberUid=baruser))')
+
+    def test_update_queryset(self):
+        qs = LdapGroup.objects.filter(usernames__contains='baruser')
+        count = qs.exclude(gid=1000).update(usernames=['foouser'])
+        self.assertEquals(count, 2)
+
+        qs = LdapGroup.objects.filter(usernames__contains='foouser')
+        self.assertEquals(sorted(g.name for g in qs),
+                          ['bargroup', 'foogroup', 'wizgroup'])
+        self.assertEquals(LdapGroup.objects.get(name='wizgroup').usernames,
+                          ['foouser'])
+
+    def test_update_queryset_none(self):
+        count = LdapGroup.objects.none().update(usernames=['foouser'])
+        self.assertEquals(count, 0)
+
+    def test_add_values(self):
+        count = LdapGroup.objects.exclude(gid=1000).add_values(
+            'usernames', ['newuser'])
+        self.assertEquals(count, 2)
+        self.assertEquals(self.ldapobj.methods_called()[-2:],
+                          ['modify_s', 'modify_s'])
+
+        self.assertEquals(LdapGroup.objects.get(name='bargroup').usernames,
+                          ['zoouser', 'baruser', 'newuser'])
+        self.assertEquals(LdapGroup.objects.get(name='foogroup').usernames,
+                          ['foouser', 'baruser'])
+
+    def test_remove_values(self):
+        count = LdapGroup.objects.remove_values('usernames', ['baruser'])
+        self.assertEquals(count, 3)
+
+        qs = LdapGroup.objects.filter(usernames__contains='baruser')
+        self.assertEquals(len(qs), 0)
+        self.assertEquals(LdapGroup.objects.get(name='wizgroup').usernames,
+                          ['wizuser'])
+
+        # removing no values does nothing
+        self.assertEquals(
+            LdapGroup.objects.remove_values('usernames', []), 0)
+
     def test_update_change_dn(self):
         g = LdapGroup.objects.get(name='foogroup')
         g.name = 'foogroup2'
@@ -498,6 +1412,83 @@ class UserTestCase(TestCase):
         u.save()
         self.assertEquals(u.dn, 'uid=foouser2,%s' % LdapUser.base_dn)
 
+    def test_get_duplicate_rdn(self):
+        # the RDNs of users are not declared unique, the subtree is searched
+        self.ldapobj.add_s('uid=foouser,ou=staff,ou=people,dc=nodomain',
+                           [('objectClass', foouser[1]['objectClass']),
+                            ('uid', ['foouser'])])
+        self.assertRaises(LdapUser.MultipleObjectsReturned,
+                          LdapUser.objects.get, username='foouser')
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('search_s', ('ou=people,dc=nodomain',
+                                        ldap.SCOPE_SUBTREE,
+                                        '(&(objectClass=posixAccount)'
+                                        '(objectClass=shadowAccount)'
+                                        '(objectClass=inetOrgPerson)'
+                                        '(uid=foouser))',
+                                        LdapUser.objects.all().ldap_query(
+                                        ).attrlist), {}))
+
+    def test_lazy(self):
+        u = LdapUser.objects.lazy().get(username='foouser')
+        self.assertTrue(isinstance(u, LdapUser))
+        self.assertFalse('first_name' in u.__dict__)
+        self.assertEquals(u.first_name, u'F\xf4o')
+        self.assertTrue('first_name' in u.__dict__)
+        self.assertEquals(u.date_of_birth, datetime.date(1982, 6, 12))
+        self.assertFalse('photo' in u.__dict__)
+
+        # only the changed fields are saved
+        u.first_name = u'F\xf4o2'
+        u.login_shell = ''
+        u.save()
+        self.assertEquals(self.ldapobj.methods_called(with_args=True)[-1],
+                          ('modify_s', ('uid=foouser,ou=people,dc=nodomain',
+                                        [(ldap.MOD_REPLACE, 'givenName',
+                                          ['F\xc3\xb4o2']),
+                                         (ldap.MOD_DELETE, 'loginShell',
+                                          None)]), {}))
+        u = LdapUser.objects.get(username='foouser')
+        self.assertEquals(u.first_name, u'F\xf4o2')
+        self.assertEquals(u.login_shell, '')
+
+    def test_lazy_signals(self):
+        senders = []
+
+        def receiver(sender, instance, **kwargs):
+            senders.append(sender)
+
+        signals.pre_save.connect(receiver, sender=LdapUser)
+        signals.post_save.connect(receiver, sender=LdapUser)
+        signals.post_delete.connect(receiver, sender=LdapUser)
+        try:
+            u = LdapUser.objects.lazy().get(username='foouser')
+            u.first_name = u'F\xf4o2'
+            u.save()
+            u.delete()
+        finally:
+            signals.pre_save.disconnect(receiver, sender=LdapUser)
+            signals.post_save.disconnect(receiver, sender=LdapUser)
+            signals.post_delete.disconnect(receiver, sender=LdapUser)
+        self.assertEquals(senders, [LdapUser, LdapUser, LdapUser])
+
+    def test_lazy_pickle(self):
+        u = LdapUser.objects.lazy().get(username='foouser')
+        u = pickle.loads(pickle.dumps(u))
+        self.assertEquals(type(u), type(LdapUser.objects.lazy().get(
+            username='foouser')))
+        self.assertFalse('first_name' in u.__dict__)
+        self.assertEquals(u.first_name, u'F\xf4o')
+        self.assertEquals(u.date_of_birth, datetime.date(1982, 6, 12))
+
+        # the fields decoded before pickling are kept
+        u = pickle.loads(pickle.dumps(u))
+        self.assertTrue('first_name' in u.__dict__)
+        u.first_name = u'F\xf4o2'
+        u.save()
+        self.assertEquals(LdapUser.objects.get(username='foouser').first_name,
+                          u'F\xf4o2')
+
 
 class ScopedTestCase(TestCase):
     directory = dict([admin, groups, people, foogroup, contacts])
@@ -613,7 +1604,7 @@ class AdminTestCase(TestCase):
         self.ldapobj.search_s.seed(
             "ou=groups,dc=nodomain", 2,
             "(&(objectClass=posixGroup)(cn=*foo*))",
-            ['dn'])([foogroup])
+            ['1.1'])([foogroup])
         self.ldapobj.search_s.seed(
             "ou=groups,dc=nodomain", 2,
             "(&(objectClass=posixGroup)(cn=*foo*))",
@@ -32,11 +32,17 @@
 
 from django.conf import settings
 import ldap.filter
+import re
 
 
 def escape_ldap_filter(value):
     return ldap.filter.escape_filter_chars(value)
 
+
+def unescape_ldap_filter(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})',
+                  lambda m: chr(int(m.group(1), 16)), value)
+
 # Legacy single database support
 if hasattr(settings, 'LDAPDB_SERVER_URI'):
     from django import db
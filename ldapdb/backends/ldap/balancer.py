@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import bisect
+import threading
+import time
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of latencies using exponentially growing buckets, from 1ms
+    to about 30s. Older samples are progressively forgotten.
+    """
+    bounds = [0.001 * 2 ** i for i in range(16)]
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.counts = [0.0] * len(self.bounds)
+        self.total = 0.0
+
+    def add(self, latency):
+        index = min(bisect.bisect_left(self.bounds, latency),
+                    len(self.bounds) - 1)
+        self.counts[index] += 1
+        self.total += 1
+        if self.total >= self.max_samples:
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket containing the given
+        percentile.
+        """
+        threshold = self.total * percent / 100.0
+        cumulative = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return bound
+        return self.bounds[-1]
+
+
+class ServerStats(object):
+    """
+    Latency and error statistics for a single server.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.failed_at = None
+        self.histogram = LatencyHistogram()
+
+
+class Balancer(object):
+    """
+    Ranks a set of servers for read operations, preferring the healthy
+    servers with the lowest latency.
+
+    Latency and error rate are tracked as exponentially weighted moving
+    averages with smoothing factor `alpha`. A server whose error rate
+    exceeds `max_error_rate` is avoided for `retry_delay` seconds after its
+    last failure.
+    """
+
+    def __init__(self, uris, alpha=0.2, max_error_rate=0.5, retry_delay=30,
+                 min_samples=20):
+        self.uris = list(uris)
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.retry_delay = retry_delay
+        self.min_samples = min_samples
+
+        self._lock = threading.Lock()
+        self._stats = dict((uri, ServerStats()) for uri in self.uris)
+
+    def record_success(self, uri, latency):
+        with self._lock:
+            stats = self._stats[uri]
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.alpha * (latency - stats.latency)
+            stats.error_rate -= self.alpha * stats.error_rate
+            stats.histogram.add(latency)
+
+    def record_error(self, uri):
+        with self._lock:
+            stats = self._stats[uri]
+            stats.error_rate += self.alpha * (1.0 - stats.error_rate)
+            stats.failed_at = time.time()
+
+    def hedge_delay(self, uri, percent):
+        """
+        Returns how long to wait for the server before hedging a request,
+        or None if there are not enough samples to tell.
+        """
+        with self._lock:
+            histogram = self._stats[uri].histogram
+            if histogram.total < self.min_samples:
+                return None
+            return histogram.percentile(percent)
+
+    def is_healthy(self, uri):
+        stats = self._stats[uri]
+        return (stats.error_rate < self.max_error_rate or
+                time.time() - stats.failed_at >= self.retry_delay)
+
+    def ranked(self):
+        """
+        Returns the servers, best first.
+        """
+        with self._lock:
+            healthy = [uri for uri in self.uris if self.is_healthy(uri)]
+            unhealthy = [uri for uri in self.uris if uri not in healthy]
+            # servers we know nothing about yet are tried first
+            healthy.sort(key=lambda uri: self._stats[uri].latency or 0)
+            unhealthy.sort(key=lambda uri: self._stats[uri].failed_at)
+        return healthy + unhealthy
+
+
+_balancers = {}
+_balancers_lock = threading.Lock()
+
+
+def get_balancer(key, factory):
+    """
+    Returns the process-wide balancer registered under `key`, creating it
+    with `factory` on first use.
+    """
+    with _balancers_lock:
+        balancer = _balancers.get(key)
+        if balancer is None:
+            balancer = _balancers[key] = factory()
+        return balancer
@@ -30,7 +30,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import contextlib
+import select
+import time
+
 import ldap
+import ldap.controls
+import ldap.ldapobject
 import django
 
 if django.VERSION < (1, 8):
@@ -43,6 +49,15 @@ else:
     from django.db.backends.base.base import BaseDatabaseWrapper
     from django.db.backends.base.creation import BaseDatabaseCreation
 
+from ldapdb.backends.ldap.balancer import Balancer, get_balancer
+from ldapdb.backends.ldap.cache import (DjangoStorage, LocalStorage,
+                                        QueryCache, get_query_cache)
+from ldapdb.backends.ldap.mirror import (Mirror, SyncreplConsumer,
+                                         SyncreplMirror, get_mirror,
+                                         wake_mirrors)
+from ldapdb.backends.ldap.poller import Poller, get_poller, submit_async
+from ldapdb.backends.ldap.pool import ConnectionPool, get_pool
+
 class DatabaseCreation(BaseDatabaseCreation):
     def create_test_db(self, *args, **kwargs):
         """
@@ -64,10 +79,63 @@ class DatabaseCursor(object):
         self.connection = ldap_connection
 
 
+SERVER_SIDE_SORT_OID = '1.2.840.113556.1.4.473'
+VIRTUAL_LIST_VIEW_OID = '2.16.840.1.113730.3.4.9'
+TREE_DELETE_OID = '1.2.840.113556.1.4.805'
+PERMISSIVE_MODIFY_OID = '1.2.840.113556.1.4.1413'
+CONTENT_SYNC_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+ASSERTION_OID = '1.3.6.1.1.12'
+
+
 class DatabaseFeatures(BaseDatabaseFeatures):
     def __init__(self, connection):
         self.connection = connection
         self.supports_transactions = False
+        self._supported_controls = None
+
+    @property
+    def supported_controls(self):
+        """
+        The OIDs of the controls advertised in the server's root DSE.
+        """
+        if self._supported_controls is None:
+            controls = set()
+            if hasattr(ldap.ldapobject.SimpleLDAPObject, 'result3'):
+                # controls can only be sent with python-ldap >= 2.4
+                try:
+                    results = self.connection.search_s(
+                        '', ldap.SCOPE_BASE, attrlist=['supportedControl'])
+                except (ldap.NO_SUCH_OBJECT, ldap.INSUFFICIENT_ACCESS):
+                    results = []
+                for dn, attrs in results:
+                    controls.update(attrs.get('supportedControl', []))
+            self._supported_controls = controls
+        return self._supported_controls
+
+    @property
+    def supports_server_side_sort(self):
+        return SERVER_SIDE_SORT_OID in self.supported_controls
+
+    @property
+    def supports_virtual_list_view(self):
+        return (self.supports_server_side_sort and
+                VIRTUAL_LIST_VIEW_OID in self.supported_controls)
+
+    @property
+    def supports_tree_delete(self):
+        return TREE_DELETE_OID in self.supported_controls
+
+    @property
+    def supports_permissive_modify(self):
+        return PERMISSIVE_MODIFY_OID in self.supported_controls
+
+    @property
+    def supports_content_sync(self):
+        return CONTENT_SYNC_OID in self.supported_controls
+
+    @property
+    def supports_assertion(self):
+        return ASSERTION_OID in self.supported_controls
 
 
 class DatabaseOperations(BaseDatabaseOperations):
@@ -113,6 +181,8 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             self.ops = DatabaseOperations()
         self.settings_dict['SUPPORTS_TRANSACTIONS'] = True
         self.autocommit = True
+        self.read_connections = {}
+        self.last_write = None
 
     def close(self):
         if hasattr(self, 'validate_thread_sharing'):
@@ -121,21 +191,243 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         if self.connection is not None:
             self.connection.unbind_s()
             self.connection = None
+        for connection in self.read_connections.values():
+            connection.unbind_s()
+        self.read_connections = {}
 
     def ensure_connection(self):
         if self.connection is None:
-            self.connection = ldap.initialize(self.settings_dict['NAME'])
+            self.connection = self._connect()
 
-            options = self.settings_dict.get('CONNECTION_OPTIONS', {})
-            for opt, value in options.items():
-                self.connection.set_option(opt, value)
+    def _connect(self, uri=None):
+        """
+        Opens and binds a new connection to the LDAP server at `uri`, by
+        default the one given by the NAME setting.
+        """
+        connection = ldap.initialize(uri or self.settings_dict['NAME'])
 
-            if self.settings_dict.get('TLS', False):
-                self.connection.start_tls_s()
+        options = self.settings_dict.get('CONNECTION_OPTIONS', {})
+        for opt, value in options.items():
+            connection.set_option(opt, value)
 
-            self.connection.simple_bind_s(
-                self.settings_dict['USER'],
-                self.settings_dict['PASSWORD'])
+        if self.settings_dict.get('TLS', False):
+            connection.start_tls_s()
+
+        connection.simple_bind_s(
+            self.settings_dict['USER'],
+            self.settings_dict['PASSWORD'])
+        return connection
+
+    def _get_pool(self, uri):
+        """
+        Returns the process-wide connection pool for the server at `uri`,
+        or None if pooling is not enabled.
+        """
+        options = self.settings_dict.get('POOL')
+        if not options:
+            return None
+
+        def factory():
+            return ConnectionPool(
+                lambda: self._connect(uri),
+                min_size=options.get('MIN_SIZE', 0),
+                max_size=options.get('MAX_SIZE', 10),
+                idle_timeout=options.get('IDLE_TIMEOUT'),
+                max_lifetime=options.get('MAX_LIFETIME'),
+                health_check_interval=options.get('HEALTH_CHECK_INTERVAL'),
+                timeout=options.get('TIMEOUT'))
+        return get_pool((self.alias, uri), factory)
+
+    def _get_balancer(self):
+        """
+        Returns the process-wide balancer for the read replicas, or None if
+        there are no replicas.
+        """
+        replicas = self.settings_dict.get('REPLICAS')
+        if not replicas:
+            return None
+        return get_balancer((self.alias, tuple(replicas)),
+                            lambda: Balancer(replicas))
+
+    def _get_query_cache(self):
+        """
+        Returns the process-wide cache of search results, or None if caching
+        is not enabled.
+        """
+        options = self.settings_dict.get('QUERY_CACHE')
+        if not options:
+            return None
+
+        def factory():
+            if options.get('CACHE'):
+                storage = DjangoStorage(options['CACHE'])
+            else:
+                storage = LocalStorage(
+                    max_entries=options.get('MAX_ENTRIES', 1000))
+            return QueryCache(storage, timeout=options.get('TIMEOUT', 60),
+                              stale_timeout=options.get('STALE_TIMEOUT', 0))
+        return get_query_cache(self.alias, factory)
+
+    def _invalidate(self, dns, structural=False):
+        """
+        Drops the cached results which writes to the entries at `dns` can
+        affect, and signals the writes to the local mirrors.
+        """
+        dns = [dn.encode(self.charset) for dn in dns]
+        cache = self._get_query_cache()
+        if cache is not None:
+            cache.invalidate(dns, structural)
+        if self.settings_dict.get('LOCAL_MIRROR') is not None and dns:
+            wake_mirrors(self.alias, dns)
+
+    def get_mirror(self, model):
+        """
+        Returns the process-wide local copy of the entries of `model`, or
+        None if the model is not mirrored.
+        """
+        options = self.settings_dict.get('LOCAL_MIRROR')
+        if options is None or not getattr(model, 'local_mirror', False):
+            return None
+
+        def factory():
+            filterstr = '(&%s)' % model._object_class_filter
+            attrlist = ['objectClass'] + [field.db_column for field
+                                          in model._meta.fields
+                                          if field.db_column]
+            matching_rules = {'objectClass': 'objectIdentifierMatch'}
+            for field in model._meta.fields:
+                equality_rule = getattr(field, 'equality_rule', None)
+                if field.db_column and equality_rule:
+                    matching_rules[field.db_column] = equality_rule
+            mirror_class = Mirror
+            if options.get('SYNCREPL', True) and \
+                    SyncreplConsumer is not None and \
+                    self.features.supports_content_sync:
+                mirror_class = SyncreplMirror
+            mirror = mirror_class(
+                self._connect, model.base_dn.encode(self.charset),
+                model.search_scope, filterstr.encode(self.charset), attrlist,
+                interval=options.get('INTERVAL', 30),
+                max_lag=options.get('MAX_LAG', 60),
+                timestamp_attr=options.get('TIMESTAMP_ATTRIBUTE',
+                                           'modifyTimestamp'),
+                charset=self.charset, matching_rules=matching_rules)
+            mirror.start()
+            return mirror
+        return get_mirror((self.alias, model._meta.app_label,
+                           model._meta.object_name), factory)
+
+    def _get_poller(self, uri):
+        """
+        Returns the process-wide poller for asynchronous operations on the
+        server at `uri`.
+        """
+        def factory():
+            return Poller(
+                lambda: self._connect(uri),
+                max_connections=self.settings_dict.get('ASYNC_CONNECTIONS',
+                                                       2))
+        return get_poller((self.alias, uri), factory)
+
+    def get_read_uris(self):
+        """
+        Returns the URIs of the servers to try for a read, best first.
+        """
+        provider = self.settings_dict['NAME']
+        balancer = self._get_balancer()
+        if balancer is None:
+            return [provider]
+
+        # read our own writes
+        if self.wrote_recently():
+            return [provider]
+        return balancer.ranked() + [provider]
+
+    def wrote_recently(self):
+        """
+        Returns whether this connection wrote to the provider less than
+        READ_AFTER_WRITE_WINDOW seconds ago, in which case copies of the
+        entries may not reflect the writes yet.
+        """
+        window = self.settings_dict.get('READ_AFTER_WRITE_WINDOW', 5)
+        return (self.last_write is not None and
+                time.time() - self.last_write < window)
+
+    def _record_success(self, uri, started):
+        balancer = self._get_balancer()
+        if balancer is not None and uri in balancer.uris:
+            balancer.record_success(uri, time.time() - started)
+
+    def _record_error(self, uri):
+        balancer = self._get_balancer()
+        if balancer is not None and uri in balancer.uris:
+            balancer.record_error(uri)
+
+    def _acquire(self, uri):
+        """
+        Returns a bound connection to the server at `uri`, to be handed back
+        with _release() once the operation is done.
+        """
+        pool = self._get_pool(uri)
+        if pool is not None:
+            return pool.acquire()
+        elif uri == self.settings_dict['NAME']:
+            return self._cursor().connection
+
+        connection = self.read_connections.get(uri)
+        if connection is None:
+            connection = self._connect(uri)
+            self.read_connections[uri] = connection
+        return connection
+
+    def _release(self, uri, connection, reusable=True):
+        """
+        Hands back a connection obtained with _acquire(), which is closed
+        unless it is `reusable`.
+        """
+        pool = self._get_pool(uri)
+        if pool is not None:
+            if reusable:
+                pool.release(connection)
+            else:
+                pool.discard(connection)
+        elif not reusable:
+            # reconnect on the next operation
+            if uri == self.settings_dict['NAME']:
+                self.connection = None
+            else:
+                self.read_connections.pop(uri, None)
+
+    @contextlib.contextmanager
+    def _checkout(self, uri=None):
+        """
+        Provides a bound connection to the server at `uri`, by default the
+        provider, for the duration of one operation.
+        """
+        uri = uri or self.settings_dict['NAME']
+        connection = self._acquire(uri)
+        reusable = True
+        try:
+            yield connection
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+            reusable = False
+            raise
+        finally:
+            self._release(uri, connection, reusable)
+
+    @contextlib.contextmanager
+    def _write_connection(self, dn=None, structural=False):
+        """
+        Provides a bound connection to the provider for one write operation,
+        on the entry at `dn` if given.
+        """
+        try:
+            with self._checkout() as connection:
+                yield connection
+            self.last_write = time.time()
+        finally:
+            if dn is not None:
+                self._invalidate([dn], structural)
 
     def _commit(self):
         pass
@@ -151,31 +443,587 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         pass
 
     def add_s(self, dn, modlist):
-        cursor = self._cursor()
-        return cursor.connection.add_s(dn.encode(self.charset), modlist)
+        with self._write_connection(dn) as connection:
+            return connection.add_s(dn.encode(self.charset), modlist)
 
     def delete_s(self, dn):
-        cursor = self._cursor()
-        return cursor.connection.delete_s(dn.encode(self.charset))
+        with self._write_connection(dn, structural=True) as connection:
+            return connection.delete_s(dn.encode(self.charset))
 
-    def modify_s(self, dn, modlist):
-        cursor = self._cursor()
-        return cursor.connection.modify_s(dn.encode(self.charset), modlist)
+    def modify_s(self, dn, modlist, serverctrls=None):
+        with self._write_connection(dn) as connection:
+            if serverctrls:
+                return connection.modify_ext_s(dn.encode(self.charset),
+                                               modlist,
+                                               serverctrls=serverctrls)
+            return connection.modify_s(dn.encode(self.charset), modlist)
 
     def rename_s(self, dn, newrdn):
-        cursor = self._cursor()
-        return cursor.connection.rename_s(dn.encode(self.charset),
-                                          newrdn.encode(self.charset))
+        # the new DN has the same superiors as the old one
+        with self._write_connection(dn, structural=True) as connection:
+            return connection.rename_s(dn.encode(self.charset),
+                                       newrdn.encode(self.charset))
 
-    def search_s(self, base, scope, filterstr='(objectClass=*)',
-                 attrlist=None):
-        cursor = self._cursor()
-        results = cursor.connection.search_s(base, scope,
-                                             filterstr.encode(self.charset),
-                                             attrlist)
+    @contextlib.contextmanager
+    def _write_connections(self, count):
+        """
+        Provides up to `count` bound connections to the provider. Only the
+        first one is waited for, and more than one is only provided if
+        pooling is enabled and the pool has connections to spare.
+        """
+        uri = self.settings_dict['NAME']
+        pool = self._get_pool(uri)
+        connections = []
+        reusable = True
+        try:
+            connections.append(self._acquire(uri))
+            if pool is not None:
+                # waiting for more connections while holding some could
+                # deadlock against other threads doing the same
+                for i in range(min(count, pool.max_size) - 1):
+                    connection = pool.acquire(block=False)
+                    if connection is None:
+                        break
+                    connections.append(connection)
+            yield connections
+            self.last_write = time.time()
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+            reusable = False
+            raise
+        finally:
+            for connection in connections:
+                self._release(uri, connection, reusable)
+
+    def pipeline(self, operations, window=None, serverctrls=None):
+        """
+        Performs the write operations given as (method, dn, args) tuples,
+        for instance ('modify', dn, (modlist,)), without waiting for each
+        response before sending the next request.
+
+        Up to `window` (by default PIPELINE_WINDOW) requests are kept in
+        flight on each connection. If pooling is enabled, the operations
+        are spread over PIPELINE_CONNECTIONS connections.
+
+        Returns a list holding, for each operation, None if it succeeded or
+        the LDAPError it failed with. Connection failures are raised.
+        """
+        operations = list(operations)
+        results = [None] * len(operations)
+        if not operations:
+            return results
+        try:
+            return self._pipeline(operations, results, window, serverctrls)
+        finally:
+            self._invalidate([dn for method, dn, args in operations
+                              if method != 'delete'])
+            self._invalidate([dn for method, dn, args in operations
+                              if method == 'delete'], structural=True)
+
+    def _pipeline(self, operations, results, window, serverctrls):
+        window = window or self.settings_dict.get('PIPELINE_WINDOW', 64)
+        count = 1
+        if self._get_pool(self.settings_dict['NAME']) is not None:
+            count = min(self.settings_dict.get('PIPELINE_CONNECTIONS', 1),
+                        len(operations))
+
+        with self._write_connections(count) as connections:
+            if not hasattr(connections[0], 'result3'):
+                # python-ldap < 2.4, perform the operations one at a time
+                for index, (method, dn, args) in enumerate(operations):
+                    try:
+                        getattr(connections[0], method + '_s')(
+                            dn.encode(self.charset), *args)
+                    except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                        raise
+                    except ldap.LDAPError as e:
+                        results[index] = e
+                return results
+
+            todo = iter(enumerate(operations))
+            # connection -> {msgid: index}
+            pending = [(connection, {}) for connection in connections]
+            exhausted = False
+            while True:
+                for connection, inflight in pending:
+                    while not exhausted and len(inflight) < window:
+                        try:
+                            index, (method, dn, args) = next(todo)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        try:
+                            msgid = getattr(connection, method + '_ext')(
+                                dn.encode(self.charset), *args,
+                                serverctrls=serverctrls)
+                        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                            raise
+                        except ldap.LDAPError as e:
+                            results[index] = e
+                        else:
+                            inflight[msgid] = index
+
+                busy = [(c, inflight) for c, inflight in pending if inflight]
+                if not busy:
+                    return results
+                received = 0
+                for connection, inflight in busy:
+                    received += self._collect(connection, inflight, results)
+                if received:
+                    continue
+                if len(busy) == 1:
+                    connection, inflight = busy[0]
+                    self._collect(connection, inflight, results, block=True)
+                else:
+                    # responses may already have been read by libldap, so
+                    # do not wait forever on the sockets
+                    select.select([c.fileno() for c, inflight in busy],
+                                  [], [], 0.05)
+
+    def _collect(self, connection, inflight, results, block=False):
+        """
+        Stores the results of the requests in flight on `connection` which
+        have received a response, waiting for the oldest one if `block` is
+        set. Returns the number of responses received.
+        """
+        received = 0
+        for msgid in sorted(inflight):
+            timeout = block and not received and -1 or 0
+            try:
+                rtype = connection.result3(msgid, 1, timeout)[0]
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                raise
+            except ldap.LDAPError as e:
+                results[inflight[msgid]] = e
+            else:
+                if rtype is None:
+                    # no response yet
+                    if block:
+                        break
+                    continue
+            del inflight[msgid]
+            received += 1
+        return received
+
+    def add(self, dn, modlist):
+        """
+        Asynchronous version of add_s, returning a future which must be
+        awaited from the current event loop.
+        """
+        self.last_write = time.time()
+        return submit_async(self._get_poller(self.settings_dict['NAME']),
+                            'add_ext', (dn.encode(self.charset), modlist),
+                            transform=self._invalidator(dn))
+
+    def delete(self, dn):
+        """
+        Asynchronous version of delete_s.
+        """
+        self.last_write = time.time()
+        return submit_async(self._get_poller(self.settings_dict['NAME']),
+                            'delete_ext', (dn.encode(self.charset),),
+                            transform=self._invalidator(dn, structural=True))
+
+    def modify(self, dn, modlist, serverctrls=None):
+        """
+        Asynchronous version of modify_s.
+        """
+        self.last_write = time.time()
+        return submit_async(self._get_poller(self.settings_dict['NAME']),
+                            'modify_ext', (dn.encode(self.charset), modlist,
+                                           serverctrls),
+                            transform=self._invalidator(dn))
+
+    def rename(self, dn, newrdn):
+        """
+        Asynchronous version of rename_s.
+        """
+        self.last_write = time.time()
+        return submit_async(self._get_poller(self.settings_dict['NAME']),
+                            'rename', (dn.encode(self.charset),
+                                       newrdn.encode(self.charset)),
+                            transform=self._invalidator(dn, structural=True))
+
+    def _invalidator(self, dn, structural=False):
+        """
+        Returns a function invalidating the cached results affected by a
+        write to `dn`, to be applied to its result.
+        """
+        def invalidate(result):
+            self._invalidate([dn], structural)
+            return result
+        return invalidate
+
+    def search(self, base, scope, filterstr='(objectClass=*)',
+               attrlist=None):
+        """
+        Asynchronous version of search_s.
+        """
+        def decode(result):
+            return self._decode_entries(result[0])
+
+        return submit_async(self._get_poller(self.get_read_uris()[0]),
+                            'search_ext', (base, scope,
+                                           filterstr.encode(self.charset),
+                                           attrlist),
+                            transform=decode)
+
+    def search_page(self, base, scope, filterstr, attrlist, page_size,
+                    cookie=''):
+        """
+        Asynchronously searches for the page of at most `page_size` entries
+        which starts at `cookie`, using the Simple Paged Results control.
+
+        Returns a future resolving to the entries and to the cookie of the
+        next page, which is empty after the last page.
+        """
+        page_control = ldap.controls.SimplePagedResultsControl(
+            True, size=page_size, cookie=cookie)
+
+        def decode(result):
+            entries, controls = result
+            cookie = ''
+            for control in controls:
+                if control.controlType == page_control.controlType:
+                    cookie = control.cookie
+            return self._decode_entries(entries), cookie
+
+        return submit_async(self._get_poller(self.get_read_uris()[0]),
+                            'search_ext', (base, scope,
+                                           filterstr.encode(self.charset),
+                                           attrlist, 0, [page_control]),
+                            transform=decode)
+
+    def _decode_entries(self, results):
         output = []
         for dn, attrs in results:
             # skip referrals
             if dn is not None:
                 output.append((dn.decode(self.charset), attrs))
         return output
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, page_size=None, serverctrls=None):
+        return list(self.search_iter(base, scope, filterstr, attrlist,
+                                     page_size=page_size,
+                                     serverctrls=serverctrls))
+
+    def read_s(self, dn, attrlist=None):
+        """
+        Returns the attributes of the entry at `dn`, as currently stored on
+        the provider, raising NO_SUCH_OBJECT if it does not exist.
+        """
+        with self._checkout() as connection:
+            results = connection.search_s(dn.encode(self.charset),
+                                          ldap.SCOPE_BASE,
+                                          '(objectClass=*)', attrlist)
+        return results[0][1]
+
+    def search_with_controls(self, base, scope, filterstr='(objectClass=*)',
+                             attrlist=None, serverctrls=None):
+        """
+        Performs a search with the given request controls and returns the
+        matching entries along with the response controls.
+
+        This requires python-ldap >= 2.4.
+        """
+        uris = self.get_read_uris()
+        for uri in uris:
+            started = time.time()
+            try:
+                with self._checkout(uri) as connection:
+                    msgid = connection.search_ext(
+                        base, scope, filterstr.encode(self.charset),
+                        attrlist, serverctrls=serverctrls)
+                    rtype, rdata, rmsgid, rctrls = connection.result3(msgid)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                self._record_error(uri)
+                if uri == uris[-1]:
+                    raise
+            else:
+                self._record_success(uri, started)
+                break
+
+        output = []
+        for dn, attrs in rdata:
+            # skip referrals
+            if dn is not None:
+                output.append((dn.decode(self.charset), attrs))
+        return output, rctrls
+
+    def search_iter(self, base, scope, filterstr='(objectClass=*)',
+                    attrlist=None, page_size=None, serverctrls=None,
+                    sizelimit=0):
+        """
+        Yields the matching entries as the server returns them, instead of
+        waiting for the complete result set.
+
+        If `page_size` (or the PAGE_SIZE database setting) is set, the
+        search is split into pages using the Simple Paged Results control
+        (RFC 2696). Additional request controls can be passed in
+        `serverctrls`, they are ignored with python-ldap < 2.4, as is
+        `sizelimit`.
+
+        If read replicas are configured, the search is sent to the fastest
+        healthy one, and retried on the next one if it cannot be reached.
+
+        If the QUERY_CACHE setting is enabled, the results of searches
+        which are not split into pages are cached.
+        """
+        if page_size is None:
+            page_size = self.settings_dict.get('PAGE_SIZE')
+
+        cache = self._get_query_cache()
+        if cache is None or page_size:
+            # paged searches are meant to be too large to be held in memory
+            return self._search_uris(base, scope, filterstr, attrlist,
+                                     page_size, serverctrls, sizelimit)
+
+        def fetch():
+            return list(self._search_uris(base, scope, filterstr, attrlist,
+                                          page_size, serverctrls, sizelimit))
+
+        def refresh():
+            # use a dedicated connection, from a background thread
+            connection = self._connect(self.get_read_uris()[0])
+            try:
+                return list(self._search_iter(connection, base, scope,
+                                              filterstr, attrlist, page_size,
+                                              serverctrls, sizelimit))
+            finally:
+                connection.unbind_s()
+
+        if isinstance(base, unicode):
+            base = base.encode(self.charset)
+        # controls such as Server Side Sort change the results
+        controls = tuple((control.controlType, control.criticality,
+                          control.encodeControlValue())
+                         for control in serverctrls or ())
+        search = (base, scope, filterstr, tuple(attrlist or ()), sizelimit,
+                  controls)
+        return iter(cache.search(base, search, fetch, refresh))
+
+    def _search_uris(self, base, scope, filterstr, attrlist, page_size,
+                     serverctrls, sizelimit):
+        """
+        Yields the entries of a search sent to the read servers, in order of
+        preference.
+        """
+        uris = self.get_read_uris()
+        hedge_percentile = self.settings_dict.get('HEDGE_PERCENTILE')
+        for index, uri in enumerate(uris):
+            started = time.time()
+            received = False
+            hedged = False
+            # the URIs of the servers whose connection failed
+            failed = set()
+            connection = None
+            try:
+                connection = self._acquire(uri)
+                delay = None
+                if hedge_percentile and index + 1 < len(uris):
+                    delay = self._get_hedge_delay(uri, hedge_percentile)
+                hedged = (delay is not None and
+                          hasattr(connection, 'result3'))
+                if hedged:
+                    # errors and latencies are recorded by the hedged search
+                    entries = self._hedged_search_iter(
+                        connection, uri, uris[index + 1], delay, failed,
+                        base, scope, filterstr, attrlist, page_size,
+                        serverctrls, sizelimit)
+                else:
+                    entries = self._search_iter(
+                        connection, base, scope, filterstr, attrlist,
+                        page_size, serverctrls, sizelimit)
+                for entry in entries:
+                    if not received:
+                        received = True
+                        if not hedged:
+                            self._record_success(uri, started)
+                    yield entry
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                if not hedged:
+                    failed.add(uri)
+                    self._record_error(uri)
+                if received or uri == uris[-1]:
+                    raise
+            else:
+                if not received and not hedged:
+                    self._record_success(uri, started)
+                return
+            finally:
+                if connection is not None:
+                    self._release(uri, connection, uri not in failed)
+
+    def _get_hedge_delay(self, uri, percentile):
+        balancer = self._get_balancer()
+        if balancer is None or uri not in balancer.uris:
+            return None
+        return balancer.hedge_delay(uri, percentile)
+
+    def _search_controls(self, page_size, serverctrls):
+        """
+        Returns the request controls for a search, along with the paged
+        results control if `page_size` is set.
+        """
+        serverctrls = list(serverctrls or [])
+        page_control = None
+        if page_size:
+            page_control = ldap.controls.SimplePagedResultsControl(
+                True, size=page_size, cookie='')
+            serverctrls.append(page_control)
+        return serverctrls, page_control
+
+    def _search_iter(self, connection, base, scope, filterstr, attrlist,
+                     page_size, serverctrls, sizelimit=0, msgid=None,
+                     response=None):
+        """
+        Yields the entries of a search performed on `connection`.
+
+        If the search was already sent, `msgid` is its message id and
+        `response` the first response received, if any.
+        """
+        if not hasattr(connection, 'result3'):
+            # python-ldap < 2.4
+            results = connection.search_s(base, scope,
+                                          filterstr.encode(self.charset),
+                                          attrlist)
+            for dn, attrs in results:
+                # skip referrals
+                if dn is not None:
+                    yield dn.decode(self.charset), attrs
+            return
+
+        serverctrls, page_control = self._search_controls(page_size,
+                                                          serverctrls)
+        while True:
+            if msgid is None:
+                msgid = connection.search_ext(base, scope,
+                                              filterstr.encode(self.charset),
+                                              attrlist,
+                                              serverctrls=serverctrls,
+                                              sizelimit=sizelimit)
+            done = False
+            try:
+                while not done:
+                    if response is not None:
+                        rtype, rdata, rmsgid, rctrls = response
+                        response = None
+                    else:
+                        rtype, rdata, rmsgid, rctrls = connection.result3(
+                            msgid, all=0)
+                    done = (rtype == ldap.RES_SEARCH_RESULT)
+                    for dn, attrs in rdata:
+                        # skip referrals
+                        if dn is not None:
+                            yield dn.decode(self.charset), attrs
+            finally:
+                if not done:
+                    # the caller stopped iterating early
+                    connection.abandon(msgid)
+
+            # request the next page, if any
+            cookie = None
+            if page_control is not None:
+                for control in rctrls:
+                    if control.controlType == page_control.controlType:
+                        cookie = control.cookie
+            if not cookie:
+                break
+            page_control.cookie = cookie
+            msgid = None
+
+    def _hedged_search_iter(self, connection, uri, hedge_uri, delay, failed,
+                            base, scope, filterstr, attrlist, page_size,
+                            serverctrls, sizelimit=0):
+        """
+        Yields the entries of a search sent to the server at `uri`.
+
+        If the server has not responded after `delay` seconds, the search is
+        also sent to `hedge_uri`. Entries are then read from whichever
+        server responds first, and the other search is abandoned. The
+        errors of each server are recorded, and the URIs of the servers
+        whose connection failed are added to `failed`.
+        """
+        def fail(failed_uri):
+            if failed_uri not in failed:
+                failed.add(failed_uri)
+                self._record_error(failed_uri)
+
+        controls = self._search_controls(page_size, serverctrls)[0]
+        started = time.time()
+        current = uri
+        try:
+            msgid = connection.search_ext(base, scope,
+                                          filterstr.encode(self.charset),
+                                          attrlist, serverctrls=controls,
+                                          sizelimit=sizelimit)
+            try:
+                response = connection.result3(msgid, all=0, timeout=delay)
+            except ldap.TIMEOUT:
+                response = None
+            if response is not None:
+                self._record_success(uri, started)
+                for entry in self._search_iter(connection, base, scope,
+                                               filterstr, attrlist,
+                                               page_size, serverctrls,
+                                               sizelimit, msgid=msgid,
+                                               response=response):
+                    yield entry
+                return
+
+            # the server is slow, ask another one
+            candidates = [(uri, connection, msgid, started)]
+            hedge_connection = None
+            try:
+                hedge_connection = self._acquire(hedge_uri)
+                hedge_started = time.time()
+                hedge_msgid = hedge_connection.search_ext(
+                    base, scope, filterstr.encode(self.charset), attrlist,
+                    serverctrls=controls, sizelimit=sizelimit)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                # keep waiting for the first server
+                fail(hedge_uri)
+            else:
+                candidates.append((hedge_uri, hedge_connection, hedge_msgid,
+                                   hedge_started))
+
+            try:
+                winner = None
+                while winner is None:
+                    select.select([c[1].fileno() for c in candidates], [], [],
+                                  0.05)
+                    for candidate in candidates:
+                        try:
+                            response = candidate[1].result3(
+                                candidate[2], all=0, timeout=0)
+                        except ldap.TIMEOUT:
+                            continue
+                        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                            # keep waiting for the other server
+                            fail(candidate[0])
+                            candidates.remove(candidate)
+                            if not candidates:
+                                raise
+                            break
+                        if response[0] is not None:
+                            winner = candidate
+                            break
+
+                for candidate in candidates:
+                    if candidate is not winner:
+                        candidate[1].abandon(candidate[2])
+                current, winner_connection, winner_msgid, sent = winner
+                self._record_success(current, sent)
+                for entry in self._search_iter(winner_connection, base, scope,
+                                               filterstr, attrlist, page_size,
+                                               serverctrls, sizelimit,
+                                               msgid=winner_msgid,
+                                               response=response):
+                    yield entry
+            finally:
+                if hedge_connection is not None:
+                    self._release(hedge_uri, hedge_connection,
+                                  hedge_uri not in failed)
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+            fail(current)
+            raise
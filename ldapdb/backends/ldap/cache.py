@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import collections
+import hashlib
+import threading
+import time
+import uuid
+
+import ldap.dn
+
+
+class LocalStorage(object):
+    """
+    A thread-safe in-process store, which forgets the least recently used
+    values once it holds more than `max_entries` of them.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expiry time or None, value)
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or (item[0] is not None and
+                                item[0] < time.time()):
+                return None
+            self._data[key] = item
+            return item[1]
+
+    def get_many(self, keys):
+        return dict((key, self.get(key)) for key in keys)
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores `value` for `timeout` seconds, or until it is evicted if
+        `timeout` is None.
+        """
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoStorage(object):
+    """
+    A store backed by one of the caches configured in Django's CACHES
+    setting, which can be shared between processes.
+    """
+
+    def __init__(self, alias):
+        try:
+            # django >= 1.7
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+
+    def _key(self, key):
+        return 'ldapdb:%s' % hashlib.md5(repr(key)).hexdigest()
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def get_many(self, keys):
+        hashed = dict((self._key(key), key) for key in keys)
+        values = self.cache.get_many(hashed.keys())
+        return dict((key, values.get(h)) for h, key in hashed.items())
+
+    def set(self, key, value, timeout):
+        self.cache.set(self._key(key), value, timeout)
+
+    def clear(self):
+        # the cache may hold other data, the results expire on their own
+        pass
+
+
+def split_dn(dn):
+    """
+    Returns the normalized DNs of an entry and of all its superiors, up to
+    the root DSE.
+    """
+    bits = ldap.dn.str2dn(dn)
+    return [ldap.dn.dn2str(bits[i:]).lower() for i in range(len(bits) + 1)]
+
+
+def copy_entries(entries):
+    """
+    Returns a copy of the (dn, attributes) search results `entries`.
+    """
+    return [(dn, dict((name, list(values))
+                      for name, values in attrs.items()))
+            for dn, attrs in entries]
+
+
+class QueryCache(object):
+    """
+    Caches search results for `timeout` seconds in `storage`.
+
+    Once expired, results are still served for `stale_timeout` seconds
+    while they are refreshed in the background.
+
+    Writes invalidate the results of the searches they can affect, by
+    changing generation tokens which are part of the cache keys: each
+    search depends on the "subtree" token of its base, which changes on
+    any write below it, and on the "entry" tokens of its base and its
+    superiors, which change when they are renamed or deleted.
+    """
+
+    def __init__(self, storage, timeout=60, stale_timeout=0):
+        self.storage = storage
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _generations(self, keys):
+        tokens = self.storage.get_many(keys)
+        for key in keys:
+            if tokens[key] is None:
+                tokens[key] = self._bump(key)
+        return tuple(tokens[key] for key in keys)
+
+    def _bump(self, key):
+        # a fresh token, rather than a counter, so that forgetting it
+        # cannot bring back older results
+        token = uuid.uuid4().hex
+        # any result depending on the token expires before it
+        self.storage.set(key, token, self.timeout + self.stale_timeout)
+        return token
+
+    def _key(self, base, search):
+        dns = split_dn(base)
+        keys = [('subtree', dns[0])] + [('entry', dn) for dn in dns]
+        return ('search', search, self._generations(keys))
+
+    def search(self, base, search, fetch, refresh=None):
+        """
+        Returns the cached results of the search identified by the `search`
+        tuple under `base`, calling `fetch` to perform it if needed. Stale
+        results are refreshed by calling `refresh`, by default `fetch`,
+        from another thread.
+        """
+        key = self._key(base, search)
+        item = self.storage.get(key)
+        if item is not None:
+            fresh_until, results = item
+            if time.time() > fresh_until:
+                self._refresh(key, refresh or fetch)
+            return copy_entries(results)
+
+        results = fetch()
+        self._store(key, results)
+        return copy_entries(results)
+
+    def _store(self, key, results):
+        # callers get copies, so that changing the entries they were
+        # handed cannot alter the cached ones
+        results = tuple(copy_entries(results))
+        self.storage.set(key, (time.time() + self.timeout, results),
+                         self.timeout + self.stale_timeout)
+
+    def _refresh(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._store(key, fetch())
+            except ldap.LDAPError:
+                # the stale results expire on their own
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def invalidate(self, dns, structural=False):
+        """
+        Invalidates the results which writes to the entries at `dns` can
+        affect. `structural` writes (renames and deletions) also affect
+        the entries below.
+        """
+        keys = set()
+        for dn in dns:
+            bits = split_dn(dn)
+            keys.update(('subtree', superior) for superior in bits)
+            if structural:
+                keys.add(('entry', bits[0]))
+        for key in keys:
+            self._bump(key)
+
+    def clear(self):
+        self.storage.clear()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_query_cache(key, factory):
+    """
+    Returns the process-wide query cache registered under `key`, creating
+    it with `factory` on first use.
+    """
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = factory()
+        return cache
+
+
+def clear_query_caches():
+    """
+    Empties and forgets all the process-wide query caches.
+    """
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
+        _caches.clear()
@@ -30,8 +30,10 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import itertools
 import ldap
-import re
+import ldap.controls
+import ldap.dn
 import sys
 
 import django
@@ -42,9 +44,27 @@ else:
 from django.db.models.sql import compiler
 from django.db.models.sql.where import AND, OR
 
+try:
+    from ldap.controls.sss import SSSRequestControl
+    from ldap.controls.vlv import VLVRequestControl, VLVResponseControl
+except ImportError:
+    # python-ldap < 2.4.15, or pyasn1 is missing
+    SSSRequestControl = VLVRequestControl = VLVResponseControl = None
+
+from ldapdb import unescape_ldap_filter
+from ldapdb.backends.ldap.base import TREE_DELETE_OID
+from ldapdb.backends.ldap.cache import LocalStorage
+from ldapdb.backends.ldap.filters import (FALSE, TRUE, format_filter,
+                                          optimize_filter, parse_filter)
 from ldapdb.models.fields import ListField
 
-_ORDER_BY_LIMIT_OFFSET_RE = re.compile(r'(?:\bORDER BY\b\s+(.+?))?\s*(?:\bLIMIT\b\s+(-?\d+))?\s*(?:\bOFFSET\b\s+(\d+))?$')
+# above this number of primary keys, one search is cheaper than reading
+# each entry
+MAX_BASE_READS = 20
+
+# the number of filter templates remembered for each model
+MAX_FILTER_TEMPLATES = 100
+
 
 def get_lookup_operator(lookup_type):
     if lookup_type == 'gte':
@@ -55,141 +75,668 @@ def get_lookup_operator(lookup_type):
         return '='
 
 
-def query_as_ldap(query):
+def _defining_class(cls, name):
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass
+
+
+def field_decoder(field, connection):
+    """
+    Returns a function performing field.from_ldap() for `connection`.
+
+    Fields may define get_decoder(connection), returning a function which
+    decodes the LDAP values of the field, so that its setup is done once
+    per query rather than once per entry. It is used unless from_ldap() is overridden by a subclass of the class
+    defining get_decoder().
+    """
+    decoder_class = _defining_class(type(field), 'get_decoder')
+    if decoder_class is not None and issubclass(
+            decoder_class, _defining_class(type(field), 'from_ldap')):
+        return field.get_decoder(connection)
+
+    def decode(values):
+        return field.from_ldap(values, connection=connection)
+    return decode
+
+
+def query_as_ldap(query, selectivity=None):
+    """
+    Returns the optimized LDAP filter of `query`, or None if it cannot
+    match any entry. `selectivity` maps attribute names to the estimated
+    fraction of the entries an equality on the attribute matches.
+    """
     # starting with django 1.6 we can receive empty querysets
     if hasattr(query, 'is_empty') and query.is_empty():
         return
 
-    filterstr = ''.join(['(objectClass=%s)' % cls for cls in
-                         query.model.object_classes])
-    sql, params = where_as_ldap(query.where)
-    filterstr += sql
-    return '(&%s)' % filterstr
+    # queries differing only by their values share the same template
+    model = query.model
+    values = []
+    shape = where_shape(query.where, values)
+    key = shape
+    if selectivity:
+        key = (shape, tuple(sorted(selectivity.items())))
+    templates = model.__dict__.get('_filter_templates')
+    if templates is None:
+        templates = LocalStorage(max_entries=MAX_FILTER_TEMPLATES)
+        model._filter_templates = templates
+    template = templates.get(key)
+    if template is None:
+        template = FilterTemplate(model, shape, selectivity)
+        templates.set(key, template)
+    return template.render(values)
 
 
 def where_as_ldap(self):
-    bits = []
+    values = []
+    template = shape_template(where_shape(self, values))
+    return template % tuple(values), []
+
+
+def where_shape(self, values):
+    """
+    Returns a hashable description of the structure of a WHERE node, and
+    appends the values of its lookups to `values`.
+    """
+    children = []
     for item in self.children:
         if hasattr(item, 'lhs') and hasattr(item, 'rhs'):
             # Django 1.7
             item = item.lhs.target.column, item.lookup_name, None, item.rhs
         elif hasattr(item, 'as_sql'):
-            sql, params = where_as_ldap(item)
-            bits.append(sql)
+            children.append(where_shape(item, values))
             continue
 
-        constraint, lookup_type, y, values = item
+        constraint, lookup_type, y, value = item
         if hasattr(constraint, 'col'):
             constraint = constraint.col
-        comp = get_lookup_operator(lookup_type)
         if lookup_type == 'in':
-            equal_bits = ["(%s%s%s)" % (constraint, comp, value) for value
-                          in values]
-            clause = '(|%s)' % ''.join(equal_bits)
+            values.extend(value)
+            children.append(('in', constraint, len(value)))
         else:
-            clause = "(%s%s%s)" % (constraint, comp, values)
+            values.append(value)
+            children.append(('lookup', constraint, lookup_type))
+    return ('node', self.connector, self.negated, tuple(children))
+
 
-        bits.append(clause)
+def shape_template(shape):
+    """
+    Returns the filter for the WHERE node described by `shape`, with a
+    placeholder for each of its values.
+    """
+    kind, connector, negated, children = shape
+    bits = []
+    for child in children:
+        if child[0] == 'node':
+            bit = shape_template(child)
+        elif child[0] == 'in':
+            column = child[1].replace('%', '%%')
+            bit = '(|%s)' % ''.join(['(%s=%%s)' % column] * child[2])
+        else:
+            bit = '(%s%s%%s)' % (child[1].replace('%', '%%'),
+                                 get_lookup_operator(child[2]))
+        bits.append(bit)
 
     if not len(bits):
-        return '', []
+        return ''
 
     if len(bits) == 1:
-        sql_string = bits[0]
-    elif self.connector == AND:
-        sql_string = '(&%s)' % ''.join(bits)
-    elif self.connector == OR:
-        sql_string = '(|%s)' % ''.join(bits)
+        template = bits[0]
+    elif connector == AND:
+        template = '(&%s)' % ''.join(bits)
+    elif connector == OR:
+        template = '(|%s)' % ''.join(bits)
     else:
-        raise Exception("Unhandled WHERE connector: %s" % self.connector)
+        raise Exception("Unhandled WHERE connector: %s" % connector)
+
+    if negated:
+        template = '(!%s)' % template
+
+    return template
+
+
+def shape_filter(shape, positions):
+    """
+    Returns the parsed filter for the WHERE node described by `shape`, with
+    a Parameter for each of its values, or None if the node is empty.
+    """
+    kind, connector, negated, children = shape
+    nodes = []
+    for child in children:
+        if child[0] == 'node':
+            node = shape_filter(child, positions)
+            if node is None:
+                continue
+        elif child[0] == 'in':
+            node = ('|', tuple([('=', child[1], Parameter(next(positions)))
+                                for i in range(child[2])]))
+        else:
+            node = (get_lookup_operator(child[2]), child[1],
+                    Parameter(next(positions)))
+        nodes.append(node)
+
+    if not nodes:
+        return None
+
+    if connector == AND:
+        node = ('&', tuple(nodes))
+    elif connector == OR:
+        node = ('|', tuple(nodes))
+    else:
+        raise Exception("Unhandled WHERE connector: %s" % connector)
+
+    if negated:
+        node = ('!', node)
+
+    return node
 
-    if self.negated:
-        sql_string = ('(!%s)' % sql_string)
 
-    return sql_string, []
+class Parameter(object):
+    """
+    The position of a value in the list of values of a WHERE node.
+    """
+    __slots__ = ('position',)
+
+    def __init__(self, position):
+        self.position = position
+
+
+def _erase(node):
+    # the structure of a parsed filter, without its parameters
+    if node[0] in ('&', '|'):
+        return (node[0], tuple([_erase(child) for child in node[1]]))
+    elif node[0] == '!':
+        return ('!', _erase(node[1]))
+    elif isinstance(node[-1], Parameter):
+        return node[:-1]
+    return node
+
+
+def _may_simplify(node):
+    # whether some values could make terms of the filter redundant
+    if node[0] == '!':
+        return _may_simplify(node[1])
+    elif node[0] not in ('&', '|'):
+        return False
+
+    seen = set()
+    for child in node[1]:
+        term = _erase(child)
+        if term in seen or _may_simplify(child):
+            return True
+        seen.add(term)
+    if node[0] == '&':
+        for term in seen:
+            if term[0] == '!' and term[1] in seen:
+                return True
+    return False
+
+
+def _bind(node, values):
+    # the parsed filter with its parameters replaced by their values
+    if node[0] in ('&', '|'):
+        return (node[0], tuple([_bind(child, values) for child in node[1]]))
+    elif node[0] == '!':
+        return ('!', _bind(node[1], values))
+    elif isinstance(node[-1], Parameter):
+        return node[:-1] + (values[node[-1].position],)
+    return node
+
+
+class FilterTemplate(object):
+    """
+    The optimized LDAP filter of the queries on a model whose WHERE nodes
+    have the same shape.
+
+    Most filters are optimized once and then rendered by substituting the
+    values. Filters where equal values would make terms redundant, such
+    as `in` lookups, are optimized again with their values.
+    """
+    def __init__(self, model, shape, selectivity=None):
+        if selectivity:
+            selectivity = dict([(attr.lower(), estimate)
+                                for attr, estimate in selectivity.items()])
+        self.selectivity = selectivity
+
+        terms = [('=', 'objectClass', cls) for cls in model.object_classes]
+        where = shape_filter(shape, itertools.count())
+        if where is not None:
+            terms.append(where)
+        self.node = optimize_filter(('&', tuple(terms)), selectivity)
+
+        self.template = None
+        self.positions = []
+        if not _may_simplify(self.node):
+            self.template = self.format(self.node, self.positions)
+
+    def format(self, node, positions=None):
+        if node == FALSE:
+            return None
+        elif node == TRUE:
+            node = ('present', 'objectClass')
+
+        if positions is None:
+            # the values are already escaped
+            return format_filter(node, escape=lambda value: value)
+
+        def escape(value):
+            if isinstance(value, Parameter):
+                positions.append(value.position)
+                return '\0'
+            return value
+        template = format_filter(node, escape=escape)
+        return template.replace('%', '%%').replace('\0', '%s')
+
+    def render(self, values):
+        if self.template is not None:
+            return self.template % tuple([values[position]
+                                          for position in self.positions])
+        elif self.node == FALSE:
+            return None
+        node = optimize_filter(_bind(self.node, values), self.selectivity)
+        return self.format(node)
+
+
+class LdapQuery(object):
+    """
+    The LDAP search performing a query, built once per compiler by
+    SQLCompiler.as_ldap().
+
+    `filterstr` is None when the query cannot match any entry, and
+    `base_dns` lists the entries to read directly when the query looks up
+    primary keys. `ordering` holds (field, reverse) sort keys, and
+    `sort_rules` their Server Side Sort ordering rules, or None if the
+    entries have to be sorted locally. `low_mark` and `high_mark` delimit
+    the window of entries to return.
+
+    `columns` describes the values of each row and `aggregates` those of
+    the row returned for aggregations, as (kind, value) tuples where kind
+    is 'dn', 'field', 'count' or 'value'. `decoders` holds a function for
+    each column, computing its value from the DN and attributes of an
+    entry.
+    """
+    def __init__(self, base_dn, scope, filterstr, attrlist, ordering=None,
+                 sort_rules=None, low_mark=0, high_mark=None, columns=None,
+                 aggregates=None, decoders=None, distinct=False,
+                 base_dns=None, page_size=None, entries=None):
+        self.base_dn = base_dn
+        self.scope = scope
+        self.filterstr = filterstr
+        self.attrlist = attrlist
+        self.ordering = ordering or []
+        self.sort_rules = sort_rules
+        self.low_mark = low_mark
+        self.high_mark = high_mark
+        self.columns = columns or []
+        self.aggregates = aggregates or []
+        self.decoders = decoders or []
+        self.distinct = distinct
+        self.base_dns = base_dns
+        self.page_size = page_size
+        self.entries = entries
+
+    def __repr__(self):
+        return '<LdapQuery: %s %r>' % (self.base_dn, self.filterstr)
+
+    @property
+    def filter(self):
+        """
+        The parsed filter, see ldapdb.backends.ldap.filters.parse_filter().
+        """
+        if self.filterstr is None:
+            return None
+        return parse_filter(self.filterstr)
+
+    @property
+    def window(self):
+        """
+        The (low_mark, high_mark) slice of the entries to return.
+        """
+        return self.low_mark, self.high_mark
 
 
 class SQLCompiler(compiler.SQLCompiler):
-    def execute_sql(self, result_type=compiler.SINGLE):
+    _ldap_query = None
+
+    def as_ldap(self):
+        """
+        Returns the LdapQuery performing the query.
+        """
+        if self._ldap_query is None:
+            query = self.query
+            model = query.model
+            ordering = self.get_ldap_ordering()
+            columns, aggregates = self.get_columns()
+            self._ldap_query = LdapQuery(
+                model.base_dn, model.search_scope,
+                query_as_ldap(
+                    query,
+                    self.connection.settings_dict.get('FILTER_SELECTIVITY')),
+                self.get_attrlist(),
+                ordering=ordering,
+                sort_rules=self.get_sort_rules(ordering),
+                low_mark=query.low_mark,
+                high_mark=query.high_mark,
+                columns=columns,
+                aggregates=aggregates,
+                decoders=self.get_decoders(columns),
+                distinct=query.distinct,
+                base_dns=self.get_base_dns(),
+                page_size=self.ldap_option('page_size'),
+                entries=self.ldap_option('entries'))
+        return self._ldap_query
+
+    def ldap_option(self, name, default=None):
+        """
+        Returns an LDAP search option set on the queryset.
+        """
+        # queries which were not built by ldapdb.models.query carry no options
+        return getattr(self.query, 'ldap_options', {}).get(name, default)
+
+    def execute_sql(self, result_type=compiler.MULTI):
+        if result_type == compiler.MULTI and django.VERSION >= (1, 8):
+            # QuerySet.iterator() only needs the query to be set up, the
+            # entries are fetched by results_iter()
+            self.as_ldap()
+            return
         if result_type != compiler.SINGLE:
             raise Exception("LDAP does not support MULTI queries")
 
-        filterstr = query_as_ldap(self.query)
+        count = self.count_entries()
+        if not count:
+            return None
+
+        output = []
+        for kind, value in self.as_ldap().aggregates:
+            if kind == 'count':
+                output.append(count)
+            else:
+                output.append(value)
+        return output
+
+    def count_entries(self):
+        """
+        Returns the number of entries matching the query, within its slice,
+        without retrieving any of their attributes.
+        """
+        ldap_query = self.as_ldap()
+        if ldap_query.distinct:
+            # rows have to be compared
+            return len(list(self.results_iter()))
+
+        if not ldap_query.filterstr:
+            return 0
+
+        low_mark, high_mark = ldap_query.window
+        if high_mark is not None and high_mark <= low_mark:
+            return 0
+        count = 0
+        # "1.1" requests no attributes at all (RFC 4511)
+        for entry in self._search(['1.1']):
+            count += 1
+            if count == high_mark:
+                # stop the search
+                break
+        return max(0, count - low_mark)
+
+    def estimate_count(self):
+        """
+        Returns the server's estimate of the number of entries matching the
+        query, or None if it cannot provide one.
+
+        The estimate is the content count of a Virtual List View, or the
+        number of subordinates of the base entry for unfiltered one-level
+        searches.
+        """
+        ldap_query = self.as_ldap()
+        filterstr = ldap_query.filterstr
         if not filterstr:
+            return 0
+        model = self.query.model
+
+        # the local copy of the entries gives an exact count
+        vals = self._search_mirror(['1.1'])
+        if vals is not None:
+            return len(vals)
+
+        sort_control = self.get_sort_control(
+            self.get_sort_rules([(model._meta.pk, False)]))
+        if sort_control is not None and VLVRequestControl is not None and \
+                self.connection.features.supports_virtual_list_view:
+            vlv_control = VLVRequestControl(
+                criticality=True, before_count=0, after_count=0, offset=1,
+                content_count=0)
+            try:
+                vals, controls = self.connection.search_with_controls(
+                    ldap_query.base_dn, ldap_query.scope,
+                    filterstr=filterstr, attrlist=['1.1'],
+                    serverctrls=[sort_control, vlv_control])
+            except ldap.NO_SUCH_OBJECT:
+                return 0
+            except (ldap.VLV_ERROR, ldap.UNAVAILABLE_CRITICAL_EXTENSION):
+                pass
+            else:
+                for control in controls:
+                    if control.controlType == VLVResponseControl.controlType \
+                            and not control.result:
+                        return control.content_count
+
+        if ldap_query.scope == ldap.SCOPE_ONELEVEL and \
+                not where_as_ldap(self.query.where)[0]:
+            try:
+                attrs = self.connection.read_s(
+                    ldap_query.base_dn,
+                    ['numSubordinates', 'hasSubordinates'])
+            except ldap.NO_SUCH_OBJECT:
+                return 0
+            if attrs.get('numSubordinates'):
+                return int(attrs['numSubordinates'][0])
+            if attrs.get('hasSubordinates') == ['FALSE']:
+                return 0
+        return None
+
+    def results_iter(self, results=None):
+        ldap_query = self.as_ldap()
+        if not ldap_query.filterstr:
             return
 
+        vals, low_mark, high_mark = self._fetch_entries()
+        decoders = ldap_query.decoders
+        pos = 0
+        results = []
+        for dn, attrs in vals:
+            # the server could not apply the slice, skip unwanted entries
+            if (low_mark and pos < low_mark) or \
+               (high_mark is not None and pos >= high_mark):
+                pos += 1
+                continue
+            row = [decode(dn, attrs) for decode in decoders]
+            if ldap_query.distinct:
+                if row in results:
+                    continue
+                else:
+                    results.append(row)
+            yield row
+            pos += 1
+
+    def entries_iter(self):
+        """
+        Yields the (dn, attrs) entries matching the query, in order and
+        within its slice, without decoding them.
+        """
+        if not self.as_ldap().filterstr:
+            return
+
+        vals, low_mark, high_mark = self._fetch_entries()
+        pos = 0
+        for entry in vals:
+            if (low_mark and pos < low_mark) or \
+               (high_mark is not None and pos >= high_mark):
+                pos += 1
+                continue
+            yield entry
+            pos += 1
+
+    def _fetch_entries(self):
+        """
+        Returns the entries matching the query, in order, and the slice
+        which remains to be applied to them.
+        """
+        ldap_query = self.as_ldap()
+        attrlist = ldap_query.attrlist
+
+        # perform slicing and sorting, on the server if possible
+        low_mark, high_mark = ldap_query.window
+        ordering = ldap_query.ordering
+        vals = ldap_query.entries
+        if vals is None:
+            vals = self._search_mirror(attrlist)
+        if vals is not None:
+            # the entries were fetched asynchronously, or from the local
+            # copy of the model's entries
+            if ordering:
+                vals = self.sort_locally(vals, ordering)
+        else:
+            sort_control = None
+            if ldap_query.base_dns is None:
+                # otherwise the entries are read one at a time
+                vals = self._search_window(attrlist)
+                sort_control = self.get_sort_control(ldap_query.sort_rules)
+            if vals is not None:
+                low_mark, high_mark = 0, None
+            elif sort_control is not None:
+                vals = self._sorted_search(attrlist, sort_control, ordering)
+            else:
+                vals = self._search(attrlist)
+                if ordering:
+                    vals = self.sort_locally(vals, ordering)
+        return vals, low_mark, high_mark
+
+    def _sorted_search(self, attrlist, sort_control, ordering):
+        """
+        Yields the entries matching the query, sorted by the server with
+        `sort_control`, or locally if the server rejects the control.
+        """
+        received = False
         try:
-            vals = self.connection.search_s(
-                self.query.model.base_dn,
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=['dn'],
-            )
-        except ldap.NO_SUCH_OBJECT:
-            vals = []
+            for entry in self._search(attrlist, serverctrls=[sort_control]):
+                received = True
+                yield entry
+        except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
+            if received:
+                raise
+            for entry in self.sort_locally(self._search(attrlist), ordering):
+                yield entry
 
-        if not vals:
-            return None
+    def get_fields(self):
+        """
+        Returns the fields selected by the query.
+        """
+        if hasattr(self.query, 'select_fields') and len(self.query.select_fields):
+            # django < 1.6
+            return self.query.select_fields
+        elif len(self.query.select):
+            # django >= 1.6
+            return [x.field for x in self.query.select]
+        else:
+            return self.query.model._meta.fields
 
-        output = []
+    def get_columns(self):
+        """
+        Returns the description of the values of each row, and of the row
+        returned for aggregations, as lists of (kind, value) tuples.
+        """
+        def column(field):
+            if field.attname == 'dn':
+                return ('dn', field)
+            elif hasattr(field, 'from_ldap'):
+                return ('field', field)
+            return ('value', None)
+
+        columns = []
+        aggregate_row = []
         if django.VERSION >= (1, 8):
-            self.setup_query()
+            if self.select is None:
+                self.setup_query()
             for e in self.select:
                 if isinstance(e[0], aggregates.Count):
-                    # Check if the SQL query has a limit value and append
-                    # that value, else append the length of the return values
-                    # from LDAP.
-                    sql = self.as_sql()[0]
-                    if hasattr(self.query, 'subquery'):
-                        sql = self.query.subquery
-                    m = _ORDER_BY_LIMIT_OFFSET_RE.search(sql)
-                    limit = m.group(2)
-                    offset = m.group(3)
-                    if limit and int(limit) >= 0:
-                        output.append(int(limit))
-                    elif offset:
-                        output.append(len(vals) - int(offset))
-                    else:
-                        output.append(len(vals))
+                    columns.append(('count', e[0].input_field.field))
+                    aggregate_row.append(('count', None))
                 else:
-                    output.append(e[0])
+                    columns.append(column(e[0].field))
+                    aggregate_row.append(('value', e[0]))
         else:
+            columns = [column(field) for field in self.get_fields()]
             for alias, col in self.query.extra_select.iteritems():
-                output.append(col[0])
+                aggregate_row.append(('value', col[0]))
             for key, aggregate in self.query.aggregate_select.items():
                 if isinstance(aggregate, aggregates.Count):
-                    output.append(len(vals))
+                    columns.append(('count', aggregate.source))
+                    aggregate_row.append(('count', None))
                 else:
-                    output.append(None)
-        return output
+                    columns.append(('value', None))
+                    aggregate_row.append(('value', None))
+        return columns, aggregate_row
 
-    def results_iter(self, results=None):
-        filterstr = query_as_ldap(self.query)
-        if not filterstr:
-            return
+    def get_decoders(self, columns):
+        """
+        Returns a function for each of the given columns, computing its
+        value from the DN and attributes of an entry.
+        """
+        return [self.get_decoder(kind, value) for kind, value in columns]
 
-        if hasattr(self.query, 'select_fields') and len(self.query.select_fields):
-            # django < 1.6
-            fields = self.query.select_fields
-        elif len(self.query.select):
-            # django >= 1.6
-            fields = [x.field for x in self.query.select]
-        else:
-            fields = self.query.model._meta.fields
+    def get_decoder(self, kind, value):
+        """
+        Returns a function computing the value of a column from the DN and
+        attributes of an entry.
+        """
+        if kind == 'dn':
+            return lambda dn, attrs: dn
+        elif kind == 'value':
+            return lambda dn, attrs: value
+        elif kind == 'count' and value.attname == 'dn':
+            return lambda dn, attrs: 1
+        elif kind == 'count' and not hasattr(value, 'from_ldap'):
+            return lambda dn, attrs: 0
 
-        attrlist = [x.db_column for x in fields if x.db_column]
+        column = value.db_column
+        decode = field_decoder(value, self.connection)
 
-        try:
-            vals = self.connection.search_s(
-                self.query.model.base_dn,
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=attrlist,
-            )
-        except ldap.NO_SUCH_OBJECT:
-            return
+        if kind == 'field':
+            return lambda dn, attrs: decode(attrs.get(column, ()))
 
-        # perform sorting
+        multiple = isinstance(value, ListField)
+
+        def count(dn, attrs):
+            result = decode(attrs.get(column, ()))
+            if not result:
+                return 0
+            return multiple and len(result) or 1
+        return count
+
+    def get_attrlist(self):
+        """
+        Returns the LDAP attributes to retrieve for the query.
+        """
+        return [x.db_column for x in self.get_fields() if x.db_column]
+
+    def get_search_args(self):
+        """
+        Returns the base DN, scope, filter and attribute list of the search
+        performing the query, or None if the query cannot match anything.
+        """
+        ldap_query = self.as_ldap()
+        if not ldap_query.filterstr:
+            return None
+        return (ldap_query.base_dn, ldap_query.scope, ldap_query.filterstr,
+                ldap_query.attrlist)
+
+    def get_ldap_ordering(self):
+        """
+        Returns the ordering of the query as a list of (field, reverse)
+        tuples.
+        """
         if self.query.extra_order_by:
             ordering = self.query.extra_order_by
         elif not self.query.default_ordering:
@@ -197,141 +744,333 @@ class SQLCompiler(compiler.SQLCompiler):
         else:
             ordering = self.query.order_by or self.query.model._meta.ordering
 
-        def cmpvals(x, y):
-            for fieldname in ordering:
-                if fieldname.startswith('-'):
-                    fieldname = fieldname[1:]
-                    negate = True
-                else:
-                    negate = False
-                if fieldname == 'pk':
-                    fieldname = self.query.model._meta.pk.name
-                field = self.query.model._meta.get_field(fieldname)
-                attr_x = field.from_ldap(x[1].get(field.db_column, []),
-                                         connection=self.connection)
-                attr_y = field.from_ldap(y[1].get(field.db_column, []),
-                                         connection=self.connection)
+        result = []
+        for fieldname in ordering:
+            if fieldname.startswith('-'):
+                fieldname = fieldname[1:]
+                reverse = True
+            else:
+                reverse = False
+            if fieldname == 'pk':
+                fieldname = self.query.model._meta.pk.name
+            result.append((self.query.model._meta.get_field(fieldname),
+                           reverse))
+        return result
+
+    def get_sort_rules(self, ordering):
+        """
+        Returns the Server Side Sort ordering rules for the given ordering,
+        or None if the ordering has to be performed locally.
+        """
+        if not ordering:
+            return None
+
+        ordering_rules = []
+        for field, reverse in ordering:
+            # only sort on the server when we know the matching rule which
+            # reproduces the local ordering
+            ordering_rule = getattr(field, 'ordering_rule', None)
+            if not field.db_column or not ordering_rule:
+                return None
+            ordering_rules.append('%s%s:%s' % (reverse and '-' or '',
+                                               field.db_column,
+                                               ordering_rule))
+        return ordering_rules
+
+    def get_sort_control(self, sort_rules):
+        """
+        Returns a Server Side Sort control (RFC 2891) for the given ordering
+        rules, or None if the server cannot sort the entries.
+        """
+        if not sort_rules or SSSRequestControl is None or \
+                not self.connection.features.supports_server_side_sort:
+            return None
+        return SSSRequestControl(criticality=True,
+                                 ordering_rules=sort_rules)
+
+    def sort_locally(self, vals, ordering):
+        """
+        Sorts the entries according to the given ordering.
+        """
+        vals = list(vals)
+        # sort on the least significant field first, relying on the
+        # stability of the sort so that each value is only decoded once
+        # per field
+        for field, reverse in reversed(ordering):
+            def sort_key(entry, decode=self.get_decoder('field', field)):
+                value = decode(*entry)
                 # perform case insensitive comparison
-                if hasattr(attr_x, 'lower'):
-                    attr_x = attr_x.lower()
-                if hasattr(attr_y, 'lower'):
-                    attr_y = attr_y.lower()
-                val = negate and cmp(attr_y, attr_x) or cmp(attr_x, attr_y)
-                if val:
-                    return val
-            return 0
-        vals = sorted(vals, cmp=cmpvals)
+                if hasattr(value, 'lower'):
+                    value = value.lower()
+                return value
+            vals.sort(key=sort_key, reverse=reverse)
+        return vals
 
-        # process results
-        pos = 0
-        results = []
-        for dn, attrs in vals:
-            # FIXME : This is not optimal, we retrieve more results than we
-            # need but there is probably no other options as we can't perform
-            # ordering server side.
-            if (self.query.low_mark and pos < self.query.low_mark) or \
-               (self.query.high_mark is not None and
-                    pos >= self.query.high_mark):
-                pos += 1
+    def _search_window(self, attrlist):
+        """
+        Fetches only the entries within the query's slice using a Virtual
+        List View control, or returns None if the server cannot do so.
+        """
+        ldap_query = self.as_ldap()
+        low_mark, high_mark = ldap_query.window
+        if high_mark is None or VLVRequestControl is None:
+            return None
+        if high_mark <= low_mark:
+            return []
+
+        # a virtual list view requires a sorted result set
+        if ldap_query.ordering:
+            sort_rules = ldap_query.sort_rules
+        else:
+            sort_rules = self.get_sort_rules(
+                [(self.query.model._meta.pk, False)])
+        sort_control = self.get_sort_control(sort_rules)
+        if sort_control is None or \
+                not self.connection.features.supports_virtual_list_view:
+            return None
+
+        vlv_control = VLVRequestControl(
+            criticality=True, before_count=0,
+            after_count=high_mark - low_mark - 1,
+            offset=low_mark + 1, content_count=0)
+        try:
+            vals, controls = self.connection.search_with_controls(
+                ldap_query.base_dn,
+                ldap_query.scope,
+                filterstr=ldap_query.filterstr,
+                attrlist=attrlist,
+                serverctrls=[sort_control, vlv_control])
+        except ldap.NO_SUCH_OBJECT:
+            return []
+        except (ldap.VLV_ERROR, ldap.UNAVAILABLE_CRITICAL_EXTENSION):
+            return None
+
+        for control in controls:
+            if control.controlType == VLVResponseControl.controlType:
+                if control.result:
+                    return None
+                if control.target_position != low_mark + 1:
+                    # the offset lies beyond the end of the list
+                    return []
+        return vals[:high_mark - low_mark]
+
+    def get_base_dns(self):
+        """
+        Returns the DNs of the entries to which the query is restricted by
+        an exact or "in" lookup on the primary key, or None.
+
+        Only one-level searches, or models declaring unique RDNs, can be
+        answered by these entries: otherwise another entry with the same
+        RDN may exist further down the subtree.
+        """
+        model = self.query.model
+        pk = model._meta.pk
+        where = self.query.where
+        if not pk.db_column or where.negated or \
+                not (model.search_scope == ldap.SCOPE_ONELEVEL or
+                     (model.unique_rdns and
+                      model.search_scope == ldap.SCOPE_SUBTREE)) or \
+                (where.connector != AND and len(where.children) > 1):
+            return None
+
+        for item in where.children:
+            if hasattr(item, 'lhs') and hasattr(item, 'rhs'):
+                # Django 1.7
+                if not hasattr(item.lhs, 'target'):
+                    continue
+                column, lookup_type, values = \
+                    item.lhs.target.column, item.lookup_name, item.rhs
+            elif hasattr(item, 'as_sql'):
                 continue
-            row = []
-            if django.VERSION >= (1, 8):
-                self.setup_query()
-                for e in self.select:
-                    if isinstance(e[0], aggregates.Count):
-                        value = 0
-                        if e[0].input_field.field.attname == 'dn':
-                            value = 1
-                        elif hasattr(e[0].input_field.field, 'from_ldap'):
-                            result = e[0].input_field.field.from_ldap(
-                                attrs.get(e[0].input_field.field.db_column, []),
-                                connection=self.connection)
-                            if result:
-                                value = 1
-                                if isinstance(e[0].input_field.field, ListField):
-                                    value = len(result)
-                        row.append(value)
-                    else:
-                        if e[0].field.attname == 'dn':
-                            row.append(dn)
-                        elif hasattr(e[0].field, 'from_ldap'):
-                            row.append(e[0].field.from_ldap(
-                                attrs.get(e[0].field.db_column, []),
-                                connection=self.connection))
-                        else:
-                            row.append(None)
             else:
-                for field in iter(fields):
-                    if field.attname == 'dn':
-                        row.append(dn)
-                    elif hasattr(field, 'from_ldap'):
-                        row.append(field.from_ldap(attrs.get(field.db_column, []),
-                                                connection=self.connection))
-                    else:
-                        row.append(None)
-                for key, aggregate in self.query.aggregate_select.items():
-                    if isinstance(aggregate, aggregates.Count):
-                        value = 0
-                        if aggregate.source.attname == 'dn':
-                            value = 1
-                        elif hasattr(aggregate.source, 'from_ldap'):
-                            result = aggregate.source.from_ldap(
-                                attrs.get(aggregate.source.db_column, []),
-                                connection=self.connection)
-                            if result:
-                                value = 1
-                                if isinstance(aggregate.source, ListField):
-                                    value = len(result)
-                        row.append(value)
-                    else:
-                        row.append(None)
-            if self.query.distinct:
-                if row in results:
-                    continue
-                else:
-                    results.append(row)
-            yield row
-            pos += 1
+                constraint, lookup_type, y, values = item
+                column = getattr(constraint, 'col', constraint)
+
+            if column != pk.db_column:
+                continue
+            if lookup_type == 'exact':
+                values = [values]
+            elif lookup_type != 'in' or len(values) > MAX_BASE_READS:
+                continue
+            return ['%s=%s,%s' % (column,
+                                  ldap.dn.escape_dn_chars(
+                                      unescape_ldap_filter('%s' % value)),
+                                  model.base_dn)
+                    for value in values]
+        return None
+
+    def _search_mirror(self, attrlist):
+        """
+        Returns the entries matching the query from the local copy of the
+        model's entries, or None if the server must be searched.
+        """
+        mirror = self.connection.get_mirror(self.query.model)
+        if mirror is None or self.connection.wrote_recently():
+            # read our own writes
+            return None
+        return mirror.search(self.as_ldap().filterstr, attrlist)
+
+    def _search(self, attrlist, serverctrls=None, sizelimit=0, mirror=True):
+        """
+        Yields the entries matching the query as they are received, or
+        nothing if the base DN does not exist.
+
+        The entries come from the local copy of the model's entries if
+        `mirror` is set and the copy can be used. If the query looks up
+        primary keys, the corresponding entries are read directly.
+        """
+        ldap_query = self.as_ldap()
+        filterstr = ldap_query.filterstr
+        vals = None
+        if mirror:
+            vals = self._search_mirror(attrlist)
+        if vals is not None:
+            for entry in vals:
+                yield entry
+            return
+
+        found = set()
+        dns = ldap_query.base_dns
+        if dns is not None:
+            for dn in dns:
+                try:
+                    for entry in self.connection.search_iter(
+                            dn.encode(self.connection.charset),
+                            ldap.SCOPE_BASE,
+                            filterstr=filterstr,
+                            attrlist=attrlist):
+                        found.add(entry[0].lower())
+                        yield entry
+                except ldap.NO_SUCH_OBJECT:
+                    pass
+            if len(found) == len(dns) or \
+                    ldap_query.scope == ldap.SCOPE_ONELEVEL:
+                return
+            # with a subtree scope, the missing entries may be further down
+
+        try:
+            for entry in self.connection.search_iter(
+                    ldap_query.base_dn,
+                    ldap_query.scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    page_size=ldap_query.page_size,
+                    serverctrls=serverctrls,
+                    sizelimit=sizelimit):
+                if entry[0].lower() not in found:
+                    yield entry
+        except ldap.NO_SUCH_OBJECT:
+            return
+
+    def get_matching_dns(self):
+        """
+        Returns the DNs of the entries matching the query, without
+        retrieving any of their attributes.
+        """
+        if not self.as_ldap().filterstr:
+            return []
+        # "1.1" requests no attributes at all (RFC 4511), and the entries
+        # to write to must not be missed by a lagging copy
+        return [dn for dn, attrs in self._search(['1.1'], mirror=False)]
+
+    def execute_pipeline(self, operations, serverctrls=None):
+        """
+        Performs the given write operations and returns how many of them
+        succeeded, raising the first error once all of them were attempted.
+        """
+        results = self.connection.pipeline(operations,
+                                           serverctrls=serverctrls)
+        for error in results:
+            if error is not None:
+                raise error
+        return len(results)
 
     def has_results(self):
-        import inspect
-        iterator = self.results_iter()
-        if inspect.isgenerator(iterator):
-            try:
-                obj = iterator.next()
-                return True
-            except:
-                return False
-        else:
+        ldap_query = self.as_ldap()
+        if ldap_query.low_mark or ldap_query.distinct:
+            return self.count_entries() > 0
+
+        if not ldap_query.filterstr:
             return False
 
+        # stop the search on the first entry, without any attributes
+        try:
+            for entry in self._search(['1.1'], sizelimit=1):
+                return True
+        except ldap.SIZELIMIT_EXCEEDED:
+            return True
+        return False
+
 class SQLInsertCompiler(compiler.SQLInsertCompiler, SQLCompiler):
     pass
 
 
 class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
+    def get_columns(self):
+        # only the DNs of the entries are needed
+        return [], []
+
     def execute_sql(self, result_type=compiler.MULTI):
-        filterstr = query_as_ldap(self.query)
-        if not filterstr:
-            return
+        dns = self.get_matching_dns()
+        rdns = dict((dn, ldap.dn.str2dn(dn.encode(self.connection.charset)))
+                    for dn in dns)
 
-        try:
-            vals = self.connection.search_s(
-                self.query.model.base_dn,
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=['dn'],
-            )
-        except ldap.NO_SUCH_OBJECT:
-            return
+        if self.connection.settings_dict.get('TREE_DELETE', False) and \
+                self.connection.features.supports_tree_delete:
+            # the server removes the subordinates of each entry, so skip
+            # the entries whose superior is deleted as well
+            deleted = set()
+            operations = []
+            for dn in sorted(dns, key=lambda dn: len(rdns[dn])):
+                bits = rdns[dn]
+                if any(self._normalize_dn(bits[i:]) in deleted
+                       for i in range(1, len(bits))):
+                    continue
+                deleted.add(self._normalize_dn(bits))
+                operations.append(('delete', dn, ()))
+            control = ldap.controls.LDAPControl(TREE_DELETE_OID, True, None)
+            self.execute_pipeline(operations, serverctrls=[control])
+            return len(dns)
 
-        # FIXME : there is probably a more efficient way to do this
-        for dn, attrs in vals:
-            self.connection.delete_s(dn)
+        # an entry can only be deleted once its subordinates are gone, so
+        # delete the deepest entries first, one level at a time
+        levels = {}
+        for dn in dns:
+            levels.setdefault(len(rdns[dn]), []).append(dn)
+        for depth in sorted(levels, reverse=True):
+            self.execute_pipeline(
+                [('delete', dn, ()) for dn in levels[depth]])
+        return len(dns)
+
+    def _normalize_dn(self, bits):
+        return ldap.dn.dn2str(bits).lower()
 
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
-    pass
+    def get_columns(self):
+        # only the DNs of the entries are needed
+        return [], []
+
+    def execute_sql(self, result_type=compiler.MULTI):
+        modlist = []
+        for field, model, value in self.query.values:
+            if field.primary_key or not field.db_column:
+                raise Exception("LDAP does not support updating %s, save "
+                                "the objects instead" % field.name)
+            if hasattr(value, 'evaluate') or \
+                    hasattr(value, 'resolve_expression'):
+                raise Exception("LDAP does not support expressions in "
+                                "updates")
+            # replacing with no values removes the attribute
+            modlist.append((ldap.MOD_REPLACE, field.db_column,
+                            field.get_db_prep_save(
+                                value, connection=self.connection)))
+
+        dns = self.get_matching_dns()
+        if not modlist:
+            return len(dns)
+        return self.execute_pipeline(
+            [('modify', dn, (modlist,)) for dn in dns])
 
 
 class SQLAggregateCompiler(compiler.SQLAggregateCompiler, SQLCompiler):
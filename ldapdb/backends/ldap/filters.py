@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import re
+
+from ldapdb import escape_ldap_filter, unescape_ldap_filter
+
+_ITEM_RE = re.compile(r'^([\w.;-]+)([<>~]?=)(.*)$', re.DOTALL)
+
+# the filters matching every entry and no entry (RFC 4526)
+TRUE = ('&', ())
+FALSE = ('|', ())
+
+
+def parse_filter(filterstr):
+    """
+    Parses an LDAP search filter (RFC 4515) into a tree of tuples:
+
+        ('&', children) and ('|', children), with a tuple of children
+        ('!', child)
+        ('=', attr, value), and likewise for '>=', '<=' and '~='
+        ('present', attr)
+        ('substring', attr, (initial, middle, final)), where initial and
+        final may be None and middle is a tuple of values
+
+    Values are unescaped. Raises ValueError if the filter is malformed or
+    uses extensible matching.
+    """
+    node, pos = _parse(filterstr, 0)
+    if pos != len(filterstr):
+        raise ValueError("Trailing characters in filter %r" % filterstr)
+    return node
+
+
+def _parse(filterstr, pos):
+    if filterstr[pos:pos + 1] != '(':
+        raise ValueError("Expected '(' at position %d of filter %r" %
+                         (pos, filterstr))
+    pos += 1
+    op = filterstr[pos:pos + 1]
+    if op in ('&', '|'):
+        pos += 1
+        children = []
+        while filterstr[pos:pos + 1] == '(':
+            child, pos = _parse(filterstr, pos)
+            children.append(child)
+        node = (op, tuple(children))
+    elif op == '!':
+        child, pos = _parse(filterstr, pos + 1)
+        node = ('!', child)
+    else:
+        end = filterstr.find(')', pos)
+        if end < 0:
+            raise ValueError("Unterminated item in filter %r" % filterstr)
+        node = _parse_item(filterstr[pos:end])
+        pos = end
+
+    if filterstr[pos:pos + 1] != ')':
+        raise ValueError("Expected ')' at position %d of filter %r" %
+                         (pos, filterstr))
+    return node, pos + 1
+
+
+def _parse_item(item):
+    match = _ITEM_RE.match(item)
+    if match is None:
+        raise ValueError("Unsupported filter item %r" % item)
+    attr, op, value = match.groups()
+    if op == '=' and value == '*':
+        return ('present', attr)
+    if op == '=' and '*' in value:
+        bits = value.split('*')
+        initial = bits[0] and unescape_ldap_filter(bits[0]) or None
+        final = bits[-1] and unescape_ldap_filter(bits[-1]) or None
+        middle = tuple(unescape_ldap_filter(bit) for bit in bits[1:-1]
+                       if bit)
+        return ('substring', attr, (initial, middle, final))
+    return (op, attr, unescape_ldap_filter(value))
+
+
+def _case_exact(value):
+    # insignificant space handling (RFC 4518)
+    return u' '.join(value.decode('utf-8').split())
+
+
+def _case_ignore(value):
+    return _case_exact(value).lower()
+
+
+def _numeric_string(value):
+    return ''.join(value.split())
+
+
+# the equality matching rules (RFC 4517) which can be evaluated locally,
+# keyed by lowercase name: the function preparing the values to compare,
+# and whether the rule is paired with ordering and substrings rules
+MATCHING_RULES = {
+    'caseexactmatch': (_case_exact, True, True),
+    'caseexactia5match': (_case_exact, False, True),
+    'caseignorematch': (_case_ignore, True, True),
+    'caseignoreia5match': (_case_ignore, False, True),
+    'integermatch': (int, True, False),
+    'numericstringmatch': (_numeric_string, True, True),
+    'objectidentifiermatch': (str.lower, False, False),
+}
+
+
+def get_matching_rule(rules, attr):
+    """
+    Returns the MATCHING_RULES entry of the equality matching rule of
+    `attr` according to `rules`, which maps lowercase attribute names to
+    rule names, or None if it cannot be evaluated locally.
+    """
+    name = rules.get(attr.lower())
+    if name is None:
+        return None
+    return MATCHING_RULES.get(name.lower())
+
+
+def prepare_value(rule, value):
+    """
+    Returns `value` prepared for comparison by the MATCHING_RULES entry
+    `rule`, or None if it is not valid for the rule.
+    """
+    try:
+        return rule[0](value)
+    except ValueError:
+        return None
+
+
+def can_match_filter(node, rules):
+    """
+    Returns whether match_filter() can evaluate the parsed filter `node`
+    with the matching rules `rules`, given as for get_matching_rule().
+    """
+    op = node[0]
+    if op in ('&', '|'):
+        return all(can_match_filter(child, rules) for child in node[1])
+    elif op == '!':
+        return can_match_filter(node[1], rules)
+    elif op == 'present':
+        return True
+
+    rule = get_matching_rule(rules, node[1])
+    if rule is None:
+        return False
+    elif op == 'substring':
+        return rule[2]
+    elif op in ('>=', '<='):
+        if not rule[1]:
+            return False
+    elif op != '=':
+        return False
+    # the server treats comparisons with invalid values as undefined
+    return prepare_value(rule, node[2]) is not None
+
+
+def match_filter(node, attrs, rules):
+    """
+    Returns whether an entry whose attributes are given in `attrs`, keyed
+    by lowercase attribute name, matches the parsed filter `node`.
+
+    Values are compared according to the matching rules `rules`, given as
+    for get_matching_rule(), which must cover the filter as checked by
+    can_match_filter().
+    """
+    op = node[0]
+    if op == '&':
+        return all(match_filter(child, attrs, rules) for child in node[1])
+    elif op == '|':
+        return any(match_filter(child, attrs, rules) for child in node[1])
+    elif op == '!':
+        return not match_filter(node[1], attrs, rules)
+
+    values = attrs.get(node[1].lower(), [])
+    if op == 'present':
+        return bool(values)
+
+    rule = get_matching_rule(rules, node[1])
+    values = [prepare_value(rule, value) for value in values]
+    values = [value for value in values if value is not None]
+    if op == 'substring':
+        initial, middle, final = node[2]
+        bits = [prepare_value(rule, bit or '')
+                for bit in (initial,) + middle + (final,)]
+        if None in bits:
+            return False
+        regex = re.compile('^%s$' % '.*'.join(re.escape(bit) for bit in bits),
+                           re.DOTALL | re.UNICODE)
+        return any(regex.match(value) for value in values)
+
+    assertion = prepare_value(rule, node[2])
+    if op == '>=':
+        return any(value >= assertion for value in values)
+    elif op == '<=':
+        return any(value <= assertion for value in values)
+    return assertion in values
+
+
+def format_filter(node, escape=escape_ldap_filter):
+    """
+    Returns the string form of the parsed filter `node`, applying `escape`
+    to each of its values.
+    """
+    op = node[0]
+    if op in ('&', '|'):
+        return '(%s%s)' % (op, ''.join([format_filter(child, escape)
+                                        for child in node[1]]))
+    elif op == '!':
+        return '(!%s)' % format_filter(node[1], escape)
+    elif op == 'present':
+        return '(%s=*)' % node[1]
+    elif op == 'substring':
+        initial, middle, final = node[2]
+        bits = [initial is not None and escape(initial) or '']
+        bits.extend([escape(bit) for bit in middle])
+        bits.append(final is not None and escape(final) or '')
+        return '(%s=%s)' % (node[1], '*'.join(bits))
+    return '(%s%s%s)' % (node[1], op, escape(node[2]))
+
+
+def optimize_filter(node, selectivity=None):
+    """
+    Returns a parsed filter matching the same entries as `node`, with
+    nested ANDs and ORs flattened, and duplicate terms, terms matching
+    every entry and double negations removed. An AND holding both a term
+    and its negation becomes FALSE, and an OR nested in an AND which also
+    holds one of its terms is dropped, as is an AND nested in an OR.
+
+    The values of "in" lookups ANDed on the same attribute are not
+    intersected: attributes may hold several values, and be compared by
+    matching rules ignoring case, so that the AND can still match.
+
+    `selectivity` maps lowercase attribute names to the estimated fraction
+    of the entries an equality on the attribute matches, the terms of each
+    AND are then ordered from the most selective one.
+    """
+    op = node[0]
+    if op == '!':
+        child = optimize_filter(node[1], selectivity)
+        if child[0] == '!':
+            return child[1]
+        elif child == TRUE:
+            return FALSE
+        elif child == FALSE:
+            return TRUE
+        return ('!', child)
+    elif op == 'present':
+        # every entry has an object class
+        if node[1].lower() == 'objectclass':
+            return TRUE
+        return node
+    elif op not in ('&', '|'):
+        return node
+
+    absorbing = op == '&' and FALSE or TRUE
+    children = []
+    seen = set()
+    for child in node[1]:
+        child = optimize_filter(child, selectivity)
+        if child == absorbing:
+            return absorbing
+        if child[0] != op:
+            child = (op, (child,))
+        # an empty AND or OR is the neutral element and vanishes here
+        for term in child[1]:
+            if term not in seen:
+                seen.add(term)
+                children.append(term)
+
+    # absorption: (&(x=1)(|(x=1)(y=1))) is (x=1)
+    dual = op == '&' and '|' or '&'
+    terms = set(child for child in children if child[0] != dual)
+    children = [child for child in children
+                if child[0] != dual or not terms.intersection(child[1])]
+
+    if op == '&':
+        for child in children:
+            if child[0] == '!' and child[1] in seen:
+                return FALSE
+        if selectivity:
+            children.sort(key=lambda child: _selectivity(child, selectivity))
+    if len(children) == 1:
+        return children[0]
+    return (op, tuple(children))
+
+
+def _selectivity(node, selectivity):
+    # the estimated fraction of the entries matching a term
+    op = node[0]
+    if op == '&':
+        return min([_selectivity(child, selectivity) for child in node[1]])
+    elif op == '|':
+        return min(1.0, sum([_selectivity(child, selectivity)
+                             for child in node[1]]))
+    elif op in ('!', 'present'):
+        return 1.0
+    estimate = selectivity.get(node[1].lower(), 1.0)
+    if op == '=':
+        return estimate
+    # substrings and orderings match many more entries than equalities
+    return min(1.0, 10 * estimate)
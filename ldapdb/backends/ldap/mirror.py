@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+import threading
+import time
+
+import ldap
+import ldap.dn
+import ldap.filter
+
+try:
+    from ldap.syncrepl import SyncreplConsumer
+except ImportError:
+    # python-ldap < 2.4.15, or pyasn1 is missing
+    SyncreplConsumer = None
+
+from ldapdb.backends.ldap.cache import split_dn
+from ldapdb.backends.ldap.filters import (can_match_filter, get_matching_rule,
+                                          match_filter, parse_filter,
+                                          prepare_value)
+
+logger = logging.getLogger('ldapdb')
+
+
+def normalize_dn(dn):
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+
+
+class Mirror(object):
+    """
+    An in-memory copy of the entries matching `filterstr` in the `scope` of
+    `base`, holding their `attrlist` attributes, which answers searches
+    with equality indexes built on demand.
+
+    The copy is brought up to date by searching for the entries whose
+    `timestamp_attr` changed since the last update, and listing the DNs of
+    all the entries to notice deletions. This is done every `interval`
+    seconds from a background thread, or if `interval` is None when the
+    copy is searched. Searches are only answered while the last update is
+    less than `max_lag` seconds old.
+
+    `matching_rules` maps attribute names to the names of their equality
+    matching rules. Searches whose filter uses other attributes, or rules
+    which cannot be evaluated locally, are not answered.
+    """
+
+    def __init__(self, connect, base, scope, filterstr, attrlist,
+                 interval=30, max_lag=60, timestamp_attr='modifyTimestamp',
+                 charset='utf-8', matching_rules=None):
+        self.connect = connect
+        self.base = base
+        self.scope = scope
+        self.filterstr = filterstr
+        self.attrlist = list(attrlist)
+        self.matching_rules = dict((attr.lower(), rule) for attr, rule
+                                   in (matching_rules or {}).items())
+        self.interval = interval
+        self.max_lag = max_lag
+        self.timestamp_attr = timestamp_attr
+        self.charset = charset
+
+        # guards the entries and indexes
+        self._lock = threading.Lock()
+        # normalized DN -> (DN, attributes keyed by lowercase name)
+        self._entries = {}
+        # lowercase attribute name -> {value: set of normalized DNs}
+        self._indexes = {}
+        self._timestamp = None
+
+        self._sync_lock = threading.Lock()
+        self._connection = None
+        self._synced = None
+        self._due = False
+        self._closed = False
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def covers(self, dn):
+        """
+        Returns whether a write to the entry at `dn` can affect the copy.
+        """
+        return normalize_dn(self.base) in split_dn(dn)
+
+    @property
+    def fresh(self):
+        synced = self._synced
+        return synced is not None and time.time() - synced < self.max_lag
+
+    def search(self, filterstr, attrlist=None):
+        """
+        Returns the entries of the copy matching `filterstr`, with their
+        `attrlist` attributes, or None if the copy cannot be used.
+        """
+        if not self._up_to_date():
+            return None
+        if isinstance(filterstr, unicode):
+            filterstr = filterstr.encode(self.charset)
+        try:
+            node = parse_filter(filterstr)
+        except ValueError:
+            return None
+        if not can_match_filter(node, self.matching_rules):
+            return None
+
+        results = []
+        with self._lock:
+            keys = self._candidates(node)
+            if keys is None:
+                keys = self._entries.keys()
+            for key in keys:
+                dn, attrs = self._entries[key]
+                if match_filter(node, attrs, self.matching_rules):
+                    results.append((dn, self._project(attrs, attrlist)))
+        return results
+
+    def _up_to_date(self):
+        """
+        Returns whether the copy can answer searches, updating it first if
+        it is updated on demand.
+        """
+        if self.interval is None:
+            if self._due or not self.fresh:
+                try:
+                    self.sync()
+                except ldap.LDAPError as e:
+                    logger.warning("Could not update the copy of %s: %s" %
+                                   (self.base, e))
+                    return False
+            return True
+        # the background update has not caught up with our writes yet
+        return self.fresh and not self._due
+
+    def _project(self, attrs, attrlist):
+        if attrlist is None:
+            return dict(attrs)
+        return dict((name, attrs[name.lower()]) for name in attrlist
+                    if name.lower() in attrs)
+
+    def _candidates(self, node):
+        """
+        Returns the normalized DNs of the entries which can match the parsed
+        filter `node` according to the indexes, or None for all of them.
+        """
+        op = node[0]
+        if op == '=':
+            return self._index(node[1]).get(self._index_key(node[1], node[2]),
+                                            ())
+        elif op == '&':
+            best = None
+            for child in node[1]:
+                keys = self._candidates(child)
+                if keys is not None and (best is None or
+                                         len(keys) < len(best)):
+                    best = keys
+            return best
+        elif op == '|':
+            keys = set()
+            for child in node[1]:
+                child_keys = self._candidates(child)
+                if child_keys is None:
+                    return None
+                keys.update(child_keys)
+            return keys
+        return None
+
+    def _index_key(self, attr, value):
+        # values which are equal according to the matching rule of `attr`
+        # have the same key
+        return prepare_value(get_matching_rule(self.matching_rules, attr),
+                             value)
+
+    def _index(self, attr):
+        attr = attr.lower()
+        index = self._indexes.get(attr)
+        if index is None:
+            index = self._indexes[attr] = {}
+            for key, (dn, attrs) in self._entries.items():
+                for value in attrs.get(attr, []):
+                    index.setdefault(self._index_key(attr, value),
+                                     set()).add(key)
+        return index
+
+    def _put(self, dn, attrs):
+        """
+        Stores the entry at `dn`, replacing any previous version, and
+        returns its normalized DN. Must be called with the lock held.
+        """
+        key = normalize_dn(dn.encode(self.charset))
+        self._remove(key)
+        attrs = dict((name.lower(), values) for name, values in attrs.items())
+        self._entries[key] = (dn, attrs)
+        for attr, index in self._indexes.items():
+            for value in attrs.get(attr, []):
+                index.setdefault(self._index_key(attr, value),
+                                 set()).add(key)
+        for value in attrs.get(self.timestamp_attr.lower(), []):
+            self._timestamp = max(self._timestamp, value)
+        return key
+
+    def _remove(self, key):
+        """
+        Removes the entry whose normalized DN is `key`, if any. Must be
+        called with the lock held.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for attr, index in self._indexes.items():
+            for value in entry[1].get(attr, []):
+                index_key = self._index_key(attr, value)
+                keys = index.get(index_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[index_key]
+
+    def start(self):
+        """
+        Starts updating the copy in the background, unless it is updated
+        when searched.
+        """
+        if self.interval is not None:
+            self._start_thread()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.clear()
+            try:
+                self.sync()
+            except ldap.LDAPError:
+                # searches go to the server until the next update succeeds
+                pass
+            self._wakeup.wait(self.interval)
+
+    def wake(self):
+        """
+        Signals that entries of the copy were modified, so that it is
+        updated as soon as possible.
+        """
+        self._due = True
+        self._wakeup.set()
+
+    def close(self):
+        """
+        Stops updating the copy and closes its connection.
+        """
+        self._closed = True
+        self._wakeup.set()
+        with self._sync_lock:
+            if self._connection is not None:
+                self._connection.unbind_s()
+                self._connection = None
+
+    def sync(self):
+        """
+        Brings the copy up to date.
+        """
+        with self._sync_lock:
+            started = time.time()
+            self._due = False
+            try:
+                if self._connection is None:
+                    self._connection = self.connect()
+                if self._synced is None or self._timestamp is None:
+                    self._load()
+                else:
+                    self._poll()
+            except ldap.LDAPError:
+                self._due = True
+                if self._connection is not None:
+                    self._connection.unbind_s()
+                    self._connection = None
+                raise
+            self._synced = started
+
+    def _search(self, filterstr, attrlist):
+        try:
+            results = self._connection.search_s(self.base, self.scope,
+                                                filterstr, attrlist)
+        except ldap.NO_SUCH_OBJECT:
+            return []
+        # skip referrals
+        return [(dn.decode(self.charset), attrs) for dn, attrs in results
+                if dn is not None]
+
+    def _load(self):
+        entries = self._search(self.filterstr,
+                               self.attrlist + [self.timestamp_attr])
+        with self._lock:
+            self._entries = {}
+            self._indexes = {}
+            self._timestamp = None
+            for dn, attrs in entries:
+                self._put(dn, attrs)
+
+    def _poll(self):
+        # the timestamps may have a resolution of one second, so the last
+        # modified entries are fetched again
+        changed = self._search(
+            '(&%s(%s>=%s))' % (self.filterstr, self.timestamp_attr,
+                               ldap.filter.escape_filter_chars(
+                                   self._timestamp)),
+            self.attrlist + [self.timestamp_attr])
+        # "1.1" requests no attributes at all (RFC 4511)
+        present = set(normalize_dn(dn.encode(self.charset))
+                      for dn, attrs in self._search(self.filterstr, ['1.1']))
+        with self._lock:
+            for dn, attrs in changed:
+                self._put(dn, attrs)
+            for key in set(self._entries) - present:
+                self._remove(key)
+            missing = present - set(self._entries)
+        if missing:
+            # renamed entries may keep their timestamp
+            self._load()
+
+
+class SyncreplMirror(Mirror):
+    """
+    A mirror updated by a Content Synchronization search (RFC 4533) in
+    refreshAndPersist mode, through which the server sends the changes as
+    they happen. If the search fails, it is resumed `interval` seconds
+    later, and searches go to the server until it has caught up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SyncreplMirror, self).__init__(*args, **kwargs)
+        self._cookie = None
+        # entryUUID -> normalized DN
+        self._uuids = {}
+        # the entryUUIDs reported as present during a refresh
+        self._present = None
+        self._persisting = False
+
+    @property
+    def fresh(self):
+        return self._persisting
+
+    def _up_to_date(self):
+        # the server sends the changes, the copy is never synced on demand
+        return self._persisting
+
+    def start(self):
+        self._start_thread()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self._persist()
+            except ldap.LDAPError:
+                pass
+            self._persisting = False
+            connection, self._connection = self._connection, None
+            if connection is not None:
+                try:
+                    connection.unbind_s()
+                except ldap.LDAPError:
+                    pass
+            self._wakeup.wait(self.interval or 30)
+
+    def _persist(self):
+        self._connection = self.connect()
+        handler = SyncreplHandler(self, self._connection)
+        self._present = set()
+        msgid = handler.syncrepl_search(self.base, self.scope,
+                                        mode='refreshAndPersist',
+                                        filterstr=self.filterstr,
+                                        attrlist=self.attrlist)
+        while not self._closed:
+            try:
+                if not handler.syncrepl_poll(msgid=msgid, timeout=1):
+                    break
+            except ldap.TIMEOUT:
+                # check whether the mirror was closed
+                continue
+
+    def wake(self):
+        # the server sends the changes
+        pass
+
+    def close(self):
+        # the connection is closed by the background thread
+        self._closed = True
+        self._wakeup.set()
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        with self._lock:
+            key = self._uuids.get(uuid)
+            if key is not None:
+                # the entry may have been renamed
+                self._remove(key)
+            self._uuids[uuid] = self._put(dn.decode(self.charset), attrs)
+        if self._present is not None:
+            self._present.add(uuid)
+
+    def syncrepl_delete(self, uuids):
+        with self._lock:
+            for uuid in uuids:
+                key = self._uuids.pop(uuid, None)
+                if key is not None:
+                    self._remove(key)
+
+    def syncrepl_present(self, uuids, refresh_deletes=False):
+        if uuids is None:
+            if not refresh_deletes and self._present is not None:
+                # the entries which were not reported are gone
+                self.syncrepl_delete([uuid for uuid in list(self._uuids)
+                                      if uuid not in self._present])
+                self._present = set()
+        elif refresh_deletes:
+            self.syncrepl_delete(uuids)
+        elif self._present is not None:
+            self._present.update(uuids)
+
+    def syncrepl_refreshdone(self):
+        self._present = None
+        self._persisting = True
+
+
+if SyncreplConsumer is not None:
+    class SyncreplHandler(SyncreplConsumer):
+        """
+        Applies the messages of a Content Synchronization search performed
+        on `connection` to `mirror`.
+        """
+
+        def __init__(self, mirror, connection):
+            self.mirror = mirror
+            self.connection = connection
+
+        def __getattr__(self, name):
+            # search_ext(), result4() and others
+            return getattr(self.connection, name)
+
+        def syncrepl_get_cookie(self):
+            return self.mirror._cookie
+
+        def syncrepl_set_cookie(self, cookie):
+            self.mirror._cookie = cookie
+
+        def syncrepl_entry(self, dn, attributes, uuid):
+            self.mirror.syncrepl_entry(dn, attributes, uuid)
+
+        def syncrepl_delete(self, uuids):
+            self.mirror.syncrepl_delete(uuids)
+
+        def syncrepl_present(self, uuids, refreshDeletes=False):
+            self.mirror.syncrepl_present(uuids, refreshDeletes)
+
+        def syncrepl_refreshdone(self):
+            self.mirror.syncrepl_refreshdone()
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(key, factory):
+    """
+    Returns the process-wide mirror registered under `key`, creating it
+    with `factory` on first use.
+    """
+    with _mirrors_lock:
+        mirror = _mirrors.get(key)
+        if mirror is None:
+            mirror = _mirrors[key] = factory()
+        return mirror
+
+
+def wake_mirrors(alias, dns):
+    """
+    Signals the writes to the entries at `dns` to the mirrors of the
+    database `alias`.
+    """
+    with _mirrors_lock:
+        mirrors = [mirror for key, mirror in _mirrors.items()
+                   if key[0] == alias]
+    for mirror in mirrors:
+        if any(mirror.covers(dn) for dn in dns):
+            mirror.wake()
+
+
+def close_mirrors():
+    """
+    Closes and forgets all the process-wide mirrors.
+    """
+    with _mirrors_lock:
+        for mirror in _mirrors.values():
+            mirror.close()
+        _mirrors.clear()
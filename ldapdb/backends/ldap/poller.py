@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import Queue
+import select
+import threading
+
+import ldap
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        # python 2
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+class Poller(threading.Thread):
+    """
+    A thread which multiplexes asynchronous LDAP operations over a handful
+    of connections, opened lazily using the `connect` callable.
+
+    Operations are submitted from any thread along with a callback, which
+    is invoked from the poller thread as callback(result, error).
+    """
+
+    def __init__(self, connect, max_connections=2):
+        super(Poller, self).__init__()
+        self.daemon = True
+        self.connect = connect
+        self.max_connections = max_connections
+
+        self._queue = Queue.Queue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._connections = []
+        self._next_connection = 0
+        # (connection, msgid) -> (callback, entries)
+        self._pending = {}
+        self._closed = False
+
+    def submit(self, method, args, callback):
+        """
+        Queues a call to the asynchronous LDAPObject method `method`, for
+        instance 'search_ext' or 'add_ext'.
+
+        Searches report the list of entries and the response controls as an
+        (entries, controls) tuple, other operations the result type and
+        data.
+        """
+        self._queue.put((method, args, callback))
+        os.write(self._wakeup_w, b'x')
+
+    def close(self):
+        """
+        Stops the thread and closes its connections. The operations which
+        are still queued or in flight fail with ldap.SERVER_DOWN.
+        """
+        self._closed = True
+        os.write(self._wakeup_w, b'x')
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self._closed:
+            fds = [self._wakeup_r] + [c.fileno() for c in self._connections]
+            # responses may already have been buffered by libldap while
+            # reading another one, so do not wait forever on the sockets
+            timeout = self._pending and 0.05 or None
+            readable = select.select(fds, [], [], timeout)[0]
+            if self._wakeup_r in readable:
+                os.read(self._wakeup_r, 4096)
+            self._send()
+            self._receive()
+
+        error = ldap.SERVER_DOWN({'desc': 'The poller was closed'})
+        callbacks = [callback for callback, entries
+                     in self._pending.values()]
+        self._pending.clear()
+        while True:
+            try:
+                callbacks.append(self._queue.get_nowait()[2])
+            except Queue.Empty:
+                break
+        for callback in callbacks:
+            callback(None, error)
+        for connection in self._connections:
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                pass
+        self._connections = []
+
+    def _send(self):
+        while True:
+            try:
+                method, args, callback = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                connection = self._get_connection()
+                msgid = getattr(connection, method)(*args)
+            except ldap.LDAPError as e:
+                callback(None, e)
+                continue
+            self._pending[connection, msgid] = (callback, [])
+
+    def _receive(self):
+        for key in list(self._pending.keys()):
+            connection, msgid = key
+            callback, entries = self._pending[key]
+            try:
+                while True:
+                    rtype, rdata, rmsgid, rctrls = connection.result3(
+                        msgid, all=0, timeout=0)
+                    if rtype is None:
+                        # no response yet
+                        break
+                    elif rtype in (ldap.RES_SEARCH_ENTRY,
+                                   ldap.RES_SEARCH_REFERENCE):
+                        entries.extend(rdata)
+                        continue
+                    del self._pending[key]
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        callback((entries, rctrls), None)
+                    else:
+                        callback((rtype, rdata), None)
+                    break
+            except ldap.LDAPError as e:
+                del self._pending[key]
+                if isinstance(e, (ldap.SERVER_DOWN, ldap.CONNECT_ERROR)) \
+                        and connection in self._connections:
+                    self._connections.remove(connection)
+                callback(None, e)
+
+    def _get_connection(self):
+        if len(self._connections) < self.max_connections:
+            self._connections.append(self.connect())
+        self._next_connection = \
+            (self._next_connection + 1) % len(self._connections)
+        return self._connections[self._next_connection]
+
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+
+def get_poller(key, factory):
+    """
+    Returns the process-wide poller registered under `key`, creating and
+    starting it with `factory` on first use.
+    """
+    with _pollers_lock:
+        poller = _pollers.get(key)
+        if poller is None:
+            poller = _pollers[key] = factory()
+            poller.start()
+        return poller
+
+
+def close_pollers():
+    """
+    Stops and forgets all the process-wide pollers.
+    """
+    with _pollers_lock:
+        pollers = list(_pollers.values())
+        _pollers.clear()
+    for poller in pollers:
+        poller.close()
+
+
+def submit_async(poller, method, args, transform=None):
+    """
+    Submits an operation to `poller` and returns a future for its result,
+    bound to the current event loop. If given, `transform` is applied to
+    the result before resolving the future.
+    """
+    future = create_future()
+    loop = asyncio.get_event_loop()
+
+    def resolve(result, error):
+        if future.cancelled():
+            return
+        if error is None and transform is not None:
+            try:
+                result = transform(result)
+            except Exception as e:
+                error = e
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def callback(result, error):
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            # the event loop was closed, nobody awaits the result anymore,
+            # and raising would stop the poller thread
+            pass
+
+    poller.submit(method, args, callback)
+    return future
+
+
+def create_future():
+    """
+    Returns a new future bound to the current event loop.
+    """
+    if asyncio is None:
+        raise ImportError('Asynchronous operations require asyncio, or '
+                          'trollius on Python 2')
+    return asyncio.Future(loop=asyncio.get_event_loop())
+
+
+def chain(future, func, errback=None):
+    """
+    Returns a future resolving to func(result) once `future` is done. If
+    func returns a future itself, its result is used instead.
+
+    If given, errback(exception) is called when `future` fails and its
+    return value is used as the result.
+    """
+    chained = create_future()
+
+    def resolve(value):
+        if chained.cancelled():
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(propagate)
+        else:
+            chained.set_result(value)
+
+    def propagate(done):
+        if chained.cancelled():
+            return
+        if done.cancelled():
+            chained.cancel()
+            return
+        try:
+            if done is not future:
+                value = done.result()
+            elif done.exception() is not None:
+                if errback is None:
+                    raise done.exception()
+                value = errback(done.exception())
+            else:
+                value = func(done.result())
+        except Exception as e:
+            chained.set_exception(e)
+        else:
+            resolve(value)
+
+    future.add_done_callback(propagate)
+    return chained
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import collections
+import threading
+import time
+
+import ldap
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of bound LDAP connections.
+
+    Connections are opened using the `connect` callable, handed out by
+    acquire() and given back with release(). `min_size` of them are opened
+    upfront and reopened whenever the pool shrinks below that size, other
+    ones only when needed. Idle connections are closed after
+    `idle_timeout` seconds (while keeping at least `min_size` of them), and
+    any connection is retired once it is older than `max_lifetime`
+    seconds.
+    """
+
+    def __init__(self, connect, min_size=0, max_size=10, idle_timeout=None,
+                 max_lifetime=None, health_check_interval=None,
+                 timeout=None):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._created = {}
+        self._opening = 0
+        self._fill()
+
+    def acquire(self, block=True):
+        """
+        Returns a bound connection, opening a new one if needed.
+
+        If `block` is false and the pool is exhausted, returns None instead
+        of waiting for a connection to be released.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+
+        while True:
+            with self._condition:
+                while True:
+                    self._prune()
+                    if self._idle:
+                        connection, last_used = self._idle.pop()
+                        break
+                    if len(self._created) + self._opening < self.max_size:
+                        connection, last_used = None, None
+                        self._opening += 1
+                        break
+                    if not block:
+                        return None
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise ldap.TIMEOUT({
+                                'desc': 'Timed out waiting for a pooled '
+                                        'LDAP connection'})
+                    self._condition.wait(remaining)
+
+            if connection is None:
+                return self._open()
+
+            if self._is_alive(connection, last_used):
+                return connection
+            self.discard(connection)
+
+    def release(self, connection):
+        """
+        Gives a connection back to the pool.
+        """
+        now = time.time()
+        with self._condition:
+            created = self._created.get(id(connection))
+            if created is None:
+                return
+            if self.max_lifetime is not None and \
+                    now - created >= self.max_lifetime:
+                del self._created[id(connection)]
+                self._unbind(connection)
+                retired = True
+            else:
+                self._idle.append((connection, now))
+                retired = False
+            self._condition.notify()
+        if retired:
+            self._fill()
+
+    def discard(self, connection):
+        """
+        Closes a connection which should not be reused, for instance after
+        the server went away, and opens a new one if the pool fell below
+        `min_size` connections.
+        """
+        with self._condition:
+            self._created.pop(id(connection), None)
+            self._condition.notify()
+        self._unbind(connection)
+        self._fill()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._condition:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                self._created.pop(id(connection), None)
+                self._unbind(connection)
+            self._condition.notify_all()
+
+    def _fill(self):
+        """
+        Opens idle connections until the pool holds `min_size` of them. A
+        server which cannot be reached is not an error, the connections are
+        opened again on demand.
+        """
+        while True:
+            with self._condition:
+                if len(self._created) + self._opening >= self.min_size:
+                    return
+                self._opening += 1
+            try:
+                connection = self._open()
+            except ldap.LDAPError:
+                return
+            self.release(connection)
+
+    def _open(self):
+        try:
+            connection = self.connect()
+        except:
+            with self._condition:
+                self._opening -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._opening -= 1
+            self._created[id(connection)] = time.time()
+        return connection
+
+    def _prune(self):
+        # must be called with the condition held
+        now = time.time()
+        keep = collections.deque()
+        while self._idle:
+            connection, last_used = self._idle.popleft()
+            created = self._created[id(connection)]
+            expired = (self.max_lifetime is not None and
+                       now - created >= self.max_lifetime)
+            stale = (self.idle_timeout is not None and
+                     now - last_used >= self.idle_timeout and
+                     len(keep) + len(self._idle) >= self.min_size)
+            if expired or stale:
+                del self._created[id(connection)]
+                self._unbind(connection)
+            else:
+                keep.append((connection, last_used))
+        self._idle = keep
+
+    def _is_alive(self, connection, last_used):
+        if self.health_check_interval is None or \
+                time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            # reading the root DSE is about the cheapest request there is
+            connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                ['1.1'])
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+            return False
+        except ldap.LDAPError:
+            # the server answered, which is all we wanted to know
+            pass
+        return True
+
+    def _unbind(self, connection):
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory):
+    """
+    Returns the process-wide pool registered under `key`, creating it with
+    `factory` on first use.
+    """
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = factory()
+        return pool
+
+
+def close_pools():
+    """
+    Closes and forgets all the process-wide pools.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -31,3 +31,4 @@
 #
 
 from ldapdb.models.base import Model  # noqa
+from ldapdb.models.manager import Manager  # noqa
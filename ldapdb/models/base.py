@@ -31,6 +31,8 @@
 #
 
 import ldap
+import ldap.controls
+import ldap.filter
 import logging
 
 import django.db.models
@@ -38,6 +40,11 @@ from django.db import connections, router
 from django.db.models import signals
 
 import ldapdb  # noqa
+from ldapdb.backends.ldap.base import PERMISSIVE_MODIFY_OID
+from ldapdb.backends.ldap.poller import chain, create_future
+from ldapdb.models.fields import ListField
+from ldapdb.models.identity import get_identity_map
+from ldapdb.models.manager import Manager
 
 
 logger = logging.getLogger('ldapdb')
@@ -54,9 +61,46 @@ class Model(django.db.models.base.Model):
     search_scope = ldap.SCOPE_SUBTREE
     object_classes = ['top']
 
+    # no two entries below base_dn share an RDN, so that primary key
+    # lookups can read the entry at the DN built from the key even when
+    # searching the whole subtree
+    unique_rdns = False
+
+    # refuse to save if the changed attributes were modified by someone
+    # else since the entry was loaded
+    strict_save = False
+
+    # answer querysets from a local copy of the entries kept up to date in
+    # the background, if the LOCAL_MIRROR database setting is enabled
+    local_mirror = False
+
+    objects = Manager()
+
     def __init__(self, *args, **kwargs):
         super(Model, self).__init__(*args, **kwargs)
         self.saved_pk = self.pk
+        self._saved_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # django >= 1.8
+        instance = super(Model, cls).from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def _snapshot(self):
+        """
+        Remembers the values of the loaded fields, against which the changes
+        to save are computed.
+        """
+        self._saved_values = {}
+        for field in self._meta.fields:
+            # skip deferred fields
+            if field.db_column and field.attname in self.__dict__:
+                value = self.__dict__[field.attname]
+                if isinstance(value, list):
+                    value = list(value)
+                self._saved_values[field.attname] = value
 
     def build_rdn(self):
         """
@@ -86,30 +130,207 @@ class Model(django.db.models.base.Model):
         connection = connections[using]
         logger.debug("Deleting LDAP entry %s" % self.dn)
         connection.delete_s(self.dn)
-        signals.post_delete.send(sender=self.__class__, instance=self)
+        self._forget(using)
+        signals.post_delete.send(sender=self._signal_sender(), instance=self)
+
+    def adelete(self, using=None):
+        """
+        Asynchronous version of delete(), returning a future.
+        """
+        using = using or router.db_for_write(self.__class__, instance=self)
+        connection = connections[using]
+        logger.debug("Deleting LDAP entry %s" % self.dn)
+
+        def deleted(result):
+            self._forget(using)
+            signals.post_delete.send(sender=self._signal_sender(),
+                                     instance=self)
+
+        return chain(connection.delete(self.dn), deleted)
+
+    def _build_entry(self, connection):
+        """
+        Returns the attributes of a new entry for the current instance.
+        """
+        entry = [('objectClass', self.object_classes)]
+        for field in self._meta.fields:
+            if not field.db_column:
+                continue
+            value = getattr(self, field.name)
+            value = field.get_db_prep_save(value, connection=connection)
+            if value:
+                entry.append((field.db_column, value))
+        return entry
+
+    def _build_modlist(self, saved_values, connection):
+        """
+        Returns the modifications turning the entry with the given field
+        values into the current instance.
+        """
+        modlist = []
+        for field in self._meta.fields:
+            # skip deferred fields which were not set
+            if not field.db_column or field.attname not in self.__dict__:
+                continue
+            old_value = saved_values.get(field.attname)
+            new_value = getattr(self, field.name, None)
+            if old_value != new_value:
+                if isinstance(field, ListField) and old_value and new_value:
+                    delta = self._build_list_delta(field, old_value,
+                                                   new_value, connection)
+                    if delta is not None:
+                        modlist.extend(delta)
+                        continue
+                new_value = field.get_db_prep_save(new_value, 
+                                    connection=connection)
+                if new_value:
+                    modlist.append((ldap.MOD_REPLACE, field.db_column, 
+                                    new_value))
+                elif old_value:
+                    modlist.append((ldap.MOD_DELETE, field.db_column,
+                                    None))
+        return modlist
+
+    def _build_list_delta(self, field, old_value, new_value, connection):
+        """
+        Returns the modifications adding and removing the values which
+        differ between two lists, or None if replacing the whole list is
+        cheaper.
+        """
+        if not connection.features.supports_permissive_modify:
+            # the values may have been added or removed concurrently, which
+            # would make the modification fail
+            return None
+
+        old_set = set(old_value)
+        new_set = set(new_value)
+        added = []
+        for value in new_value:
+            if value not in old_set and value not in added:
+                added.append(value)
+        removed = [value for value in old_value if value not in new_set]
+        if len(added) + len(removed) >= len(new_set):
+            return None
+
+        # the values of an attribute are not ordered, so reordering the
+        # list leaves nothing to do
+        delta = []
+        if removed:
+            delta.append((ldap.MOD_DELETE, field.db_column,
+                          field.get_db_prep_save(removed,
+                                                 connection=connection)))
+        if added:
+            delta.append((ldap.MOD_ADD, field.db_column,
+                          field.get_db_prep_save(added,
+                                                 connection=connection)))
+        return delta
+
+    def _delta_controls(self, modlist):
+        """
+        Returns the request controls for the values added to or removed
+        from multi-valued attributes by `modlist`: the Permissive Modify
+        control, so that values already present or absent are not errors.
+        """
+        for op, column, values in modlist:
+            if op == ldap.MOD_ADD or (op == ldap.MOD_DELETE and values):
+                return [ldap.controls.LDAPControl(PERMISSIVE_MODIFY_OID,
+                                                  True, None)]
+        return []
+
+    def _conflict_controls(self, modlist, connection):
+        """
+        Returns the request controls making the server reject `modlist` if
+        the modified attributes no longer hold the loaded values, or None
+        if the server does not support the Assertion control (RFC 4528).
+
+        The assertion only checks that the loaded values are still present,
+        values added concurrently to a multi-valued attribute go unnoticed.
+        """
+        if not connection.features.supports_assertion:
+            return None
+        bits = []
+        for field in self._conflicting_fields(modlist):
+            saved_value = self._saved_values.get(field.attname)
+            values = field.get_db_prep_save(saved_value,
+                                            connection=connection)
+            absent = '(!(%s=*))' % field.db_column
+            if not values:
+                bits.append(absent)
+                continue
+            bit = ''.join(['(%s=%s)' % (field.db_column,
+                                        ldap.filter.escape_filter_chars(v))
+                           for v in values])
+            if saved_value == field.from_ldap([], connection=connection):
+                # the value was possibly loaded from a missing attribute
+                bit = '(|(&%s)%s)' % (bit, absent)
+            bits.append(bit)
+        return [ldap.controls.AssertionControl(True,
+                                               '(&%s)' % ''.join(bits))]
+
+    def _conflicting_fields(self, modlist):
+        columns = set(column for op, column, value in modlist)
+        return [f for f in self._meta.fields if f.db_column in columns]
+
+    def _check_conflicts(self, modlist, attrs, connection):
+        """
+        Raises ldap.ASSERTION_FAILED if the attributes about to be modified,
+        as read again in `attrs`, no longer hold the loaded values.
+
+        This is only a best-effort check for servers which do not support
+        the Assertion control, as the entry can still be modified between
+        the read and the modification.
+        """
+        for field in self._conflicting_fields(modlist):
+            value = field.from_ldap(attrs.get(field.db_column, []),
+                                    connection=connection)
+            if value != self._saved_values.get(field.attname):
+                raise ldap.ASSERTION_FAILED({
+                    'desc': 'LDAP entry %s was modified concurrently' %
+                            self.dn,
+                    'info': field.db_column})
+
+    def _signal_sender(self):
+        """
+        Returns the model signals are sent for, which is the proxied model
+        for lazily decoded or deferred instances.
+        """
+        if self._deferred:
+            return self._meta.proxy_for_model
+        return self.__class__
+
+    def _forget(self, using):
+        """
+        Drops the current instance from the active identity map, before
+        its DN changes or once its entry is deleted.
+        """
+        identities = get_identity_map()
+        if identities is not None:
+            identities.discard(using, self.dn)
+
+    def _saved(self, created, using):
+        self.saved_pk = self.pk
+        self._state.db = using
+        self._snapshot()
+        identities = get_identity_map()
+        if identities is not None:
+            identities.add(self)
+        signals.post_save.send(sender=self._signal_sender(), instance=self,
+                               created=created)
 
     def save(self, using=None):
         """
         Saves the current instance.
         """
-        signals.pre_save.send(sender=self.__class__, instance=self)
+        signals.pre_save.send(sender=self._signal_sender(), instance=self)
         
         using = using or router.db_for_write(self.__class__, instance=self)
         connection = connections[using]
         if not self.dn:
             # create a new entry
             record_exists = False
-            entry = [('objectClass', self.object_classes)]
+            entry = self._build_entry(connection)
             new_dn = self.build_dn()
 
-            for field in self._meta.fields:
-                if not field.db_column:
-                    continue
-                value = getattr(self, field.name)
-                value = field.get_db_prep_save(value, connection=connection)
-                if value:
-                    entry.append((field.db_column, value))
-
             logger.debug("Creating new LDAP entry %s" % new_dn)
             connection.add_s(new_dn, entry)
 
@@ -119,42 +340,134 @@ class Model(django.db.models.base.Model):
         else:
             # update an existing entry
             record_exists = True
-            modlist = []
-            orig = self.__class__.objects.using(using).get(pk=self.saved_pk)
-            for field in self._meta.fields:
-                if not field.db_column:
-                    continue
-                old_value = getattr(orig, field.name, None)
-                new_value = getattr(self, field.name, None)
-                if old_value != new_value:
-                    new_value = field.get_db_prep_save(new_value, 
-                                        connection=connection)
-                    if new_value:
-                        modlist.append((ldap.MOD_REPLACE, field.db_column, 
-                                        new_value))
-                    elif old_value:
-                        modlist.append((ldap.MOD_DELETE, field.db_column,
-                                        None))
+            if self._saved_values is None:
+                # the instance was not loaded from the directory
+                orig = self.__class__.objects.using(using).get(
+                    pk=self.saved_pk)
+                orig._snapshot()
+                self._saved_values = orig._saved_values
+            modlist = self._build_modlist(self._saved_values, connection)
 
             if len(modlist):
+                serverctrls = None
+                if self.strict_save:
+                    serverctrls = self._conflict_controls(modlist,
+                                                          connection)
+                    if serverctrls is None:
+                        fields = self._conflicting_fields(modlist)
+                        try:
+                            attrs = connection.read_s(
+                                self.dn, [f.db_column for f in fields])
+                        except ldap.NO_SUCH_OBJECT:
+                            raise self.DoesNotExist(
+                                "LDAP entry %s no longer exists" % self.dn)
+                        self._check_conflicts(modlist, attrs, connection)
+
                 # handle renaming
                 new_dn = self.build_dn()
                 if new_dn != self.dn:
                     logger.debug("Renaming LDAP entry %s to %s" % (self.dn,
                                                                    new_dn))
                     connection.rename_s(self.dn, self.build_rdn())
+                    self._forget(using)
                     self.dn = new_dn
 
                 logger.debug("Modifying existing LDAP entry %s" % self.dn)
-                connection.modify_s(self.dn, modlist)
+                serverctrls = (serverctrls or []) + \
+                    self._delta_controls(modlist)
+                connection.modify_s(self.dn, modlist, serverctrls or None)
             else:
                 logger.debug("No changes to be saved to LDAP entry %s" %
                              self.dn)
 
         # done
-        self.saved_pk = self.pk
-        signals.post_save.send(sender=self.__class__, instance=self,
-                               created=(not record_exists))
+        self._saved(created=(not record_exists), using=using)
+
+    def asave(self, using=None):
+        """
+        Asynchronous version of save(), returning a future.
+        """
+        signals.pre_save.send(sender=self._signal_sender(), instance=self)
+
+        using = using or router.db_for_write(self.__class__, instance=self)
+        connection = connections[using]
+        if not self.dn:
+            # create a new entry
+            entry = self._build_entry(connection)
+            new_dn = self.build_dn()
+
+            def created(result):
+                self.dn = new_dn
+                self._saved(created=True, using=using)
+
+            logger.debug("Creating new LDAP entry %s" % new_dn)
+            return chain(connection.add(new_dn, entry), created)
+
+        def modified(result):
+            self._saved(created=False, using=using)
+
+        def modify(orig):
+            if orig is not None:
+                orig._snapshot()
+                self._saved_values = orig._saved_values
+            modlist = self._build_modlist(self._saved_values, connection)
+            if not len(modlist):
+                logger.debug("No changes to be saved to LDAP entry %s" %
+                             self.dn)
+                return modified(None)
+
+            def renamed(result, serverctrls):
+                if new_dn != self.dn:
+                    self._forget(using)
+                self.dn = new_dn
+                logger.debug("Modifying existing LDAP entry %s" % self.dn)
+                serverctrls = (serverctrls or []) + \
+                    self._delta_controls(modlist)
+                return chain(connection.modify(self.dn, modlist,
+                                               serverctrls or None),
+                             modified)
+
+            def checked(serverctrls):
+                # handle renaming
+                if new_dn != self.dn:
+                    logger.debug("Renaming LDAP entry %s to %s" % (self.dn,
+                                                                   new_dn))
+                    return chain(connection.rename(self.dn, self.build_rdn()),
+                                 lambda result: renamed(result, serverctrls))
+                return renamed(None, serverctrls)
+
+            def reread(entries):
+                self._check_conflicts(modlist, entries[0][1], connection)
+                return checked(None)
+
+            def missing(e):
+                if isinstance(e, ldap.NO_SUCH_OBJECT):
+                    raise self.DoesNotExist("LDAP entry %s no longer exists" %
+                                            self.dn)
+                raise e
+
+            new_dn = self.build_dn()
+            if not self.strict_save:
+                return checked(None)
+            serverctrls = self._conflict_controls(modlist, connection)
+            if serverctrls is not None:
+                return checked(serverctrls)
+            # read the entry again without blocking the event loop
+            fields = self._conflicting_fields(modlist)
+            return chain(connection.search(self.dn.encode(connection.charset),
+                                           ldap.SCOPE_BASE, '(objectClass=*)',
+                                           [f.db_column for f in fields]),
+                         reread, missing)
+
+        # update an existing entry
+        if self._saved_values is None:
+            # the instance was not loaded from the directory
+            future = self.__class__.objects.using(using).aget(
+                pk=self.saved_pk)
+        else:
+            future = create_future()
+            future.set_result(None)
+        return chain(future, modify)
 
     @classmethod
     def scoped(base_class, base_dn):
@@ -175,3 +488,12 @@ class Model(django.db.models.base.Model):
 
     class Meta:
         abstract = True
+
+
+def prepare_model(sender, **kwargs):
+    if issubclass(sender, Model):
+        # the filter on the object classes starts every search
+        sender._object_class_filter = ''.join(
+            ['(objectClass=%s)' % cls for cls in sender.object_classes])
+
+signals.class_prepared.connect(prepare_model)
@@ -36,18 +36,48 @@ from ldapdb import escape_ldap_filter
 
 import datetime
 
+ISO8601_DATE_FORMAT = '%Y-%m-%d'
+
+
+class MatchingRulesMixin(object):
+    """
+    Declares the equality and ordering matching rules of the field's LDAP
+    attribute, which default to those of the field class and can be given
+    as the `equality_rule` and `ordering_rule` arguments. A rule of None
+    means the attribute is never compared locally, or sorted by the
+    server, respectively.
+    """
+    equality_rule = None
+    ordering_rule = None
+
+    def __init__(self, *args, **kwargs):
+        if 'equality_rule' in kwargs:
+            self.equality_rule = kwargs.pop('equality_rule')
+        if 'ordering_rule' in kwargs:
+            self.ordering_rule = kwargs.pop('ordering_rule')
+        super(MatchingRulesMixin, self).__init__(*args, **kwargs)
+
+
+class CharField(MatchingRulesMixin, fields.CharField):
+    equality_rule = 'caseIgnoreMatch'
+    ordering_rule = 'caseIgnoreOrderingMatch'
 
-class CharField(fields.CharField):
     def __init__(self, *args, **kwargs):
         defaults = {'max_length': 200}
         defaults.update(kwargs)
         super(CharField, self).__init__(*args, **defaults)
 
     def from_ldap(self, value, connection):
-        if len(value) == 0:
-            return ''
-        else:
-            return value[0].decode(connection.charset)
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        charset = connection.charset
+
+        def decode(value):
+            if not value:
+                return ''
+            return value[0].decode(charset)
+        return decode
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
@@ -88,10 +118,14 @@ class CharField(fields.CharField):
 
 class ImageField(fields.Field):
     def from_ldap(self, value, connection):
-        if len(value) == 0:
-            return ''
-        else:
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        def decode(value):
+            if not value:
+                return ''
             return value[0]
+        return decode
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
@@ -108,12 +142,19 @@ class ImageField(fields.Field):
         raise TypeError("ImageField has invalid lookup: %s" % lookup_type)
 
 
-class IntegerField(fields.IntegerField):
+class IntegerField(MatchingRulesMixin, fields.IntegerField):
+    equality_rule = 'integerMatch'
+    ordering_rule = 'integerOrderingMatch'
+
     def from_ldap(self, value, connection):
-        if len(value) == 0:
-            return 0
-        else:
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        def decode(value):
+            if not value:
+                return 0
             return int(value[0])
+        return decode
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
@@ -132,12 +173,16 @@ class IntegerField(fields.IntegerField):
         raise TypeError("IntegerField has invalid lookup: %s" % lookup_type)
 
 
-class FloatField(fields.FloatField):
+class FloatField(MatchingRulesMixin, fields.FloatField):
     def from_ldap(self, value, connection):
-        if len(value) == 0:
-            return 0.0
-        else:
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        def decode(value):
+            if not value:
+                return 0.0
             return float(value[0])
+        return decode
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
@@ -156,11 +201,18 @@ class FloatField(fields.FloatField):
         raise TypeError("FloatField has invalid lookup: %s" % lookup_type)
 
 
-class ListField(fields.Field):
+class ListField(MatchingRulesMixin, fields.Field):
     __metaclass__ = SubfieldBase
 
     def from_ldap(self, value, connection):
-        return [x.decode(connection.charset) for x in value]
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        charset = connection.charset
+
+        def decode(value):
+            return [x.decode(charset) for x in value]
+        return decode
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
@@ -184,7 +236,7 @@ class ListField(fields.Field):
         return value
 
 
-class DateField(fields.DateField):
+class DateField(MatchingRulesMixin, fields.DateField):
     """
     A text field containing date, in specified format.
     The format can be specified as 'format' argument, as strptime()
@@ -199,15 +251,32 @@ class DateField(fields.DateField):
         if 'format' in kwargs:
             self._date_format = kwargs.pop('format')
         else:
-            self._date_format = '%Y-%m-%d'
+            self._date_format = ISO8601_DATE_FORMAT
         super(DateField, self).__init__(*args, **kwargs)
 
     def from_ldap(self, value, connection):
-        if len(value) == 0:
-            return None
-        else:
-            return datetime.datetime.strptime(value[0],
-                                              self._date_format).date()
+        return self.get_decoder(connection)(value)
+
+    def get_decoder(self, connection):
+        parse_date = self._parse_date
+
+        def decode(value):
+            if not value:
+                return None
+            return parse_date(value[0])
+        return decode
+
+    def _parse_date(self, value):
+        # strptime() is slow, read ISO8601 dates directly
+        if self._date_format == ISO8601_DATE_FORMAT and len(value) == 10 \
+                and value[4] == value[7] == '-' and value[:4].isdigit() \
+                and value[5:7].isdigit() and value[8:].isdigit():
+            try:
+                return datetime.date(int(value[:4]), int(value[5:7]),
+                                     int(value[8:]))
+            except ValueError:
+                pass
+        return datetime.datetime.strptime(value, self._date_format).date()
 
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
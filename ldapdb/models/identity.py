@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import contextlib
+import threading
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """
+    Maps the DNs of LDAP entries to the model instances loaded for them.
+    """
+
+    def __init__(self):
+        # (database alias, lowercase DN) -> instance
+        self._instances = {}
+
+    def get(self, using, model, dn):
+        """
+        Returns the instance of `model` known for the entry at `dn`, or None.
+        The instance may belong to a proxy of `model`, such as the one of
+        lazily decoded instances.
+        """
+        instance = self._instances.get((using, dn.lower()))
+        if instance is not None and isinstance(instance, model):
+            return instance
+        return None
+
+    def add(self, instance):
+        """
+        Records a loaded or saved instance, replacing any instance known
+        for the same entry.
+        """
+        if instance.dn:
+            self._instances[(instance._state.db, instance.dn.lower())] = \
+                instance
+
+    def discard(self, using, dn):
+        """
+        Forgets the instance known for the entry at `dn`, if any.
+        """
+        self._instances.pop((using, dn.lower()), None)
+
+    def discard_model(self, model):
+        """
+        Forgets all the instances of `model`.
+        """
+        for key, instance in list(self._instances.items()):
+            if isinstance(instance, model):
+                del self._instances[key]
+
+
+def get_identity_map():
+    """
+    Returns the identity map active in the current thread, or None.
+    """
+    return getattr(_local, 'identity_map', None)
+
+
+def activate():
+    """
+    Activates a new identity map in the current thread, unless one is
+    already active, and returns the active one.
+    """
+    if get_identity_map() is None:
+        _local.identity_map = IdentityMap()
+        _local.depth = 0
+    _local.depth += 1
+    return _local.identity_map
+
+
+def deactivate():
+    """
+    Deactivates the identity map of the current thread once each call to
+    activate() has been matched.
+    """
+    if get_identity_map() is None:
+        return
+    _local.depth -= 1
+    if not _local.depth:
+        _local.identity_map = None
+
+
+def reset():
+    """
+    Deactivates the identity map of the current thread, if any.
+    """
+    _local.identity_map = None
+
+
+@contextlib.contextmanager
+def identity_map():
+    """
+    Within this context, primary key and DN lookups with get() return the
+    instance already loaded for the entry, if any, without searching the
+    directory. Nested contexts share the same map.
+    """
+    try:
+        yield activate()
+    finally:
+        deactivate()
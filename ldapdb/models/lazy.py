@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+
+from django.db import connections
+from django.db.models.query_utils import DeferredAttribute
+
+from ldapdb.backends.ldap.compiler import field_decoder
+
+_lock = threading.Lock()
+_lazy_models = {}
+
+
+class LazyAttribute(DeferredAttribute):
+    """
+    A field of a lazily decoded instance, decoded from the attributes of
+    its entry on first access.
+    """
+
+    def __init__(self, field, model):
+        super(LazyAttribute, self).__init__(field.attname, model)
+        self.field = field
+        # connection alias -> decoder
+        self._decoders = {}
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        if self.field_name not in data:
+            self._decode(instance)
+        return data[self.field_name]
+
+    def __set__(self, instance, value):
+        if self.field_name not in instance.__dict__:
+            # the changes to save are computed against the loaded value
+            self._decode(instance)
+        instance.__dict__[self.field_name] = value
+
+    def _decode(self, instance):
+        data = instance.__dict__
+        using, attrs = data['_lazy_entry']
+        decode = self._decoders.get(using)
+        if decode is None:
+            decode = field_decoder(self.field, connections[using])
+            self._decoders[using] = decode
+        value = decode(attrs.get(self.field.db_column, ()))
+        data[self.field_name] = value
+        saved_values = data.get('_saved_values')
+        if saved_values is not None:
+            if isinstance(value, list):
+                value = list(value)
+            saved_values[self.field_name] = value
+
+
+def _reduce_lazy(self):
+    # pickle the undecoded entry, and restore the instance as a lazy one
+    # rather than one of django's deferred models
+    model = self._meta.proxy_for_model
+    reduced = super(lazy_model(model), self).__reduce__()
+    return (_unpickle_lazy, (model,)) + tuple(reduced[2:])
+
+
+def _unpickle_lazy(model):
+    lazy_class = lazy_model(model)
+    return lazy_class.__new__(lazy_class)
+
+
+def lazy_model(model):
+    """
+    Returns the proxy of `model` whose instances decode their fields on
+    first access.
+    """
+    with _lock:
+        lazy_class = _lazy_models.get(model)
+        if lazy_class is None:
+            class Meta:
+                proxy = True
+                verbose_name = model._meta.verbose_name
+                verbose_name_plural = model._meta.verbose_name_plural
+            attrs = {'__module__': model.__module__, 'Meta': Meta,
+                     '_deferred': True, '__reduce__': _reduce_lazy}
+            for field in model._meta.fields:
+                if field.db_column and hasattr(field, 'from_ldap'):
+                    attrs[field.attname] = LazyAttribute(field, model)
+            name = '%s_Lazy' % model.__name__
+            lazy_class = type(str(name), (model,), attrs)
+            _lazy_models[model] = lazy_class
+    return lazy_class
+
+
+def lazy_instance(model, using, dn, attrs):
+    """
+    Returns an instance of `model` for the entry at `dn`, whose fields are
+    decoded on first access from the LDAP attributes `attrs`, as read from
+    the `using` database.
+    """
+    lazy_class = lazy_model(model)
+    instance = lazy_class.__new__(lazy_class)
+    instance.__dict__['_lazy_entry'] = (using, attrs)
+    instance.__init__(dn=dn)
+    instance._state.db = using
+    instance._state.adding = False
+    instance._snapshot()
+    return instance
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import django.db.models
+
+from ldapdb.models.query import QuerySet
+
+
+class Manager(django.db.models.Manager):
+    """
+    The default manager for LDAP models.
+    """
+
+    def get_queryset(self):
+        kwargs = {'using': self._db}
+        if hasattr(self, '_hints'):
+            # django >= 1.7
+            kwargs['hints'] = self._hints
+        return QuerySet(self.model, **kwargs)
+
+    # django < 1.6
+    get_query_set = get_queryset
+
+    def page_size(self, *args, **kwargs):
+        return self.get_queryset().page_size(*args, **kwargs)
+
+    def lazy(self):
+        return self.get_queryset().lazy()
+
+    def estimated_count(self):
+        return self.get_queryset().estimated_count()
+
+    def afetch(self, *args, **kwargs):
+        return self.get_queryset().afetch(*args, **kwargs)
+
+    def aget(self, *args, **kwargs):
+        return self.get_queryset().aget(*args, **kwargs)
+
+    def bulk_create(self, *args, **kwargs):
+        return self.get_queryset().bulk_create(*args, **kwargs)
+
+    def add_values(self, *args, **kwargs):
+        return self.get_queryset().add_values(*args, **kwargs)
+
+    def remove_values(self, *args, **kwargs):
+        return self.get_queryset().remove_values(*args, **kwargs)
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import ldap
+import ldap.controls
+import ldap.dn
+
+from django.db import connections
+from django.db.models import query, sql
+
+from ldapdb.backends.ldap.base import PERMISSIVE_MODIFY_OID
+from ldapdb.backends.ldap.poller import chain, create_future
+from ldapdb.models.fields import ListField
+from ldapdb.models.identity import get_identity_map
+from ldapdb.models.lazy import lazy_instance
+
+try:
+    StopAsyncIteration
+except NameError:
+    # python < 3.5
+    class StopAsyncIteration(Exception):
+        pass
+
+class Query(sql.Query):
+    """
+    A Query which also carries LDAP-specific search options.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Query, self).__init__(*args, **kwargs)
+        self.ldap_options = {}
+
+    def clone(self, *args, **kwargs):
+        obj = super(Query, self).clone(*args, **kwargs)
+        obj.ldap_options = self.ldap_options.copy()
+        return obj
+
+    def get_count(self, using):
+        # count the matching entries without retrieving their attributes
+        return self.get_compiler(using=using).count_entries()
+
+
+class AsyncIterator(object):
+    """
+    Iterates asynchronously over the objects of a QuerySet.
+
+    When a page size applies, the pages are searched for one at a time
+    with the Simple Paged Results control: the objects of a page are
+    yielded as soon as it is received, and the next page is only requested
+    once they have all been consumed. Sorted, sliced or distinct QuerySets
+    are fetched with a single search.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.objects = []
+        # None until the first page is received, empty after the last one
+        self.cookie = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = create_future()
+        if self.objects:
+            future.set_result(self.objects.pop(0))
+        elif self.cookie == '':
+            future.set_exception(StopAsyncIteration())
+        else:
+            return chain(self._fetch_page(), self._received)
+        return future
+
+    def _fetch_page(self):
+        """
+        Returns a future resolving to the objects of the next page and to
+        the cookie of the page after it.
+        """
+        def received(result):
+            entries, cookie = result
+            clone = self.queryset._clone()
+            clone.query.ldap_options['entries'] = entries
+            return list(clone), cookie
+
+        def failed(e):
+            if isinstance(e, ldap.NO_SUCH_OBJECT):
+                return [], ''
+            raise e
+
+        connection = connections[self.queryset.db]
+        compiler = self.queryset.query.get_compiler(using=self.queryset.db)
+        ldap_query = compiler.as_ldap()
+        page_size = (ldap_query.page_size or
+                     connection.settings_dict.get('PAGE_SIZE'))
+        if (not page_size or ldap_query.ordering or ldap_query.distinct or
+                ldap_query.window != (0, None)):
+            return chain(self.queryset.afetch(), lambda objs: (objs, ''))
+
+        args = compiler.get_search_args()
+        if args is None:
+            future = create_future()
+            future.set_result(([], ''))
+            return future
+        future = connection.search_page(*args, page_size=page_size,
+                                        cookie=self.cookie or '')
+        return chain(future, received, failed)
+
+    def _received(self, result):
+        self.objects, self.cookie = list(result[0]), result[1]
+        return self.__anext__()
+
+
+class QuerySet(query.QuerySet):
+    """
+    A QuerySet for LDAP models.
+    """
+
+    def __init__(self, model=None, query=None, *args, **kwargs):
+        if query is None:
+            query = Query(model)
+        super(QuerySet, self).__init__(model, query, *args, **kwargs)
+
+    def iterator(self):
+        identities = get_identity_map()
+        # instances with deferred fields are not shared
+        deferred = self.query.deferred_loading[0]
+        if self._decodes_lazily():
+            objs = self._lazy_iterator()
+        else:
+            objs = super(QuerySet, self).iterator()
+        for obj in objs:
+            if identities is not None and not deferred and \
+                    isinstance(obj, self.model):
+                identities.add(obj)
+            yield obj
+
+    def _decodes_lazily(self):
+        """
+        Returns whether the objects are decoded lazily, which requires them
+        to hold the fields of the model and nothing else.
+        """
+        query = self.query
+        if hasattr(query, 'annotation_select'):
+            # django >= 1.8
+            annotations = query.annotation_select
+        else:
+            annotations = query.aggregate_select
+        return bool(query.ldap_options.get('lazy')) and \
+            not query.deferred_loading[0] and not query.distinct and \
+            not query.extra_select and not annotations
+
+    def _lazy_iterator(self):
+        compiler = self.query.get_compiler(using=self.db)
+        for dn, attrs in compiler.entries_iter():
+            yield lazy_instance(self.model, self.db, dn, attrs)
+
+    def get(self, *args, **kwargs):
+        obj = self._identity_lookup(args, kwargs)
+        if obj is not None:
+            return obj
+        return super(QuerySet, self).get(*args, **kwargs)
+
+    def _identity_lookup(self, args, kwargs):
+        """
+        Returns the instance of the active identity map looked up by
+        get(*args, **kwargs), if it is a lookup of the primary key or DN.
+        """
+        identities = get_identity_map()
+        if identities is None or args or len(kwargs) != 1 or \
+                self.query.where.children or self.query.low_mark or \
+                self.query.high_mark is not None or \
+                self.query.deferred_loading[0]:
+            return None
+
+        lookup, value = list(kwargs.items())[0]
+        if lookup.endswith('__exact'):
+            lookup = lookup[:-len('__exact')]
+        pk = self.model._meta.pk
+        if lookup == 'dn':
+            dn = value
+        elif lookup in ('pk', pk.name) and pk.db_column:
+            dn = '%s=%s,%s' % (pk.db_column,
+                               ldap.dn.escape_dn_chars(u'%s' % value),
+                               self.model.base_dn)
+        else:
+            return None
+        return identities.get(self.db, self.model, dn)
+
+    def _forget_instances(self):
+        """
+        Drops the instances of the model from the active identity map,
+        before entries are modified without them.
+        """
+        identities = get_identity_map()
+        if identities is not None:
+            identities.discard_model(self.model)
+
+    def update(self, **kwargs):
+        self._forget_instances()
+        return super(QuerySet, self).update(**kwargs)
+    update.alters_data = True
+
+    def delete(self):
+        try:
+            return super(QuerySet, self).delete()
+        finally:
+            # the deleted instances were loaded by the delete
+            self._forget_instances()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def page_size(self, size):
+        """
+        Returns a new QuerySet whose searches are split into pages of
+        `size` entries.
+        """
+        clone = self._clone()
+        clone.query.ldap_options['page_size'] = size
+        return clone
+
+    def lazy(self):
+        """
+        Returns a new QuerySet whose objects keep the attributes of their
+        entry and decode each field on first access, instead of decoding
+        all of them when loaded.
+        """
+        clone = self._clone()
+        clone.query.ldap_options['lazy'] = True
+        return clone
+
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Creates the entries for the given objects, sending up to
+        `batch_size` requests before waiting for the responses.
+
+        Unlike save(), no signals are sent. Every object is attempted: if
+        some of them could not be created, the first error is raised once
+        all responses have been received, and only the created objects
+        have their `dn` set.
+        """
+        objs = list(objs)
+        connection = connections[self.db]
+        operations = []
+        for obj in objs:
+            operations.append(('add', obj.build_dn(),
+                               (obj._build_entry(connection),)))
+
+        results = connection.pipeline(operations, window=batch_size)
+        for obj, (method, dn, args), error in zip(objs, operations, results):
+            if error is None:
+                obj.dn = dn
+                obj.saved_pk = obj.pk
+                obj._state.db = self.db
+                obj._state.adding = False
+                obj._snapshot()
+        for error in results:
+            if error is not None:
+                raise error
+        return objs
+
+    def estimated_count(self):
+        """
+        Returns the server's estimate of the number of objects matching this
+        QuerySet if it provides one, which is cheaper to obtain than an
+        exact count. Otherwise, returns the exact count.
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        count = self.query.get_compiler(using=self.db).estimate_count()
+        if count is None:
+            return self.count()
+
+        # apply the slice
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        count = max(0, count - low_mark)
+        if high_mark is not None:
+            count = min(count, max(0, high_mark - low_mark))
+        return count
+
+    def ldap_query(self):
+        """
+        Returns the LdapQuery describing the search which performs this
+        QuerySet, without running it.
+        """
+        return self.query.get_compiler(using=self.db).as_ldap()
+
+    def add_values(self, field_name, values):
+        """
+        Adds values to a multi-valued attribute of the matching entries,
+        without reading the attribute. Returns the number of entries.
+        """
+        return self._modify_values(ldap.MOD_ADD, field_name, values)
+
+    def remove_values(self, field_name, values):
+        """
+        Removes values from a multi-valued attribute of the matching
+        entries, without reading the attribute. Returns the number of
+        entries.
+        """
+        return self._modify_values(ldap.MOD_DELETE, field_name, values)
+
+    def _modify_values(self, op, field_name, values):
+        field = self.model._meta.get_field(field_name)
+        if not isinstance(field, ListField):
+            raise TypeError("%s is not a ListField" % field_name)
+        if not values:
+            # removing no values would remove the whole attribute
+            return 0
+
+        self._for_write = True
+        self._forget_instances()
+        connection = connections[self.db]
+        modlist = [(op, field.db_column,
+                    field.get_db_prep_save(values, connection=connection))]
+
+        serverctrls = None
+        if connection.features.supports_permissive_modify:
+            # do not fail on values which are already present or absent
+            serverctrls = [ldap.controls.LDAPControl(PERMISSIVE_MODIFY_OID,
+                                                     True, None)]
+
+        compiler = self.query.get_compiler(using=self.db)
+        return compiler.execute_pipeline(
+            [('modify', dn, (modlist,))
+             for dn in compiler.get_matching_dns()],
+            serverctrls=serverctrls)
+
+    def _prefetch_async(self):
+        """
+        Returns a future resolving to a clone of this QuerySet whose entries
+        were searched for asynchronously, so that evaluating the clone does
+        not block.
+        """
+        def prefetched(entries):
+            clone = self._clone()
+            clone.query.ldap_options['entries'] = entries
+            return clone
+
+        def failed(e):
+            if isinstance(e, ldap.NO_SUCH_OBJECT):
+                return prefetched([])
+            raise e
+
+        compiler = self.query.get_compiler(using=self.db)
+        args = compiler.get_search_args()
+        if args is None:
+            future = create_future()
+            future.set_result([])
+        else:
+            future = connections[self.db].search(*args)
+        return chain(future, prefetched, failed)
+
+    def __aiter__(self):
+        return AsyncIterator(self)
+
+    def afetch(self):
+        """
+        Returns a future resolving to the list of objects matching this
+        QuerySet.
+        """
+        return chain(self._prefetch_async(), list)
+
+    def aget(self, *args, **kwargs):
+        """
+        Asynchronous version of get().
+        """
+        obj = self._identity_lookup(args, kwargs)
+        if obj is not None:
+            future = create_future()
+            future.set_result(obj)
+            return future
+        clone = self.filter(*args, **kwargs)
+        return chain(clone._prefetch_async(), lambda qs: qs.get())
@@ -30,13 +30,275 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import datetime
+import os
+import threading
+import time
+import unittest
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from django.db import connections
 from django.test import TestCase
 from django.db.models.sql.where import Constraint, AND, OR, WhereNode
 
 from ldapdb import escape_ldap_filter
-from ldapdb.backends.ldap.compiler import where_as_ldap
+from ldapdb.backends.ldap.balancer import Balancer, LatencyHistogram
+from ldapdb.backends.ldap.base import DatabaseWrapper
+from ldapdb.backends.ldap.cache import LocalStorage, QueryCache
+from ldapdb.backends.ldap.compiler import field_decoder, where_as_ldap
+from ldapdb.backends.ldap.filters import (FALSE, can_match_filter,
+                                          format_filter, match_filter,
+                                          optimize_filter, parse_filter)
+from ldapdb.backends.ldap.mirror import SyncreplMirror
+from ldapdb.backends.ldap.poller import (Poller, asyncio, chain,
+                                         create_future, submit_async)
+from ldapdb.backends.ldap.pool import ConnectionPool
 from ldapdb.models.fields import (CharField, IntegerField, FloatField,
                                   ListField, DateField)
+from examples.models import LdapGroup
+
+
+class FakeLDAPObject(object):
+    """
+    A connection to a server holding `entries`, which answers asynchronous
+    requests one response at a time, once `delay` seconds have elapsed.
+    """
+    def __init__(self, entries=(), delay=0):
+        self.entries = list(entries)
+        self.delay = delay
+        # DN -> the error requests on the entry fail with
+        self.errors = {}
+        self.abandoned = []
+        self.cookies = []
+        self.requests = []
+        # the largest number of requests awaiting a response at once
+        self.max_pending = 0
+        self.unbound = False
+        self._responses = {}
+        self._last_msgid = 0
+        self._fds = os.pipe()
+
+    def _send(self, request, responses):
+        self.requests.append(request)
+        self._last_msgid += 1
+        self._responses[self._last_msgid] = (time.time() + self.delay,
+                                             list(responses))
+        self.max_pending = max(self.max_pending, len(self._responses))
+        return self._last_msgid
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        error = self.errors.get(base)
+        if error is not None:
+            return self._send(('search', base, filterstr),
+                              [(error, [], [])])
+        entries = self.entries
+        rctrls = []
+        for control in serverctrls or []:
+            if control.controlType == SimplePagedResultsControl.controlType:
+                self.cookies.append(control.cookie)
+                start = int(control.cookie or 0)
+                end = start + control.size
+                entries = entries[start:end]
+                cookie = end < len(self.entries) and str(end) or ''
+                rctrls.append(SimplePagedResultsControl(
+                    False, size=control.size, cookie=cookie))
+        responses = [(ldap.RES_SEARCH_ENTRY, [entry], [])
+                     for entry in entries]
+        responses.append((ldap.RES_SEARCH_RESULT, [], rctrls))
+        return self._send(('search', base, filterstr), responses)
+
+    def _write(self, request, rtype, dn):
+        error = self.errors.get(dn)
+        if error is not None:
+            return self._send(request, [(error, [], [])])
+        return self._send(request, [(rtype, [], [])])
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._write(('add', dn), ldap.RES_ADD, dn)
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        return self._write(('delete', dn), ldap.RES_DELETE, dn)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._write(('modify', dn), ldap.RES_MODIFY, dn)
+
+    def result3(self, msgid, all=1, timeout=None):
+        ready, responses = self._responses[msgid]
+        wait = ready - time.time()
+        if wait > 0:
+            if timeout == 0:
+                return None, None, None, None
+            elif timeout is not None and 0 < timeout < wait:
+                time.sleep(timeout)
+                raise ldap.TIMEOUT
+            time.sleep(wait)
+
+        if all:
+            response = (responses[-1][0],
+                        sum([r[1] for r in responses], []), responses[-1][2])
+            del responses[:]
+        else:
+            response = responses.pop(0)
+        if not responses:
+            del self._responses[msgid]
+        if isinstance(response[0], ldap.LDAPError):
+            raise response[0]
+        return response[0], response[1], msgid, response[2]
+
+    def abandon(self, msgid):
+        self.abandoned.append(msgid)
+        self._responses.pop(msgid, None)
+
+    def fileno(self):
+        # never readable, callers poll for responses
+        return self._fds[0]
+
+    def unbind_s(self):
+        self.unbound = True
+        for fd in self._fds:
+            os.close(fd)
+
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self.settings_dict = dict(connections['ldap'].settings_dict)
+        self.servers = []
+
+        def connect(uri=None):
+            server = FakeLDAPObject(delay=0.01)
+            self.servers.append(server)
+            return server
+        # one connection pool per test
+        self.wrapper = DatabaseWrapper(self.settings_dict, self.id())
+        self.wrapper._connect = connect
+
+    def tearDown(self):
+        pool = self.wrapper._get_pool(self.settings_dict['NAME'])
+        if pool is not None:
+            pool.close()
+
+    def operations(self, count):
+        return [('add', 'cn=group%d,ou=groups,dc=example' % i,
+                 ([('cn', ['group%d' % i])],)) for i in range(count)]
+
+    def test_window(self):
+        operations = self.operations(10)
+        self.assertEqual(self.wrapper.pipeline(operations, window=3),
+                         [None] * 10)
+        server, = self.servers
+        self.assertEqual(server.requests,
+                         [('add', dn) for method, dn, args in operations])
+        self.assertEqual(server.max_pending, 3)
+
+        # the window defaults to the PIPELINE_WINDOW setting
+        self.settings_dict['PIPELINE_WINDOW'] = 4
+        self.wrapper.pipeline(self.operations(10))
+        self.assertEqual(server.max_pending, 4)
+
+    def test_errors(self):
+        self.wrapper.ensure_connection()
+        server, = self.servers
+        server.errors['cn=group2,ou=groups,dc=example'] = \
+            ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+
+        # the other operations are performed
+        results = self.wrapper.pipeline(self.operations(5), window=2)
+        self.assertEqual(len(server.requests), 5)
+        self.assertEqual(results[:2] + results[3:], [None] * 4)
+        self.assertTrue(isinstance(results[2], ldap.ALREADY_EXISTS))
+
+        # connection failures are raised
+        server.errors['cn=group3,ou=groups,dc=example'] = \
+            ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        self.assertRaises(ldap.SERVER_DOWN, self.wrapper.pipeline,
+                          self.operations(5), 2)
+        self.assertEqual(self.wrapper.connection, None)
+
+    def test_connections(self):
+        self.settings_dict['POOL'] = {'MAX_SIZE': 2}
+        self.settings_dict['PIPELINE_CONNECTIONS'] = 2
+        self.assertEqual(self.wrapper.pipeline(self.operations(8), window=2),
+                         [None] * 8)
+        self.assertEqual(len(self.servers), 2)
+        for server in self.servers:
+            self.assertEqual(len(server.requests), 4)
+            self.assertEqual(server.max_pending, 2)
+
+    def test_connections_limited(self):
+        self.settings_dict['POOL'] = {'MAX_SIZE': 2, 'TIMEOUT': 1}
+        self.settings_dict['PIPELINE_CONNECTIONS'] = 5
+        self.assertEqual(self.wrapper.pipeline(self.operations(8), window=2),
+                         [None] * 8)
+        self.assertEqual(len(self.servers), 2)
+
+        # the connections held elsewhere are not waited for
+        pool = self.wrapper._get_pool(self.settings_dict['NAME'])
+        held = pool.acquire()
+        self.assertEqual(self.wrapper.pipeline(self.operations(4), window=2),
+                         [None] * 4)
+        pool.release(held)
+        self.assertEqual(len(pool._idle), 2)
+
+    def test_connections_released(self):
+        self.settings_dict['POOL'] = {'MAX_SIZE': 3}
+        self.settings_dict['PIPELINE_CONNECTIONS'] = 3
+        connect = self.wrapper._connect
+
+        def connect_once(uri=None):
+            if self.servers:
+                raise ldap.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+            return connect(uri)
+        self.wrapper._connect = connect_once
+
+        # the connection acquired before the failure is given back
+        self.assertRaises(ldap.INVALID_CREDENTIALS, self.wrapper.pipeline,
+                          self.operations(3))
+        pool = self.wrapper._get_pool(self.settings_dict['NAME'])
+        self.assertEqual([c for c, last_used in pool._idle], self.servers)
+        self.assertEqual(pool._opening, 0)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.opened = []
+        self.failing = False
+
+    def connect(self):
+        if self.failing:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        connection = FakeLDAPObject()
+        self.opened.append(connection)
+        return connection
+
+    def test_min_size(self):
+        pool = ConnectionPool(self.connect, min_size=2, max_size=3)
+        self.assertEqual(len(self.opened), 2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertEqual(set([first, second]), set(self.opened))
+
+        # the pool is refilled once a connection is discarded
+        pool.discard(first)
+        self.assertTrue(first.unbound)
+        self.assertEqual(len(self.opened), 3)
+        self.assertTrue(pool.acquire() is self.opened[2])
+
+        # unreachable servers are only reported on use
+        self.failing = True
+        pool.discard(second)
+        self.assertRaises(ldap.SERVER_DOWN, pool.acquire)
+        self.assertEqual(len(self.opened), 3)
+
+    def test_acquire_nonblocking(self):
+        pool = ConnectionPool(self.connect, max_size=1)
+        connection = pool.acquire(block=False)
+        self.assertTrue(connection is not None)
+        self.assertEqual(pool.acquire(block=False), None)
+        pool.release(connection)
+        self.assertTrue(pool.acquire(block=False) is connection)
 
 
 class WhereTestCase(TestCase):
@@ -166,3 +428,525 @@ class WhereTestCase(TestCase):
                    "bar"), OR)
         self.assertEqual(where_as_ldap(where), ("(|(cn=foo)(givenName=bar))",
                                                  []))
+
+
+class BalancerTestCase(TestCase):
+    def test_ranked(self):
+        balancer = Balancer(['ldap://a', 'ldap://b', 'ldap://c'])
+        balancer.record_success('ldap://a', 0.2)
+        balancer.record_success('ldap://b', 0.1)
+        # unknown servers come first, then the fastest ones
+        self.assertEqual(balancer.ranked(),
+                         ['ldap://c', 'ldap://b', 'ldap://a'])
+
+        # failing servers come last
+        balancer.record_error('ldap://c')
+        balancer.record_error('ldap://c')
+        balancer.record_error('ldap://c')
+        balancer.record_error('ldap://c')
+        self.assertEqual(balancer.ranked(),
+                         ['ldap://b', 'ldap://a', 'ldap://c'])
+
+    def test_hedge_delay(self):
+        balancer = Balancer(['ldap://a'], min_samples=10)
+        for i in range(9):
+            balancer.record_success('ldap://a', 0.001)
+        self.assertEqual(balancer.hedge_delay('ldap://a', 90), None)
+
+        balancer.record_success('ldap://a', 0.1)
+        self.assertEqual(balancer.hedge_delay('ldap://a', 90), 0.001)
+        self.assertEqual(balancer.hedge_delay('ldap://a', 100), 0.128)
+
+    def test_histogram(self):
+        histogram = LatencyHistogram(max_samples=4)
+        histogram.add(0.003)
+        histogram.add(0.003)
+        histogram.add(100)
+        self.assertEqual(histogram.percentile(50), 0.004)
+        self.assertEqual(histogram.percentile(100), histogram.bounds[-1])
+
+        # older samples are progressively forgotten
+        histogram.add(0.003)
+        self.assertEqual(histogram.total, 2)
+
+
+class QueryCacheTestCase(TestCase):
+    def test_lru(self):
+        storage = LocalStorage(max_entries=2)
+        storage.set('a', 1, 60)
+        storage.set('b', 2, 60)
+        self.assertEqual(storage.get('a'), 1)
+        storage.set('c', 3, 60)
+        self.assertEqual(storage.get('b'), None)
+        self.assertEqual(storage.get('a'), 1)
+        self.assertEqual(storage.get('c'), 3)
+
+        # expired values are forgotten
+        storage.set('d', 4, -1)
+        self.assertEqual(storage.get('d'), None)
+
+    def test_invalidate(self):
+        cache = QueryCache(LocalStorage())
+        calls = []
+
+        def search(base):
+            def fetch():
+                calls.append(base)
+                return [(base, {})]
+            return cache.search(base, (base,), fetch)
+
+        search('ou=groups,dc=example')
+        search('ou=people,dc=example')
+        search('uid=foo,ou=people,dc=example')
+        self.assertEqual(len(calls), 3)
+
+        # writes affect the searches on their superiors
+        cache.invalidate(['uid=bar,ou=people,dc=example'])
+        search('ou=groups,dc=example')
+        search('ou=people,dc=example')
+        search('uid=foo,ou=people,dc=example')
+        self.assertEqual(calls[3:], ['ou=people,dc=example'])
+
+        # renames and deletions affect the searches below
+        cache.invalidate(['ou=people,dc=example'], structural=True)
+        search('ou=groups,dc=example')
+        search('uid=foo,ou=people,dc=example')
+        self.assertEqual(calls[4:], ['uid=foo,ou=people,dc=example'])
+
+    def test_copies(self):
+        cache = QueryCache(LocalStorage())
+        entries = [('cn=foo,ou=groups,dc=example', {'cn': ['foo']})]
+
+        def search():
+            return cache.search('ou=groups,dc=example', ('groups',),
+                                lambda: entries)
+
+        # changing the returned entries does not affect later reads
+        dn, attrs = search()[0]
+        attrs['cn'].append('bar')
+        attrs['gidNumber'] = ['1000']
+        self.assertEqual(search(), entries)
+        search()[0][1]['cn'][0] = 'bar'
+        self.assertEqual(search(), entries)
+
+        # nor does changing the fetched ones
+        entries[0][1]['cn'] = ['bar']
+        self.assertEqual(search(), [('cn=foo,ou=groups,dc=example',
+                                     {'cn': ['foo']})])
+
+
+class FilterTestCase(TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            parse_filter('(&(objectClass=posixGroup)(!(cn=fo\\2ao))'
+                         '(|(gidNumber>=1000)(cn=*))(cn=a*b*c))'),
+            ('&', (('=', 'objectClass', 'posixGroup'),
+                   ('!', ('=', 'cn', 'fo*o')),
+                   ('|', (('>=', 'gidNumber', '1000'),
+                          ('present', 'cn'))),
+                   ('substring', 'cn', ('a', ('b',), 'c')))))
+        self.assertRaises(ValueError, parse_filter, '(cn=foo')
+        self.assertRaises(ValueError, parse_filter, '(cn:dn:=foo)')
+
+    def test_match(self):
+        rules = {'cn': 'caseIgnoreMatch', 'gidnumber': 'integerMatch',
+                 'memberuid': 'caseExactIA5Match'}
+        attrs = {'cn': ['Foo  Group'], 'gidnumber': ['1000'],
+                 'memberuid': ['007']}
+
+        def match(filterstr):
+            node = parse_filter(filterstr)
+            self.assertTrue(can_match_filter(node, rules))
+            return match_filter(node, attrs, rules)
+
+        self.assertTrue(match('(cn=foo group)'))
+        self.assertTrue(match('(CN=foo*)'))
+        self.assertFalse(match('(cn=*bar)'))
+        self.assertFalse(match('(mail=*)'))
+        # integers are compared by value
+        self.assertTrue(match('(gidNumber>=999)'))
+        self.assertFalse(match('(gidNumber<=999)'))
+        self.assertTrue(match('(&(cn=foo group)(!(gidNumber=1001)))'))
+        # other values according to their syntax
+        self.assertTrue(match('(memberUid=007)'))
+        self.assertFalse(match('(memberUid=7)'))
+        self.assertFalse(match('(memberUid=*Z*)'))
+
+    def test_cannot_match(self):
+        rules = {'cn': 'caseIgnoreIA5Match', 'gidnumber': 'integerMatch'}
+        for filterstr in ['(mail=foo)', '(cn>=foo)', '(gidNumber=*0)',
+                          '(gidNumber=foo)', '(cn~=foo)',
+                          '(&(cn=foo)(|(gidNumber=1000)(!(mail=foo))))']:
+            self.assertFalse(can_match_filter(parse_filter(filterstr),
+                                              rules))
+        self.assertTrue(can_match_filter(parse_filter('(mail=*)'), rules))
+
+    def test_format(self):
+        filterstr = '(&(!(cn=fo\\2ao))(|(gidNumber>=1000)(cn=*))(cn=a*b*c))'
+        self.assertEqual(format_filter(parse_filter(filterstr)), filterstr)
+
+    def test_optimize(self):
+        def optimize(filterstr, selectivity=None):
+            return format_filter(optimize_filter(parse_filter(filterstr),
+                                                 selectivity))
+
+        # nested ANDs and ORs are flattened
+        self.assertEqual(
+            optimize('(&(objectClass=a)(objectClass=b)'
+                     '(&(x=1)(|(y=1)(|(y=2)(y=1)))))'),
+            '(&(objectClass=a)(objectClass=b)(x=1)(|(y=1)(y=2)))')
+        # duplicates, tautologies and double negations are removed
+        self.assertEqual(optimize('(&(x=1)(objectClass=*)(!(!(x=1))))'),
+                         '(x=1)')
+        self.assertEqual(optimize('(|(x=1)(!(x=1)))'), '(|(x=1)(!(x=1)))')
+        # terms absorb the nested ORs and ANDs holding them
+        self.assertEqual(optimize('(&(x=1)(|(x=1)(x=2))(|(x=2)(x=3)))'),
+                         '(&(x=1)(|(x=2)(x=3)))')
+        self.assertEqual(optimize('(|(x=1)(&(x=1)(y=1))(&(x=2)(y=1)))'),
+                         '(|(x=1)(&(x=2)(y=1)))')
+        # contradictions match nothing
+        self.assertEqual(optimize_filter(parse_filter('(&(x=1)(!(x=1)))')),
+                         FALSE)
+        self.assertEqual(optimize_filter(parse_filter('(&(x=1)(|))')), FALSE)
+        # the most selective terms come first
+        self.assertEqual(
+            optimize('(&(objectClass=a)(|(y=1)(y=2))(x>=1))',
+                     {'x': 0.01, 'y': 0.2}),
+            '(&(x>=1)(|(y=1)(y=2))(objectClass=a))')
+
+
+class PagedSearchTestCase(TestCase):
+    entries = [('cn=group%d,ou=groups,dc=example' % i,
+                {'cn': ['group%d' % i]}) for i in range(5)]
+
+    def search(self, connection, page_size):
+        return connections['ldap']._search_iter(
+            connection, 'ou=groups,dc=example', ldap.SCOPE_SUBTREE,
+            '(objectClass=*)', ['cn'], page_size, None)
+
+    def test_pages(self):
+        connection = FakeLDAPObject(self.entries)
+        self.assertEqual([dn for dn, attrs in self.search(connection, 2)],
+                         [dn for dn, attrs in self.entries])
+        self.assertEqual(connection.cookies, ['', '2', '4'])
+        self.assertEqual(connection.abandoned, [])
+
+    def test_stop_early(self):
+        connection = FakeLDAPObject(self.entries)
+        results = self.search(connection, 2)
+        self.assertEqual(next(results)[0], 'cn=group0,ou=groups,dc=example')
+        results.close()
+        self.assertEqual(connection.abandoned, [1])
+        self.assertEqual(connection.cookies, [''])
+
+    def test_queryset(self):
+        wrapper = connections['ldap']
+        connection = FakeLDAPObject([
+            ('cn=group%d,%s' % (i, LdapGroup.base_dn),
+             {'cn': ['group%d' % i], 'gidNumber': [str(1000 + i)]})
+            for i in range(5)])
+        wrapper.connection = connection
+        wrapper.features._supported_controls = set()
+        try:
+            objs = LdapGroup.objects.page_size(2).iterator()
+            # the first object is built before the next page is requested
+            self.assertEqual(next(objs).name, 'group0')
+            self.assertEqual(connection.cookies, [''])
+            self.assertEqual([g.gid for g in objs],
+                             [1001, 1002, 1003, 1004])
+            self.assertEqual(connection.cookies, ['', '2', '4'])
+        finally:
+            connection.unbind_s()
+            wrapper.connection = None
+            wrapper.features._supported_controls = None
+
+
+class HedgedSearchTestCase(TestCase):
+    base = 'ou=groups,dc=example'
+    entries = [('cn=group%d,ou=groups,dc=example' % i,
+                {'cn': ['group%d' % i]}) for i in range(2)]
+
+    def setUp(self):
+        settings_dict = dict(connections['ldap'].settings_dict,
+                             REPLICAS=['ldap://a', 'ldap://b'],
+                             HEDGE_PERCENTILE=50)
+        # one balancer per test
+        self.wrapper = DatabaseWrapper(settings_dict, self.id())
+        self.servers = {}
+
+        def connect(uri=None):
+            if uri not in self.servers:
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            return self.servers[uri]
+        self.wrapper._connect = connect
+
+        self.balancer = self.wrapper._get_balancer()
+        for i in range(self.balancer.min_samples):
+            self.balancer.record_success('ldap://a', 0.01)
+            self.balancer.record_success('ldap://b', 0.02)
+
+    def search(self):
+        return list(self.wrapper._search_uris(
+            self.base, ldap.SCOPE_SUBTREE, '(objectClass=*)', ['cn'], None,
+            None, 0))
+
+    def error_rate(self, uri):
+        return self.balancer._stats[uri].error_rate
+
+    def test_slow_server(self):
+        slow = self.servers['ldap://a'] = FakeLDAPObject(self.entries, 0.5)
+        fast = self.servers['ldap://b'] = FakeLDAPObject(self.entries)
+        self.assertEqual(self.search(), self.entries)
+        self.assertEqual(slow.abandoned, [1])
+        self.assertEqual(len(fast.requests), 1)
+
+        # both connections remain usable
+        self.assertEqual(self.wrapper.read_connections,
+                         {'ldap://a': slow, 'ldap://b': fast})
+        self.assertEqual(self.error_rate('ldap://a'), 0)
+        self.assertEqual(self.error_rate('ldap://b'), 0)
+
+    def test_slow_server_fails(self):
+        slow = self.servers['ldap://a'] = FakeLDAPObject(self.entries, 0.2)
+        slow.errors[self.base] = ldap.SERVER_DOWN({'desc': "Can't contact "
+                                                           "LDAP server"})
+        hedge = self.servers['ldap://b'] = FakeLDAPObject(self.entries, 0.4)
+        self.assertEqual(self.search(), self.entries)
+
+        # the broken connection is discarded
+        self.assertEqual(self.wrapper.read_connections, {'ldap://b': hedge})
+        self.assertTrue(self.error_rate('ldap://a') > 0)
+        self.assertEqual(self.error_rate('ldap://b'), 0)
+
+    def test_hedge_server_down(self):
+        slow = self.servers['ldap://a'] = FakeLDAPObject(self.entries, 0.3)
+        self.assertEqual(self.search(), self.entries)
+        self.assertEqual(slow.abandoned, [])
+
+        # the error is recorded against the server which could not be
+        # reached
+        self.assertEqual(self.wrapper.read_connections, {'ldap://a': slow})
+        self.assertEqual(self.error_rate('ldap://a'), 0)
+        self.assertTrue(self.error_rate('ldap://b') > 0)
+
+
+class SyncreplMirrorTestCase(TestCase):
+    def setUp(self):
+        self.mirror = SyncreplMirror(
+            None, 'ou=groups,dc=example', 1, '(objectClass=posixGroup)',
+            ['objectClass', 'cn', 'gidNumber'],
+            matching_rules={'objectClass': 'objectIdentifierMatch',
+                            'cn': 'caseIgnoreMatch',
+                            'gidNumber': 'integerMatch'})
+
+    def entry(self, cn, uuid, gid=None):
+        attrs = {'objectClass': ['posixGroup'], 'cn': [cn]}
+        if gid is not None:
+            attrs['gidNumber'] = [gid]
+        self.mirror.syncrepl_entry('cn=%s,ou=groups,dc=example' % cn, attrs,
+                                   uuid)
+
+    def search(self, filterstr='(objectClass=*)'):
+        results = self.mirror.search(filterstr, ['cn'])
+        if results is None:
+            return None
+        return sorted(attrs['cn'][0] for dn, attrs in results)
+
+    def test_refresh(self):
+        self.mirror._present = set()
+        self.entry('foo', 'uuid1', '1000')
+        self.entry('bar', 'uuid2', '1001')
+        # not answering until the refresh is done
+        self.assertEqual(self.search(), None)
+        self.mirror.syncrepl_refreshdone()
+        self.assertEqual(self.search(), ['bar', 'foo'])
+        self.assertEqual(self.search('(gidNumber=1000)'), ['foo'])
+        self.assertEqual(self.search('(cn=FOO)'), ['foo'])
+
+        # changes are applied as they are received
+        self.entry('baz', 'uuid1', '1000')
+        self.assertEqual(self.search('(gidNumber=1000)'), ['baz'])
+        self.mirror.syncrepl_delete(['uuid2'])
+        self.assertEqual(self.search(), ['baz'])
+
+        # filters on attributes without a known matching rule are not
+        # answered
+        self.assertEqual(self.search('(memberUid=foo)'), None)
+
+    def test_present(self):
+        self.mirror._present = set()
+        self.entry('foo', 'uuid1')
+        self.entry('bar', 'uuid2')
+        self.mirror.syncrepl_refreshdone()
+
+        # the entries which are not reported during the next refresh were
+        # deleted in the meantime
+        self.mirror._persisting = False
+        self.mirror._present = set()
+        self.mirror.syncrepl_present(['uuid2'])
+        self.mirror.syncrepl_present(None)
+        self.mirror.syncrepl_refreshdone()
+        self.assertEqual(self.search(), ['bar'])
+
+
+class DecoderTestCase(TestCase):
+    class connection:
+        charset = 'utf-8'
+
+    def test_decoders(self):
+        decode = CharField().get_decoder(self.connection)
+        self.assertEqual(decode(['caf\xc3\xa9']), u'caf\xe9')
+        self.assertEqual(decode([]), '')
+        decode = IntegerField().get_decoder(self.connection)
+        self.assertEqual(decode(['1000']), 1000)
+        self.assertEqual(decode([]), 0)
+        decode = FloatField().get_decoder(self.connection)
+        self.assertEqual(decode(['1.5']), 1.5)
+        self.assertEqual(decode([]), 0.0)
+        decode = ListField().get_decoder(self.connection)
+        self.assertEqual(decode(['foo', 'bar']), [u'foo', u'bar'])
+
+    def test_from_ldap_override(self):
+        class UpperCharField(CharField):
+            def from_ldap(self, value, connection):
+                return super(UpperCharField, self).from_ldap(
+                    value, connection).upper()
+
+        self.assertEqual(CharField().from_ldap(['foo'], self.connection),
+                         u'foo')
+        decode = field_decoder(UpperCharField(), self.connection)
+        self.assertEqual(decode(['foo']), u'FOO')
+
+    def test_date(self):
+        decode = DateField().get_decoder(self.connection)
+        self.assertEqual(decode(['2013-01-05']), datetime.date(2013, 1, 5))
+        self.assertEqual(decode(['2013-1-5']), datetime.date(2013, 1, 5))
+        self.assertEqual(decode([]), None)
+        self.assertRaises(ValueError, decode, ['2013-13-05'])
+        self.assertRaises(ValueError, decode, ['2013-01-+5'])
+
+        decode = DateField(format='%d/%m/%Y').get_decoder(self.connection)
+        self.assertEqual(decode(['05/01/2013']), datetime.date(2013, 1, 5))
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class MatchingRulesTestCase(TestCase):
+    def test_defaults(self):
+        self.assertEqual(CharField().equality_rule, 'caseIgnoreMatch')
+        self.assertEqual(CharField().ordering_rule, 'caseIgnoreOrderingMatch')
+        self.assertEqual(IntegerField().equality_rule, 'integerMatch')
+        self.assertEqual(ListField().equality_rule, None)
+
+    def test_arguments(self):
+        field = CharField(equality_rule='caseExactIA5Match',
+                          ordering_rule=None)
+        self.assertEqual(field.equality_rule, 'caseExactIA5Match')
+        self.assertEqual(field.ordering_rule, None)
+        self.assertEqual(CharField.equality_rule, 'caseIgnoreMatch')
+        self.assertEqual(ListField(equality_rule='caseExactIA5Match')
+                         .equality_rule, 'caseExactIA5Match')
+
+
+class ChainTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_chain(self):
+        future = create_future()
+        chained = chain(future, lambda x: x + 1)
+        future.set_result(1)
+        self.assertEqual(self.loop.run_until_complete(chained), 2)
+
+    def test_chain_future(self):
+        future = create_future()
+        inner = create_future()
+        chained = chain(future, lambda x: inner)
+        future.set_result(1)
+        self.loop.call_soon(inner.set_result, 3)
+        self.assertEqual(self.loop.run_until_complete(chained), 3)
+
+    def test_chain_error(self):
+        future = create_future()
+        chained = chain(future, lambda x: x, lambda e: 'failed')
+        future.set_exception(KeyError('foo'))
+        self.assertEqual(self.loop.run_until_complete(chained), 'failed')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class PollerTestCase(TestCase):
+    entries = [('cn=foo,ou=groups,dc=example', {'cn': ['foo']}),
+               ('cn=bar,ou=groups,dc=example', {'cn': ['bar']})]
+
+    def setUp(self):
+        self.connection = FakeLDAPObject(self.entries)
+        self.poller = Poller(lambda: self.connection, max_connections=1)
+        self.poller.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.poller.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def submit(self, method, *args):
+        return self.loop.run_until_complete(
+            submit_async(self.poller, method, args))
+
+    def test_operations(self):
+        self.assertEqual(self.submit('search_ext', 'ou=groups,dc=example',
+                                     ldap.SCOPE_SUBTREE),
+                         (self.entries, []))
+        self.assertEqual(self.submit('modify_ext',
+                                     'cn=foo,ou=groups,dc=example', []),
+                         (ldap.RES_MODIFY, []))
+
+        self.connection.errors['cn=bar,ou=groups,dc=example'] = \
+            ldap.NO_SUCH_OBJECT()
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.submit, 'delete_ext',
+                          'cn=bar,ou=groups,dc=example')
+        self.assertEqual(self.connection.requests,
+                         [('search', 'ou=groups,dc=example',
+                           '(objectClass=*)'),
+                          ('modify', 'cn=foo,ou=groups,dc=example'),
+                          ('delete', 'cn=bar,ou=groups,dc=example')])
+
+    def test_closed_loop(self):
+        # a result received once its event loop is closed is dropped
+        received = threading.Event()
+
+        def callback(result, error):
+            received.set()
+
+        self.connection.delay = 0.1
+        submit_async(self.poller, 'search_ext', ('ou=groups,dc=example',
+                                                 ldap.SCOPE_SUBTREE))
+        self.poller.submit('search_ext', ('ou=groups,dc=example',
+                                          ldap.SCOPE_SUBTREE), callback)
+        self.loop.close()
+        self.assertTrue(received.wait(5))
+
+        # the poller keeps serving the other loops
+        self.connection.delay = 0
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.assertTrue(self.poller.is_alive())
+        self.assertEqual(len(self.submit('search_ext',
+                                         'ou=groups,dc=example',
+                                         ldap.SCOPE_SUBTREE)[0]), 2)
+
+    def test_close(self):
+        self.connection.delay = 10
+        future = submit_async(self.poller, 'search_ext',
+                              ('ou=groups,dc=example', ldap.SCOPE_SUBTREE))
+        while not self.connection.requests:
+            time.sleep(0.01)
+        self.poller.close()
+        self.assertRaises(ldap.SERVER_DOWN, self.loop.run_until_complete,
+                          future)
+        self.assertTrue(self.connection.unbound)